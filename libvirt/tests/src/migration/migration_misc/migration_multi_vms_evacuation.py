@@ -0,0 +1,101 @@
+import json
+import os
+
+from virttest import utils_test
+from virttest.libvirt_xml import vm_xml
+from virttest.utils_libvirt import libvirt_vmxml
+from virttest.utils_test import libvirt
+
+from provider.migration import base_steps
+from provider.migration import migration_base
+
+
+def run(test, params, env):
+    """
+    Evacuate several vms to the target host with a limited number of
+    concurrent migrations, a scheduling policy and a shared bandwidth
+    budget, and report the total evacuation time and the timing of each vm.
+
+    :param test: test object
+    :param params: Dictionary with the test parameters
+    :param env: Dictionary with test environment.
+    """
+    def setup_vm(vm):
+        """
+        Put the vm disk on the shared storage, start it and run the workload
+
+        :param vm: vm object
+        """
+        disk_dict = {'source': {'attrs': {'file': os.path.join(
+            nfs_mount_dir,
+            os.path.basename(vm.get_first_disk_devices()['source']))}}}
+        libvirt_vmxml.modify_vm_device(
+            vm_xml.VMXML.new_from_inactive_dumpxml(vm.name), 'disk', disk_dict)
+        if not vm.is_alive():
+            vm.start()
+        vm.wait_for_login().close()
+        if stress_args:
+            utils_test.load_stress("stress_in_vms", params=params, vms=[vm])
+
+    vm_name = params.get("migrate_main_vm")
+    vm_names = params.get("evacuation_vms", vm_name).split()
+    nfs_mount_dir = params.get("nfs_mount_dir")
+    dest_uri = params.get("virsh_migrate_desturi")
+    stress_args = params.get("stress_args")
+    max_total_time = params.get("evacuation_max_time")
+
+    vm = env.get_vm(vm_name)
+    params.update({'vm_obj': vm})
+    migration_obj = base_steps.MigrationBase(test, vm, params)
+    vms = [env.get_vm(name) for name in vm_names]
+    extra_vms = [extra_vm for extra_vm in vms if extra_vm.name != vm_name]
+    backup_xmls = [vm_xml.VMXML.new_from_inactive_dumpxml(extra_vm.name).copy()
+                   for extra_vm in extra_vms]
+    scheduler = migration_base.MigrationScheduler(
+        vms, dest_uri,
+        options=params.get("virsh_migrate_options", "--live --verbose"),
+        extra=params.get("virsh_migrate_extra", ""),
+        concurrency=params.get_numeric("evacuation_concurrency", 2),
+        policy=params.get("evacuation_policy", "fifo"),
+        bandwidth_budget=params.get_numeric("evacuation_bandwidth_budget", 0),
+        virsh_options=params.get("virsh_options", ""))
+
+    try:
+        migration_obj.setup_connection()
+        if stress_args:
+            utils_test.load_stress("stress_in_vms", params=params, vms=[vm])
+        for extra_vm in extra_vms:
+            setup_vm(extra_vm)
+
+        test.log.info("TEST_STEP: Evacuate vms %s with %s policy",
+                      vm_names, scheduler.policy)
+        result = scheduler.run()
+        with open(os.path.join(test.outputdir, "evacuation.json"), "w") as fd:
+            json.dump(result, fd, indent=2)
+        for name, timing in sorted(result["vms"].items(),
+                                   key=lambda item: item[1]["order"]):
+            test.log.info("%s: waited %ss, migrated in %ss, status %s",
+                          name, timing["wait"], timing["duration"],
+                          timing["status"])
+        test.log.info("Total evacuation time: %ss", result["total_time"])
+
+        test.log.info("TEST_STEP: Check the vms on the target host")
+        failed = [name for name, timing in result["vms"].items()
+                  if timing["status"]]
+        if failed:
+            test.fail("Migration failed for %s: %s" % (
+                failed, [result["vms"][name].get("error") for name in failed]))
+        for name in vm_names:
+            if not libvirt.check_vm_state(name, "running", uri=dest_uri):
+                test.fail("VM %s is not running on the target host" % name)
+        if max_total_time and result["total_time"] > float(max_total_time):
+            test.fail("Total evacuation time %ss is longer than %ss"
+                      % (result["total_time"], max_total_time))
+    finally:
+        if stress_args:
+            utils_test.unload_stress("stress_in_vms", params=params, vms=vms)
+        for extra_vm, backup_xml in zip(extra_vms, backup_xmls):
+            extra_vm.connect_uri = migration_obj.src_uri
+            migration_obj.migration_test.cleanup_vm(extra_vm, dest_uri)
+            backup_xml.sync()
+        migration_obj.cleanup_connection()
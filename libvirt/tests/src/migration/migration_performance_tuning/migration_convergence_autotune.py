@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+
+from virttest import virsh
+
+from provider.migration import base_steps
+from provider.migration import migration_base
+
+
+def run(test, params, env):
+    """
+    Measure the guest dirty rate and the link bandwidth, predict the
+    migration, choose the bandwidth, maxdowntime or postcopy switch over
+    point from the prediction, migrate with them and record the prediction
+    error against the completed job.
+
+    :param test: test object
+    :param params: Dictionary with the test parameters
+    :param env: Dictionary with test environment.
+    """
+    def get_guest_memory():
+        """
+        Get the memory sent in the first iteration, in MiB
+
+        Never touched guest pages are sent as zero pages, so the resident
+        memory of the qemu process is used.
+        """
+        with open("/proc/%s/status" % vm.get_pid()) as fd:
+            for line in fd:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+        test.error("Failed to get the resident memory of vm")
+
+    vm_name = params.get("migrate_main_vm")
+    link_bandwidth = params.get("migration_link_bandwidth")
+    iperf_port = params.get("iperf_port", "5201")
+    target_downtime = int(params.get("target_downtime", "300"))
+    max_downtime_limit = int(params.get("max_downtime_limit", "2000"))
+    max_total_time = params.get("max_total_time")
+    working_set = params.get("dirty_workload_size")
+    period = int(params.get("dirty_rate_calc_period", "1"))
+    prediction_tolerance = params.get("prediction_tolerance")
+    base_extra = params.get("virsh_migrate_extra", "")
+    base_options = params.get("virsh_migrate_options", "--live --verbose")
+
+    vm = env.get_vm(vm_name)
+    params.update({'vm_obj': vm})
+    migration_obj = base_steps.MigrationBase(test, vm, params)
+    if not migration_obj.job_sampler:
+        migration_obj.job_sampler = migration_base.MigrationJobSampler(vm_name)
+
+    try:
+        migration_obj.setup_connection()
+        test.log.info("TEST_STEP: Measure the dirty rate and link bandwidth")
+        if params.get("dirty_workload_rate"):
+            migration_obj.start_dirty_workload()
+        dirty_rate = migration_base.get_dirty_rate(vm_name, period)
+        if link_bandwidth:
+            link_bandwidth = float(link_bandwidth)
+        else:
+            migration_obj.remote_add_or_remove_port(iperf_port)
+            try:
+                link_bandwidth = migration_base.measure_link_bandwidth(
+                    params, iperf_port)
+            finally:
+                migration_obj.remote_add_or_remove_port(iperf_port, add=False)
+        memory = get_guest_memory()
+
+        test.log.info("TEST_STEP: Predict the migration and choose the settings")
+        tuning = migration_base.tune_migration(
+            memory, dirty_rate, link_bandwidth, target_downtime,
+            max_downtime_limit,
+            working_set=float(working_set) if working_set else None,
+            max_total_time=float(max_total_time) if max_total_time else None)
+        test.log.info("Memory %.1f MiB, dirty rate %.1f MiB/s, link %.1f "
+                      "MiB/s, chosen settings: %s", memory, dirty_rate,
+                      link_bandwidth, tuning)
+        params.update({"virsh_migrate_extra": "%s --bandwidth %s"
+                       % (base_extra, tuning["bandwidth"])})
+        virsh.migrate_setmaxdowntime(vm_name, tuning["maxdowntime"],
+                                     debug=True, ignore_status=False)
+        switch_thread = None
+        if tuning["postcopy_after_iteration"]:
+            params.update({"virsh_migrate_options": "%s --postcopy" % base_options})
+            switch_thread = threading.Thread(
+                target=migration_base.switch_to_postcopy_after_iteration,
+                args=(vm_name, tuning["postcopy_after_iteration"]))
+            switch_thread.start()
+
+        test.log.info("TEST_STEP: Migrate with the chosen settings")
+        try:
+            migration_obj.run_migration()
+        finally:
+            if switch_thread:
+                switch_thread.join()
+        migration_obj.verify_default()
+
+        error = migration_base.get_prediction_error(
+            tuning["prediction"], migration_obj.job_sampler.completed)
+        result = {"memory": round(memory, 1), "dirty_rate": dirty_rate,
+                  "link_bandwidth": round(link_bandwidth, 1),
+                  "tuning": tuning, "error": error}
+        with open(os.path.join(test.outputdir, "convergence_prediction.json"), "w") as fd:
+            json.dump(result, fd, indent=2)
+        for name, item in error.items():
+            test.log.info("%s: predicted %s, actual %s, error %s", name,
+                          item["predicted"], item["actual"], item["error"])
+        if prediction_tolerance:
+            failed = [name for name, item in error.items()
+                      if item["error"] is not None and
+                      item["error"] > float(prediction_tolerance)]
+            if failed:
+                test.fail("Prediction error of %s is larger than %s"
+                          % (failed, prediction_tolerance))
+    finally:
+        migration_obj.cleanup_connection()
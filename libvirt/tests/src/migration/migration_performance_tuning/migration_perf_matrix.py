@@ -0,0 +1,85 @@
+import json
+import os
+
+from provider.migration import base_steps
+from provider.migration import migration_base
+
+
+def run(test, params, env):
+    """
+    Sweep parallel connections, compression method, zerocopy and bandwidth
+    of migration under the calibrated dirty workload, record total time,
+    downtime, transferred data and cpu usage on both hosts, and rank the
+    configurations.
+
+    :param test: test object
+    :param params: Dictionary with the test parameters
+    :param env: Dictionary with test environment.
+    """
+    vm_name = params.get("migrate_main_vm")
+    base_extra = params.get("virsh_migrate_extra", "")
+    rank_by = params.get("matrix_rank_by", "total_time downtime").split()
+
+    vm = env.get_vm(vm_name)
+    params.update({'vm_obj': vm})
+    migration_obj = base_steps.MigrationBase(test, vm, params)
+    if not migration_obj.job_sampler:
+        migration_obj.job_sampler = migration_base.MigrationJobSampler(vm_name)
+    matrix = migration_base.build_mig_perf_matrix(params)
+    if not matrix:
+        test.error("No valid migration configuration to sweep")
+
+    results = []
+    try:
+        migration_obj.setup_connection()
+        for config in matrix:
+            options = migration_base.get_mig_perf_options(config)
+            test.log.info("TEST_STEP: Migrate with options '%s'", options)
+            params.update({"virsh_migrate_extra": "%s %s" % (base_extra, options)})
+            if not vm.is_alive():
+                vm.start()
+                # The dirty workload is started again in the new boot
+                migration_obj.dirty_workload_started = False
+            vm.wait_for_login().close()
+
+            src_ticks = migration_base.get_host_cpu_ticks()
+            dest_ticks = migration_base.get_host_cpu_ticks(params)
+            migration_obj.run_migration()
+            src_cpu = migration_base.get_cpu_usage(
+                src_ticks, migration_base.get_host_cpu_ticks())
+            dest_cpu = migration_base.get_cpu_usage(
+                dest_ticks, migration_base.get_host_cpu_ticks(params))
+
+            completed = migration_obj.job_sampler.completed
+            passed = int(migration_obj.migration_test.ret.exit_status) == 0
+            result = dict(config)
+            result.update({"options": options,
+                           "passed": passed,
+                           "total_time": completed.get("Time elapsed"),
+                           "downtime": completed.get("Total downtime"),
+                           "transferred": completed.get("Data processed"),
+                           "iterations": completed.get("Iteration"),
+                           "src_cpu": src_cpu,
+                           "dest_cpu": dest_cpu})
+            test.log.debug("Migration performance result: %s", result)
+            results.append(result)
+
+            if passed:
+                migration_obj.run_migration_back()
+            vm.connect_uri = migration_obj.src_uri
+
+        ranked = migration_base.rank_mig_perf_results(results, rank_by)
+        with open(os.path.join(test.outputdir, "migration_perf_matrix.json"), "w") as fd:
+            json.dump(ranked, fd, indent=2)
+        for result in ranked:
+            test.log.info("#%d %s: total time %s ms, downtime %s ms, "
+                          "transferred %s MiB, cpu src %s%% dest %s%%%s",
+                          result["rank"], result["options"] or "default",
+                          result["total_time"], result["downtime"],
+                          result["transferred"], result["src_cpu"],
+                          result["dest_cpu"],
+                          "" if result["passed"] else " (failed)")
+        if not any(result["passed"] for result in results):
+            test.fail("Migration failed with all the configurations")
+    finally:
+        migration_obj.cleanup_connection()
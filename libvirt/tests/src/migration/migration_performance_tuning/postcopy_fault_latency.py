@@ -0,0 +1,115 @@
+import json
+import os
+import time
+
+from provider.migration import base_steps
+from provider.migration import migration_base
+
+
+def run(test, params, env):
+    """
+    Profile the remote page faults of postcopy migration with several
+    postcopy bandwidths: the postcopy phase length, the postcopy requests
+    of the migration job, and the latency percentiles of the guest memory
+    reads slowed down by the faults.
+
+    :param test: test object
+    :param params: Dictionary with the test parameters
+    :param env: Dictionary with test environment.
+    """
+    def run_touch_workload(session, duration=None):
+        """
+        Run the touch workload, for the given seconds if duration is set
+
+        :param session: vm session
+        :param duration: seconds to run, None to keep it running
+        :return: dict, the fault latency if duration is set
+        """
+        migration_base.start_touch_workload_in_vm(
+            session, working_set, duration or 3600, threshold, write_ratio)
+        if duration:
+            time.sleep(duration)
+            return migration_base.analyze_fault_latency(
+                migration_base.stop_touch_workload_in_vm(session))
+
+    vm_name = params.get("migrate_main_vm")
+    bandwidths = params.get("postcopy_bandwidths", "0").split()
+    working_set = int(params.get("touch_workload_size", "1024"))
+    threshold = int(params.get("fault_latency_threshold", "50"))
+    baseline_duration = int(params.get("baseline_duration", "10"))
+    write_ratio = float(params.get("touch_write_ratio", "0.2"))
+    switch_iteration = int(params.get("postcopy_switch_iteration", "0"))
+    precopy_bandwidth = int(params.get("precopy_bandwidth", "0"))
+    postcopy_extra = params.get("postcopy_extra_options", "")
+
+    vm = env.get_vm(vm_name)
+    params.update({'vm_obj': vm})
+    migration_obj = base_steps.MigrationBase(test, vm, params)
+    if not migration_obj.job_sampler:
+        migration_obj.job_sampler = migration_base.MigrationJobSampler(vm_name)
+    timer = migration_base.PostcopyPhaseTimer(vm_name, switch_iteration)
+
+    results = []
+    try:
+        migration_obj.setup_connection()
+        session = vm.wait_for_login()
+        test.log.info("TEST_STEP: Measure the touch latency without migration")
+        baseline = run_touch_workload(session, baseline_duration)
+        test.log.info("Baseline touch latency: %s", baseline)
+        session.close()
+
+        for bandwidth in bandwidths:
+            postcopy_options = ("--postcopy %s" % postcopy_extra).strip()
+            if int(bandwidth):
+                postcopy_options += " --postcopy-bandwidth %s" % bandwidth
+            if precopy_bandwidth:
+                postcopy_options += " --bandwidth %s" % precopy_bandwidth
+            params.update({"postcopy_options": postcopy_options})
+            test.log.info("TEST_STEP: Migrate with '%s'", postcopy_options)
+            if not vm.is_alive():
+                vm.start()
+            session = vm.wait_for_login()
+            clock_offset = migration_base.get_guest_clock_offset(session)
+            run_touch_workload(session)
+            timer.start()
+            try:
+                migration_obj.run_migration()
+            finally:
+                postcopy_time = timer.stop()
+            if int(migration_obj.migration_test.ret.exit_status):
+                test.fail("Migration with '%s' failed" % postcopy_options)
+            if not timer.switched:
+                test.fail("Migration with '%s' was not switched to postcopy"
+                          % postcopy_options)
+            # Only the slow touches in the postcopy phase are remote faults
+            completed = migration_obj.job_sampler.completed
+            window = (timer.switch_time + clock_offset,
+                      timer.end_time + clock_offset)
+            latency = migration_base.analyze_fault_latency(
+                migration_base.stop_touch_workload_in_vm(session),
+                window=window,
+                postcopy_requests=completed.get("Postcopy requests"))
+            session.close()
+
+            result = {"postcopy_bandwidth": int(bandwidth),
+                      "postcopy_time": postcopy_time,
+                      "total_time": completed.get("Time elapsed"),
+                      "downtime": completed.get("Total downtime")}
+            result.update(latency)
+            test.log.info("Postcopy fault profile: %s", result)
+            results.append(result)
+
+            migration_obj.run_migration_back()
+            vm.connect_uri = migration_obj.src_uri
+
+        with open(os.path.join(test.outputdir, "postcopy_fault_latency.json"), "w") as fd:
+            json.dump({"baseline": baseline, "results": results}, fd, indent=2)
+        for result in results:
+            test.log.info("postcopy bandwidth %s: phase %s ms, %s requests, "
+                          "%s faults, p50 %s us, p99 %s us, max %s us",
+                          result["postcopy_bandwidth"] or "unlimited",
+                          result["postcopy_time"], result["postcopy_requests"],
+                          result["faults"], result["p50"], result["p99"],
+                          result["max"])
+    finally:
+        migration_obj.cleanup_connection()
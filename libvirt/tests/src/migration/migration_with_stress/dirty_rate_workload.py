@@ -0,0 +1,80 @@
+import json
+import os
+
+from virttest import libvirt_version
+from virttest.libvirt_xml import vm_xml
+
+from provider.migration import base_steps
+from provider.migration import migration_base
+
+
+def run(test, params, env):
+    """
+    Calibrate the guest dirty workload against the dirty rate calculated by
+    domdirtyrate-calc for several rates, then migrate the vm under the
+    workload.
+
+    :param test: test object
+    :param params: Dictionary with the test parameters
+    :param env: Dictionary with test environment.
+    """
+    def calibrate(rate):
+        """
+        Measure the dirty rate of the workload with the given rate
+
+        :param rate: written rate in MiB/s
+        :return: dict, the expected and calculated dirty rate
+        """
+        session = vm.wait_for_login()
+        migration_base.start_dirty_workload_in_vm(
+            session, rate, working_set, pattern, hot_size_ratio, hot_write_ratio)
+        try:
+            actual = migration_base.get_dirty_rate(vm_name, period, mode=mode)
+        finally:
+            migration_base.stop_dirty_workload_in_vm(session)
+            session.close()
+        expected = migration_base.get_expected_dirty_rate(
+            rate, working_set, pattern, period, hot_size_ratio, hot_write_ratio)
+        error = abs(actual - expected) / expected
+        test.log.info("Rate %s MiB/s: expected %.1f MiB/s, calculated "
+                      "%.1f MiB/s, error %.2f", rate, expected, actual, error)
+        return {"rate": rate, "expected": round(expected, 2),
+                "actual": actual, "error": round(error, 3)}
+
+    vm_name = params.get("migrate_main_vm")
+    rates = params.get("dirty_workload_rates", "50 100 200").split()
+    working_set = int(params.get("dirty_workload_size", "1024"))
+    pattern = params.get("dirty_workload_pattern", "sequential")
+    hot_size_ratio = float(params.get("dirty_workload_hot_size_ratio", "0.1"))
+    hot_write_ratio = float(params.get("dirty_workload_hot_write_ratio", "0.9"))
+    period = int(params.get("dirty_rate_calc_period", "1"))
+    mode = params.get("dirty_rate_calc_mode")
+    tolerance = float(params.get("dirty_rate_tolerance", "0.25"))
+
+    dirty_ring_state = params.get("kvm_dirty_ring_state")
+
+    libvirt_version.is_libvirt_feature_supported(params)
+    vm = env.get_vm(vm_name)
+    migration_obj = base_steps.MigrationBase(test, vm, params)
+
+    try:
+        if dirty_ring_state:
+            if vm.is_alive():
+                vm.destroy()
+            vm_xml.VMXML.set_vm_features(
+                vm_name, kvm_dirty_ring_state=dirty_ring_state,
+                kvm_dirty_ring_size=params.get("kvm_dirty_ring_size"))
+        migration_obj.setup_connection()
+        test.log.info("TEST_STEP: Calibrate the %s dirty workload", pattern)
+        results = [calibrate(float(rate)) for rate in rates]
+        with open(os.path.join(test.outputdir, "dirty_rate_calibration.json"), "w") as fd:
+            json.dump(results, fd, indent=2)
+        failed = [result for result in results if result["error"] > tolerance]
+        if failed:
+            test.fail("Dirty rate is out of %s tolerance: %s" % (tolerance, failed))
+
+        test.log.info("TEST_STEP: Migrate the vm under the dirty workload")
+        migration_obj.run_migration()
+        migration_obj.verify_default()
+    finally:
+        migration_obj.cleanup_connection()
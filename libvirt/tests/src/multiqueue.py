@@ -1,4 +1,6 @@
+import json
 import logging as log
+import os
 import time
 import threading
 import re
@@ -12,6 +14,8 @@ from virttest import libvirt_vm
 from virttest.libvirt_xml import vm_xml
 from virttest.utils_test import libvirt as utlv
 
+from provider.virtual_network import network_base
+
 
 # Using as lower capital is not the best way to do, but this is just a
 # workaround to avoid changing the entire file.
@@ -296,6 +300,124 @@ def start_iperf(test, vm, params):
     return host_session, client_sessions
 
 
+def get_queue_stats(session, interface):
+    """
+    Get per queue packets and interrupts of interface in vm.
+
+    :return: dict of rx/tx packets and interrupts lists indexed by queue
+    """
+    stats = {"rx_packets": {}, "tx_packets": {}, "rx_intr": {}, "tx_intr": {}}
+    output = session.cmd_output("ethtool -S %s" % interface)
+    for direction, queue, value in re.findall(
+            r"(rx|tx)_queue_(\d+)_packets:\s*(\d+)", output):
+        stats["%s_packets" % direction][int(queue)] = int(value)
+    output = session.cmd_output("grep virtio /proc/interrupts")
+    for line in output.splitlines():
+        match = re.search(r"virtio\d+-(input|output)\.(\d+)", line)
+        if not match:
+            continue
+        count = 0
+        for value in line.split()[1:]:
+            if not value.isdigit():
+                break
+            count += int(value)
+        key = "rx_intr" if match.group(1) == "input" else "tx_intr"
+        stats[key][int(match.group(2))] = count
+    return stats
+
+
+def get_skew(values):
+    """
+    Get the skew of per queue values, as the coefficient of variation and
+    the max/mean ratio.
+    """
+    if not values or not sum(values):
+        return {"cv": 0.0, "max_mean": 0.0}
+    mean = sum(values) / len(values)
+    variance = sum((v - mean) ** 2 for v in values) / len(values)
+    return {"cv": variance ** 0.5 / mean, "max_mean": max(values) / mean}
+
+
+def run_scaling(test, vm, params):
+    """
+    Sweep the queue number and the iperf sessions, record the throughput,
+    per queue distribution and vhost cpu of each point.
+
+    The iperf server runs in the vm so the traffic is received by the vm
+    and the rx distribution shows how RSS spreads the flows.
+    """
+    server_ip = params.get("local_ip")
+    server_pwd = params.get("local_pwd")
+    max_queues = int(params.get("queue_count", 4))
+    queues_list = [int(q) for q in params.get(
+        "scaling_queues", " ".join(str(q) for q in range(1, max_queues + 1))
+    ).split()]
+    sessions_list = [int(s) for s in params.get(
+        "scaling_sessions", "1 %s" % max_queues).split()]
+    duration = int(params.get("scaling_duration", 30))
+    interface = get_vm_interface(vm, vm.get_mac_address())
+
+    host_session = remote.remote_login("ssh", server_ip, 22, "root",
+                                       server_pwd, "#")
+    session = vm.wait_for_login()
+    vm_ip = vm.get_address()
+    results = []
+    try:
+        session.cmd(params.get("firewall_cmd", "systemctl stop firewalld"),
+                    ignore_all_errors=True)
+        session.cmd("iperf -s -D")
+        for queues in queues_list:
+            if not setting_channel(test, vm, interface, "combined", queues):
+                test.fail("Failed to set %s queues" % queues)
+            vhost_tids = network_base.get_vhost_tids(vm)
+            for sessions in sessions_list:
+                before = get_queue_stats(session, interface)
+                vhost_before = network_base.get_threads_cpu_time(vhost_tids)
+                output = host_session.cmd_output(
+                    "iperf -c %s -t %s -P %s -f m"
+                    % (vm_ip, duration, sessions), timeout=duration + 60)
+                vhost_after = network_base.get_threads_cpu_time(vhost_tids)
+                after = get_queue_stats(session, interface)
+                rates = re.findall(r"([\d.]+)\s+Mbits/sec", output)
+                if not rates:
+                    test.fail("Failed to get iperf result: %s" % output)
+                point = {"queues": queues, "sessions": sessions,
+                         "throughput": float(rates[-1])}
+                for key in before:
+                    delta = [after[key].get(q, 0) - before[key].get(q, 0)
+                             for q in range(queues)]
+                    point[key] = delta
+                    point["%s_skew" % key] = get_skew(delta)
+                point["vhost_cpu"] = {
+                    tid: (vhost_after[tid] - vhost_before[tid]) / duration
+                    for tid in vhost_after if tid in vhost_before}
+                logging.info("Scaling point: %s", point)
+                results.append(point)
+    finally:
+        session.cmd_output("pkill iperf")
+        host_session.close()
+        session.close()
+
+    for point in results:
+        base = [p for p in results if p["queues"] == queues_list[0] and
+                p["sessions"] == point["sessions"]][0]
+        point["speedup"] = (point["throughput"] / base["throughput"]
+                            if base["throughput"] else 0.0)
+        point["efficiency"] = (point["speedup"] * queues_list[0] /
+                               point["queues"])
+    with open(os.path.join(test.resultsdir, "multiqueue_scaling.json"),
+              "w") as result_file:
+        json.dump(results, result_file, indent=2)
+    max_skew = params.get("max_rx_skew")
+    if max_skew:
+        skewed = [p for p in results if p["sessions"] >= p["queues"] and
+                  p["rx_packets_skew"]["cv"] > float(max_skew)]
+        if skewed:
+            test.fail("The load is not spread across the queues: %s"
+                      % skewed)
+    return results
+
+
 def run(test, params, env):
     """
     Test multi function of vm devices.
@@ -329,6 +451,10 @@ def run(test, params, env):
         if len(vhost_pids) != int(params.get("queue_count")):
             test.fail("Vhost count is not matched with queue.")
 
+        if params.get("application") == "scaling":
+            run_scaling(test, new_vm, params)
+            return
+
         affinity_cpu_number = params.get("affinity_cpu_number", '1')
         # Here, cpu affinity should be in this format:
         # 0001 means CPU0, 0010 means CPU1...
@@ -0,0 +1,83 @@
+import json
+import os
+
+from virttest import utils_misc
+from virttest import utils_net
+from virttest import virsh
+from virttest.libvirt_xml import vm_xml
+from virttest.utils_libvirt import libvirt_network
+from virttest.utils_libvirt import libvirt_vmxml
+
+from provider.virtual_network import network_base
+
+
+def run(test, params, env):
+    """
+    Measure how the data path scales with vm density by concurrent
+    east-west netperf streams between all the vms.
+    """
+    vms = params.get('vms').split()
+    vm_objs = [env.get_vm(vm_i) for vm_i in vms]
+    br_type = params.get('br_type', '')
+    rand_id = utils_misc.generate_random_string(3)
+    br_name = br_type + '_' + rand_id
+    host_iface = params.get('host_iface')
+    host_iface = host_iface if host_iface else utils_net.get_net_if(
+        state='UP')[0]
+    network_attrs = eval(params.get('network_attrs', '{}'))
+    iface_attrs = eval(params.get('iface_attrs'))
+    min_fairness = float(params.get('min_fairness', 0))
+    # Direct interfaces can't be reached from the host
+    serial = iface_attrs.get('type_name') == 'direct'
+
+    bkxmls = list(map(vm_xml.VMXML.new_from_inactive_dumpxml, vms))
+
+    try:
+        if br_type == 'linux_br':
+            utils_net.create_linux_bridge_tmux(br_name, host_iface)
+        elif br_type == 'ovs_br':
+            utils_net.create_ovs_bridge(br_name)
+        if network_attrs:
+            libvirt_network.create_or_del_network(network_attrs)
+            test.log.debug(
+                f'Network xml:\n'
+                f'{virsh.net_dumpxml(network_attrs["name"]).stdout_text}')
+        for vm_name in vms:
+            vmxml = vm_xml.VMXML.new_from_inactive_dumpxml(vm_name)
+            vmxml.del_device('interface', by_tag=True)
+            libvirt_vmxml.modify_vm_device(vmxml, 'interface', iface_attrs)
+
+        test.log.info('TEST_STEP: Start the VM(s)')
+        [vm_inst.start() for vm_inst in vm_objs]
+        if serial:
+            [vm_inst.wait_for_serial_login().close() for vm_inst in vm_objs]
+        else:
+            [vm_inst.wait_for_login().close() for vm_inst in vm_objs]
+
+        test.log.info('TEST_STEP: Run concurrent netperf streams')
+        results = network_base.exec_netperf_mesh(params, env, serial)
+        with open(os.path.join(test.resultsdir, 'netperf_mesh.json'),
+                  'w') as result_file:
+            json.dump(results, result_file, indent=2)
+        for pair in results['pairs']:
+            test.log.info(f'{pair["client"]} -> {pair["server"]}: '
+                          f'{pair["throughput"]}')
+        test.log.info(f'Aggregate: {results["aggregate"]}, fairness: '
+                      f'{results["fairness"]:.3f}, host cpu: '
+                      f'{results["host_cpu"]:.2f}%')
+
+        failed = [pair for pair in results['pairs'] if not pair['throughput']]
+        if failed:
+            test.fail(f'Netperf streams failed: {failed}')
+        if results['fairness'] < min_fairness:
+            test.fail(f'Fairness {results["fairness"]:.3f} is lower than '
+                      f'{min_fairness}')
+
+    finally:
+        [backup_xml.sync() for backup_xml in bkxmls]
+        if network_attrs:
+            libvirt_network.create_or_del_network(network_attrs, is_del=True)
+        if br_type == 'linux_br':
+            utils_net.delete_linux_bridge_tmux(br_name, host_iface)
+        elif br_type == 'ovs_br':
+            utils_net.delete_ovs_bridge(br_name)
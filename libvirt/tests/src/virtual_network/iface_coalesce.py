@@ -1,4 +1,6 @@
+import json
 import logging as log
+import os
 import time
 import re
 
@@ -6,20 +8,178 @@ import re
 from virttest import virt_vm
 from virttest import virsh
 from virttest import utils_net
+from virttest import utils_package
 from virttest.utils_test import libvirt
 from virttest.libvirt_xml import vm_xml, xcepts
 from virttest.libvirt_xml.network_xml import NetworkXML
 from virttest.libvirt_xml.devices.interface import Interface
+from virttest.utils_libvirt import libvirt_vmxml
 from avocado.utils import process
 
 from virttest import libvirt_version
 
+from provider.virtual_network import network_base
+
 
 # Using as lower capital is not the best way to do, but this is just a
 # workaround to avoid changing the entire file.
 logging = log.getLogger('avocado.' + __name__)
 
 
+def measure_coalesce_point(session, server_ip, irq_pattern, duration,
+                           stream_opts=''):
+    """
+    Run TCP_STREAM and TCP_RR with the current coalesce setting
+
+    :param session: vm session
+    :param server_ip: ip address of netserver on host
+    :param irq_pattern: pattern of the guest irqs of the interface
+    :param duration: length of each netperf run in seconds
+    :param stream_opts: extra options of TCP_STREAM
+    :return: dict of throughput, mean and p99 latency, interrupt rate and
+             host cpu
+    """
+    point = {}
+    for test_type, key in (("TCP_STREAM", "stream"), ("TCP_RR", "rr")):
+        opts = stream_opts if test_type == "TCP_STREAM" else ""
+        irq_before = network_base.get_guest_irq_count(session, irq_pattern)
+        ticks_before = network_base.get_host_cpu_ticks()
+        start = time.time()
+        result = network_base.run_guest_netperf(session, server_ip,
+                                                test_type, duration, opts)
+        elapsed = time.time() - start
+        irq_after = network_base.get_guest_irq_count(session, irq_pattern)
+        ticks_after = network_base.get_host_cpu_ticks()
+        busy = ticks_after[0] - ticks_before[0]
+        total = ticks_after[1] - ticks_before[1]
+        point[key + "_throughput"] = result["throughput"]
+        point[key + "_latency"] = result["mean_latency"]
+        point[key + "_p99_latency"] = result["p99_latency"]
+        point[key + "_irq_rate"] = round((irq_after - irq_before) / elapsed, 1)
+        point[key + "_host_cpu"] = round(busy / total * 100, 2) if total else 0.0
+    return point
+
+
+def get_guest_coalesce(session, iface, keys=None):
+    """
+    Get the coalesce settings of the guest interface by ethtool -c
+
+    :param session: vm session
+    :param iface: interface name in vm
+    :param keys: names of the settings to get, all numeric ones if None
+    :return: dict of the settings, e.g. {"rx-usecs": 0}
+    """
+    output = session.cmd_output("ethtool -c %s" % iface)
+    settings = dict((key, int(value)) for key, value in
+                    re.findall(r"^([\w-]+):\s+(\d+)\s*$", output, re.M))
+    if keys is not None:
+        settings = dict((key, settings[key]) for key in keys
+                        if key in settings)
+    return settings
+
+
+def run_coalesce_sweep(test, params, vm):
+    """
+    Sweep interrupt coalescing and report the pareto front
+
+    The rx frames of the host tap are set through the interface xml, which
+    is the only coalesce setting libvirt supports, the guest side rx/tx
+    usecs/frames are set by ethtool in the guest when the virtio-net device
+    supports notification coalescing.
+
+    :param test: test instance
+    :param params: test params
+    :param vm: vm instance
+    """
+    vm_name = vm.name
+    rx_frames_list = params.get("sweep_rx_frames", "0 8 16 32 64").split()
+    guest_opts_list = [opts.strip() for opts in
+                       params.get("sweep_guest_coalesce", "").split(";")]
+    duration = int(params.get("sweep_duration", "20"))
+    stream_opts = params.get("stream_opts", "")
+    objectives = dict(item.split(":") for item in params.get(
+        "sweep_objectives",
+        "stream_throughput:max rr_latency:min rr_p99_latency:min "
+        "stream_host_cpu:min").split())
+
+    if vm.is_alive():
+        vm.destroy(gracefully=False)
+    vmxml_backup = vm_xml.VMXML.new_from_inactive_dumpxml(vm_name)
+    points = []
+    try:
+        if not utils_package.package_install("netperf"):
+            test.error("Unable to install netperf on host")
+        process.run("systemctl stop firewalld", ignore_status=True)
+        process.run("netserver", shell=True)
+        for rx_frames in rx_frames_list:
+            vmxml = vm_xml.VMXML.new_from_inactive_dumpxml(vm_name)
+            libvirt_vmxml.modify_vm_device(vmxml, "interface",
+                                           {"coalesce": {"max": rx_frames}})
+            vm.start()
+            session = vm.wait_for_login()
+            try:
+                if not utils_package.package_install("netperf", session):
+                    test.error("Unable to install netperf on vm")
+                session.cmd("systemctl stop firewalld", ignore_all_errors=True)
+                guest_iface = utils_net.get_linux_ifname(
+                    session, vm.get_virsh_mac_address())
+                # irqs of virtio-net are named as virtioN-input.M/output.M
+                irq_pattern = session.cmd_output(
+                    "basename $(readlink /sys/class/net/%s/device)" %
+                    guest_iface).strip() + "-"
+                server_ip = params.get("netperf_server_ip")
+                if not server_ip:
+                    server_ip = utils_net.get_default_gateway(
+                        session=session, force_dhcp=True, json=True)
+                # Restore the settings changed by the previous entry, so
+                # each point only runs with its own guest options
+                sweep_keys = set(opt for opts in guest_opts_list
+                                 for opt in opts.split()[::2])
+                orig_coalesce = get_guest_coalesce(session, guest_iface,
+                                                   sweep_keys)
+                reset_opts = " ".join("%s %s" % item for item in
+                                      orig_coalesce.items())
+                for guest_opts in guest_opts_list:
+                    if reset_opts:
+                        session.cmd_status_output(
+                            "ethtool -C %s %s" % (guest_iface, reset_opts))
+                    if guest_opts:
+                        status, output = session.cmd_status_output(
+                            "ethtool -C %s %s" % (guest_iface, guest_opts))
+                        if status:
+                            logging.warning("Skip guest coalesce '%s': %s",
+                                            guest_opts, output)
+                            continue
+                    point = {"rx_frames": int(rx_frames),
+                             "guest_coalesce": guest_opts,
+                             "guest_coalesce_actual": get_guest_coalesce(
+                                 session, guest_iface, sweep_keys)}
+                    point.update(measure_coalesce_point(
+                        session, server_ip, irq_pattern, duration,
+                        stream_opts))
+                    logging.info("Coalesce point: %s", point)
+                    points.append(point)
+            finally:
+                session.close()
+                vm.destroy(gracefully=False)
+
+        if not points:
+            test.error("No coalesce setting was measured")
+        front = network_base.pareto_front(points, objectives)
+        result_file = os.path.join(test.outputdir, "coalesce_sweep.json")
+        with open(result_file, "w") as fd:
+            json.dump({"objectives": objectives, "points": points,
+                       "pareto_front": front}, fd, indent=2)
+        for point in front:
+            logging.info("Pareto optimal coalesce setting: %s", point)
+    finally:
+        process.run("pkill netserver", ignore_status=True)
+        process.run("systemctl start firewalld", ignore_status=True)
+        if vm.is_alive():
+            vm.destroy(gracefully=False)
+        vmxml_backup.sync()
+
+
 def run(test, params, env):
     """
     Since 3.3.0, Coalesce setting is supported.
@@ -196,6 +356,10 @@ def run(test, params, env):
     vm_name = params.get("main_vm")
     vm = env.get_vm(vm_name)
 
+    if params.get("coalesce_sweep", "no") == "yes":
+        run_coalesce_sweep(test, params, vm)
+        return
+
     def get_first_phy_iface():
         """
         Get first physical network interface from output of 'ls /sys/class/net'
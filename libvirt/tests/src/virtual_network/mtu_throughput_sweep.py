@@ -0,0 +1,160 @@
+import json
+import os
+import time
+
+from avocado.utils import process
+
+from virttest import utils_misc
+from virttest import utils_net
+from virttest import utils_package
+from virttest import virsh
+from virttest.libvirt_xml import vm_xml
+from virttest.utils_libvirt import libvirt_network
+from virttest.utils_libvirt import libvirt_vmxml
+
+from provider.virtual_network import network_base
+
+
+def measure_workload(session, server_ip, test_type, duration, test_opts):
+    """
+    Run one netperf workload and account the host cpu per byte
+
+    :param session: client vm session
+    :param server_ip: ip address of the server vm
+    :param test_type: netperf test type
+    :param duration: length of the run in seconds
+    :param test_opts: test specific netperf options
+    :return: dict of throughput, host cpu and host cpu time per byte
+    """
+    ticks_before = network_base.get_host_cpu_ticks()
+    start = time.time()
+    result = network_base.run_guest_netperf(session, server_ip, test_type,
+                                            duration, test_opts)
+    elapsed = time.time() - start
+    ticks_after = network_base.get_host_cpu_ticks()
+    busy = ticks_after[0] - ticks_before[0]
+    total = ticks_after[1] - ticks_before[1]
+    # TCP_STREAM throughput is in 10^6bits/s
+    transferred = result['throughput'] * 1e6 / 8 * duration
+    cpu_time = busy / os.sysconf('SC_CLK_TCK')
+    return {'throughput': result['throughput'],
+            'units': result['units'],
+            'host_cpu': round(busy / total * 100, 2) if total else 0.0,
+            'elapsed': round(elapsed, 2),
+            'cpu_ns_per_byte': round(cpu_time * 1e9 / transferred, 3)
+            if transferred else None}
+
+
+def run(test, params, env):
+    """
+    Measure the throughput and host cpu per byte of bulk and small message
+    netperf streams between 2 vms while sweeping the mtu of the data path.
+    """
+    vms = params.get('vms').split()
+    vm_objs = [env.get_vm(vm_i) for vm_i in vms]
+    iface_type = params.get('iface_type')
+    mtu_list = [int(mtu) for mtu in params.get('mtu_list').split()]
+    duration = int(params.get('netperf_duration', 30))
+    workloads = eval(params.get('workloads'))
+    test_ips = params.get('test_ips').split()
+    test_netmask = params.get('test_netmask', '24')
+    rand_id = utils_misc.generate_random_string(3)
+    host_dev = params.get('host_dev_prefix', 'mtu') + '_' + rand_id
+    network_attrs = eval(params.get('network_attrs', '{}'))
+    iface_attrs = eval(params.get('iface_attrs'))
+
+    bkxmls = list(map(vm_xml.VMXML.new_from_inactive_dumpxml, vms))
+    points = []
+    try:
+        if not utils_package.package_install('netperf'):
+            test.error('Unable to install netperf on host')
+        if iface_type == 'bridge':
+            process.run(f'ip link add {host_dev} type bridge && '
+                        f'ip link set {host_dev} up', shell=True)
+        elif iface_type == 'direct':
+            # Use a dummy lower device so that the host uplink mtu is
+            # untouched, macvtap in bridge mode forwards between the vms
+            process.run(f'ip link add {host_dev} type dummy && '
+                        f'ip link set {host_dev} up', shell=True)
+        elif network_attrs:
+            libvirt_network.create_or_del_network(network_attrs)
+            test.log.debug(
+                f'Network xml:\n'
+                f'{virsh.net_dumpxml(network_attrs["name"]).stdout_text}')
+
+        for mtu in mtu_list:
+            test.log.info(f'TEST_STEP: Measure with mtu {mtu}')
+            attrs = dict(iface_attrs)
+            if iface_type == 'direct':
+                # libvirt can not set mtu of direct interface, the macvtap
+                # device inherits the mtu of the lower device
+                network_base.set_tap_mtu(host_dev, mtu)
+            else:
+                attrs['mtu'] = {'size': str(mtu)}
+            for vm_name, bkxml in zip(vms, bkxmls):
+                vmxml = bkxml.copy()
+                vmxml.add_device(libvirt_vmxml.create_vm_device_by_type(
+                    'interface', attrs))
+                vmxml.sync()
+            [vm_inst.start() for vm_inst in vm_objs]
+            if iface_type == 'bridge':
+                network_base.set_tap_mtu(host_dev, mtu)
+            elif iface_type == 'network':
+                network_base.set_tap_mtu(network_attrs['bridge']['name'], mtu)
+
+            sessions = []
+            try:
+                for vm_inst, test_ip in zip(vm_objs, test_ips):
+                    session = vm_inst.wait_for_login()
+                    sessions.append(session)
+                    if not utils_package.package_install('netperf', session):
+                        test.error(f'Unable to install netperf on '
+                                   f'{vm_inst.name}')
+                    session.cmd('systemctl stop firewalld',
+                                ignore_all_errors=True)
+                    # The test interface is appended after the existing ones
+                    mac = vm_xml.VMXML.new_from_dumpxml(
+                        vm_inst.name).get_devices('interface')[-1].mac_address
+                    ifname = utils_net.get_linux_ifname(session, mac)
+                    network_base.set_guest_iface_mtu(test, session, ifname,
+                                                     mtu)
+                    session.cmd(f'ip addr flush dev {ifname} && ip addr add '
+                                f'{test_ip}/{test_netmask} dev {ifname}')
+                client, server = sessions
+                server.cmd_output('killall netserver')
+                server.cmd('netserver')
+                status, output = client.cmd_status_output(
+                    f'ping -M do -s {mtu - 28} -c 3 {test_ips[1]}')
+                if status:
+                    test.fail(f'Path mtu {mtu} does not work: {output}')
+
+                point = {'mtu': mtu}
+                for name, (test_type, test_opts) in workloads.items():
+                    point[name] = measure_workload(client, test_ips[1],
+                                                   test_type, duration,
+                                                   test_opts)
+                test.log.info(f'MTU sweep point: {point}')
+                points.append(point)
+            finally:
+                [session.close() for session in sessions]
+                [vm_inst.destroy() for vm_inst in vm_objs]
+
+        with open(os.path.join(test.resultsdir, 'mtu_sweep.json'),
+                  'w') as result_file:
+            json.dump({'iface_type': iface_type, 'points': points},
+                      result_file, indent=2)
+        for point in points:
+            test.log.info(
+                f'MTU {point["mtu"]}: ' + ', '.join(
+                    f'{name} {point[name]["throughput"]} '
+                    f'{point[name]["units"]} '
+                    f'{point[name]["cpu_ns_per_byte"]} ns/byte'
+                    for name in workloads))
+
+    finally:
+        [vm_inst.destroy() for vm_inst in vm_objs if vm_inst.is_alive()]
+        [backup_xml.sync() for backup_xml in bkxmls]
+        if iface_type in ('bridge', 'direct'):
+            process.run(f'ip link del {host_dev}', ignore_status=True)
+        elif network_attrs:
+            libvirt_network.create_or_del_network(network_attrs, is_del=True)
@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+
+from avocado.utils import process
+from virttest import libvirt_version
+from virttest import utils_net
+from virttest import utils_package
+from virttest import virsh
+from virttest.libvirt_xml import vm_xml
+
+from provider.virtual_network import passt
+
+LOG = logging.getLogger('avocado.' + __name__)
+
+
+def compare_backends(results, reference, workloads):
+    """
+    Compare the throughput of each backend with the reference backend
+
+    :param results: dict of backend and its benchmark results
+    :param reference: backend to compare with
+    :param workloads: list of netperf test types
+    :return: dict of backend and throughput ratio of each workload
+    """
+    ratios = {}
+    for backend, result in results.items():
+        ratios[backend] = {}
+        for test_type in workloads:
+            ref_value = results[reference][test_type]['throughput']
+            value = result[test_type]['throughput']
+            ratios[backend][test_type] = round(value / ref_value, 3) \
+                if ref_value else None
+            LOG.info(f'{backend} {test_type}: {value} '
+                     f'{result[test_type]["units"]}, '
+                     f'{ratios[backend][test_type]} of {reference}')
+    return ratios
+
+
+def run(test, params, env):
+    """
+    Compare throughput, latency and connection rate of passt with legacy
+    user mode, tap and vhost-net data paths on the same guest
+    """
+    libvirt_version.is_libvirt_feature_supported(params)
+    vm_name = params.get('main_vm')
+    vm = env.get_vm(vm_name)
+    backends = params.get('backends', 'passt user tap vhost').split()
+    workloads = params.get('workloads', 'TCP_STREAM TCP_RR TCP_CRR').split()
+    duration = int(params.get('benchmark_duration', 30))
+    reference = params.get('reference_backend', 'vhost')
+    passt_min_ratio = params.get('passt_min_ratio')
+
+    vmxml = vm_xml.VMXML.new_from_inactive_dumpxml(vm_name)
+    bkxml = vmxml.copy()
+
+    results = {}
+    try:
+        if not utils_package.package_install('netperf'):
+            test.error('Unable to install netperf on host')
+        process.run('systemctl stop firewalld', ignore_status=True)
+        process.run('netserver', shell=True)
+
+        for backend in backends:
+            LOG.info(f'Benchmark data path of backend: {backend}')
+            iface_attrs = eval(params.get(f'iface_attrs_{backend}'))
+            passt.vm_add_iface(vmxml, iface_attrs, virsh)
+            vm.start()
+            LOG.debug(virsh.dumpxml(vm_name).stdout_text)
+            session = vm.wait_for_serial_login(timeout=60)
+            try:
+                if not utils_package.package_install('netperf', session):
+                    test.error('Unable to install netperf on vm')
+                session.cmd('systemctl stop firewalld', ignore_all_errors=True)
+                server_ip = params.get(f'server_ip_{backend}')
+                server_ip = server_ip if server_ip else \
+                    utils_net.get_default_gateway(session=session,
+                                                  force_dhcp=True, json=True)
+                pids = {'qemu': vm.get_pid()}
+                if iface_attrs.get('backend', {}).get('type') == 'passt':
+                    pids['passt'] = passt.get_passt_pid()
+                results[backend] = passt.benchmark_data_path(
+                    session, server_ip, workloads, duration, pids)
+            finally:
+                session.close()
+                vm.destroy()
+
+        ratios = {}
+        if reference in results:
+            ratios = compare_backends(results, reference, workloads)
+        result_file = os.path.join(test.outputdir, 'passt_perf_compare.json')
+        with open(result_file, 'w') as fd:
+            json.dump({'results': results, 'ratios': ratios}, fd, indent=2)
+        LOG.info(f'Benchmark results saved to {result_file}')
+
+        if passt_min_ratio and 'passt' in ratios:
+            slow = [f'{k}: {v}' for k, v in ratios['passt'].items()
+                    if v is not None and v < float(passt_min_ratio)]
+            if slow:
+                test.fail(f'passt throughput is below {passt_min_ratio} of '
+                          f'{reference}: {", ".join(slow)}')
+    finally:
+        process.run('pkill netserver', ignore_status=True)
+        process.run('systemctl start firewalld', ignore_status=True)
+        if vm.is_alive():
+            vm.destroy()
+        bkxml.sync()
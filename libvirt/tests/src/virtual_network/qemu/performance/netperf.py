@@ -7,6 +7,7 @@
 #
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+import json
 import logging
 import os
 import re
@@ -36,6 +37,7 @@ from provider.interface import interface_base
 LOG_JOB = logging.getLogger("avocado.test")
 
 _netserver_started = False
+_server_ifname = None
 
 
 def start_netserver_win(session, start_cmd, test):
@@ -352,7 +354,24 @@ def run(test, params, env):
         "TEST_STEP 6: Pin guest vCPU/vhost threads and setup host/client")
     # Pin guest vCPUs and vhost threads.
     # Use the specified NUMA node if provided; otherwise, pin sequentially to host CPUs.
-    network_base.pin_vcpu_vhost_threads(vm, params.get("numa_node"))
+    # With pinning_planner, the placement is planned from the host topology
+    # and the nic locality, and recorded with the results.
+    if params.get("pinning_planner", "no") == "yes":
+        reserved_cpus = [int(c) for c in params.get_list("reserved_cpus")]
+        # numa_node is 1-based, or negative for the last node, the same as
+        # the vhost pinning without the planner
+        node_id = None
+        if params.get("numa_node") is not None:
+            node_id = int(utils_misc.NumaNode(
+                int(params.get("numa_node"))).node_id)
+        pin_plan = network_base.plan_and_pin_vms(
+            [vm], node_id, params.get("physical_nic"), reserved_cpus)
+        with open(os.path.join(test.resultsdir, "pinning_plan.json"),
+                  "w") as plan_file:
+            json.dump(pin_plan, plan_file, indent=2)
+        test.write_test_keyval({"pinning-plan": json.dumps(pin_plan)})
+    else:
+        network_base.pin_vcpu_vhost_threads(vm, params.get("numa_node"))
 
     host_ip = host
     if host != "localhost":
@@ -432,6 +451,7 @@ def run(test, params, env):
             netserver_port=params.get("netserver_port", "12865"),
             params=params,
             test=test,
+            vm=vm,
         )
 
         if params.get("log_hostinfo_script"):
@@ -483,6 +503,7 @@ def start_test(
     netserver_port=None,
     params=None,
     test=None,
+    vm=None,
 ):
     """
     Start to test with different kind of configurations
@@ -500,21 +521,49 @@ def start_test(
     :param protocols: test type
     :param netserver_port: netserver listen port
     :param params: Dictionary with the test parameters.
+    :param vm: the netperf server vm, to profile its kvm exits
     """
+    global _netserver_started, _server_ifname
     if params is None:
         params = {}
-
-    fd = open("%s/netperf-result.%s.RHS" % (resultsdir, time.time()), "w")
-    netperf_base.record_env_version(
+    _netserver_started = False
+    _server_ifname = None
+
+    result_stamp = time.time()
+    fd = open("%s/netperf-result.%s.RHS" % (resultsdir, result_stamp), "w")
+    json_fd = open(
+        "%s/netperf-result.%s.jsonl" % (resultsdir, result_stamp), "w")
+    env_version = netperf_base.record_env_version(
         test, params, host, server_ctl, fd, test_duration)
+    json_records = []
+    samples_fd = None
+    if params.get("netperf_sample_interval"):
+        samples_fd = open(
+            "%s/netperf-samples.%s.jsonl" % (resultsdir, result_stamp), "w")
 
     record_list = [
         "size",
         "sessions",
         "throughput",
         "trans.rate",
+        "p50_lat",
+        "p90_lat",
+        "p99_lat",
+        "worst_p99_lat",
+        "max_lat",
+        "mean_lat",
+        "stddev_lat",
         "CPU",
         "thr_per_CPU",
+        "CPU_vcpu",
+        "CPU_vhost",
+        "CPU_iothread",
+        "CPU_emulator",
+        "CPU_other",
+        "thr_per_CPU_vcpu",
+        "thr_per_CPU_vhost",
+        "thr_per_CPU_iothread",
+        "thr_per_CPU_emulator",
         "rx_pkts",
         "tx_pkts",
         "rx_byts",
@@ -533,6 +582,27 @@ def start_test(
     base = params.get("format_base", "12")
     fbase = params.get("format_fbase", "2")
 
+    result_stream = None
+    if params.get("netperf_result_stream", "yes") == "yes":
+        result_stream = netperf_base.open_result_stream(
+            params, params.get("client", "localhost"))
+        if (params.get("netperf_client_agent", "yes") == "yes" and
+                params.get("os_type_client") == "linux"):
+            result_stream.start_agent()
+
+    collect_latency = params.get("netperf_latency", "no") == "yes"
+    latency_failures = []
+    cpu_attribution = None
+    if params.get("netperf_cpu_attribution", "no") == "yes" and vm:
+        if host == "localhost":
+            cpu_attribution = network_base.HostCpuAttribution(vm)
+        else:
+            test.log.warning("CPU attribution needs the vm on localhost")
+    kvm_profiler = None
+    if params.get("netperf_kvm_stat", "no") == "yes" and vm:
+        kvm_profiler = netperf_base.KvmExitProfiler(
+            host, vm.get_pid(), int(vm.dominfo().get("CPU(s)", 0)))
+
     output = netperf_base.ssh_cmd(host, "mpstat 1 1 |grep CPU")
     mpstat_head = re.findall(r"CPU\s+.*", output)[0].split()
     mpstat_key = params.get("mpstat_key", "%idle")
@@ -562,6 +632,10 @@ def start_test(
             for j in sessions_test:
                 if protocol in ("TCP_RR", "TCP_CRR"):
                     nf_args = "-t %s -v 1 -- -r %s,%s" % (protocol, i, i)
+                    if collect_latency:
+                        global_args, test_args = netperf_base.latency_args()
+                        nf_args = "-t %s -v 1 %s -- -r %s,%s %s" % (
+                            protocol, global_args, i, i, test_args)
                 elif protocol == "TCP_MAERTS":
                     nf_args = "-C -c -t %s -- -m ,%s" % (protocol, i)
                 else:
@@ -578,6 +652,9 @@ def start_test(
                     netserver_port,
                     params,
                     test,
+                    result_stream=result_stream,
+                    kvm_profiler=kvm_profiler,
+                    cpu_attribution=cpu_attribution,
                 )
                 if ret:
                     thu = float(ret["thu"])
@@ -592,10 +669,20 @@ def start_test(
                     ret["sessions"] = int(j)
                     if protocol in ("TCP_RR", "TCP_CRR"):
                         ret["trans.rate"] = thu
+                        p99_limit = params.get("latency_p99_threshold")
+                        if (p99_limit and ret.get("p99_lat") and
+                                ret["p99_lat"] > float(p99_limit)):
+                            latency_failures.append(
+                                "%s size %s sessions %s: p99 %.2fus > %sus"
+                                % (protocol, i, j, ret["p99_lat"], p99_limit))
                     else:
                         ret["throughput"] = thu
                     ret["CPU"] = cpu
                     ret["thr_per_CPU"] = normal
+                    for category, usage in ret.get("cpu_attr", {}).items():
+                        ret["CPU_%s" % category] = usage
+                        if category != "other" and usage:
+                            ret["thr_per_CPU_%s" % category] = thu / usage
                     row, key_list = netperf_base.netperf_record(
                         ret, record_list,
                         header=record_header, base=base, fbase=fbase
@@ -614,6 +701,15 @@ def start_test(
                     fd.write(row + "\n")
 
                     fd.flush()
+                    extra = {"protocol": protocol, "env": env_version}
+                    if ret.get("kvm_exits"):
+                        extra["kvm_exits"] = ret["kvm_exits"]
+                    json_records.append(netperf_base.netperf_record_json(
+                        json_fd, ret, record_list, **extra))
+                    if samples_fd and ret.get("samples"):
+                        netperf_base.netperf_record_json(
+                            samples_fd, ret, ["samples"], protocol=protocol,
+                            size=int(i), sessions=int(j))
 
                     test.log.debug("Remove temporary files")
                     process.system_output(
@@ -631,6 +727,40 @@ def start_test(
                     )
                     continue
     fd.close()
+    json_fd.close()
+    if samples_fd:
+        samples_fd.close()
+    if result_stream:
+        result_stream.close()
+
+    baseline_path = params.get("netperf_baseline")
+    if baseline_path:
+        error_context.context("Compare results with baseline %s"
+                              % baseline_path, test.log.info)
+        regressions = netperf_base.compare_with_baseline(
+            json_records,
+            netperf_base.load_json_records(baseline_path),
+            tolerance=float(params.get("netperf_regression_tolerance", 0.05)),
+            z_threshold=float(params.get("netperf_regression_zscore", 2.0)),
+        )
+        with open("%s/netperf-regression.%s.jsonl"
+                  % (resultsdir, result_stamp), "w") as reg_fd:
+            for regression in regressions:
+                reg_fd.write(json.dumps(regression, sort_keys=True) + "\n")
+        for regression in regressions:
+            test.log.warning("Regression of %(metric)s in %(protocol)s "
+                             "size %(size)s sessions %(sessions)s: "
+                             "%(value).2f vs baseline %(baseline_mean).2f",
+                             regression)
+        if regressions and params.get("netperf_fail_on_regression",
+                                      "no") == "yes":
+            test.fail("Found %d regressions against baseline %s"
+                      % (len(regressions), baseline_path))
+
+    # Fail after the regression report is written
+    if latency_failures:
+        test.fail("Latency beyond threshold:\n%s"
+                  % "\n".join(latency_failures))
 
 
 @error_context.context_aware
@@ -645,15 +775,30 @@ def launch_client(
     port,
     params,
     test,
+    result_stream=None,
+    kvm_profiler=None,
+    cpu_attribution=None,
 ):
-    """Launch netperf clients"""
+    """
+    Launch netperf clients
+
+    :param result_stream: resident NetperfResultStream of the client, the
+                          result file is polled with ssh_cmd if it's None,
+                          the sessions are launched by its agent if started
+    :param kvm_profiler: KvmExitProfiler to break down the kvm exits of
+                         the measurement window, or None
+    :param cpu_attribution: HostCpuAttribution to attribute the host cpu of
+                            the measurement window, or None
+    """
 
     netperf_version = params.get("netperf_version", "2.6.0")
     client_path = "/tmp/netperf-%s/src/netperf" % netperf_version
     server_path = "/tmp/netperf-%s/src/netserver" % netperf_version
     get_status_flag = params.get("get_status_in_guest", "no") == "yes"
+    sample_interval = float(params.get("netperf_sample_interval", 0))
+    use_agent = bool(result_stream and result_stream.agent)
     global _netserver_started
-    # Start netserver
+    # Start netserver, it keeps resident for the following cells
     if _netserver_started:
         test.log.info("Netserver already started.")
     else:
@@ -672,96 +817,31 @@ def launch_client(
             test.log.info("Netserver start cmd is '%s'", server_path)
             netperf_base.ssh_cmd(
                 server_ctl, "pidof netserver || %s" % server_path)
-            ncpu = netperf_base.ssh_cmd(
-                server_ctl, "cat /proc/cpuinfo |grep processor |wc -l"
-            )
-            ncpu = re.findall(r"\d+", ncpu)[-1]
 
+        _netserver_started = True
         test.log.info("Netserver start successfully")
 
-    def count_interrupt(name):
-        """
-        Get a list of interrut number for each queue
-
-        @param name: the name of interrupt, such as "virtio0-input"
-        """
-        sum = 0
-        intr = []
-        stat = netperf_base.ssh_cmd(
-            server_ctl, "grep %s /proc/interrupts" % name)
-        for i in stat.strip().split("\n"):
-            for cpu in range(int(ncpu)):
-                sum += int(i.split()[cpu + 1])
-            intr.append(sum)
-            sum = 0
-        return intr
+    def get_ifname():
+        global _server_ifname
+        if _server_ifname is None:
+            output = netperf_base.ssh_cmd(server_ctl, "ifconfig")
+            for i in output.split("\n\n"):
+                if server in i:
+                    _server_ifname = re.findall(r"(\w+\d+)[:\s]", i)[0]
+            if _server_ifname is None:
+                raise RuntimeError(
+                    f"no available iface associated with {server}")
+        return _server_ifname
 
     def get_state():
-        ifname = None
-        for i in netperf_base.ssh_cmd(server_ctl, "ifconfig").split("\n\n"):
-            if server in i:
-                ifname = re.findall(r"(\w+\d+)[:\s]", i)[0]
-        if ifname is None:
-            raise RuntimeError(f"no available iface associated with {server}")
-
-        path = "find /sys/devices|grep net/%s/statistics" % ifname
-        cmd = (
-            "%s/rx_packets|xargs cat;%s/tx_packets|xargs cat;"
-            "%s/rx_bytes|xargs cat;%s/tx_bytes|xargs cat"
-            % (path, path, path, path)
-        )
-        output = netperf_base.ssh_cmd(server_ctl, cmd).split()[-4:]
-
-        nrx = int(output[0])
-        ntx = int(output[1])
-        nrxb = int(output[2])
-        ntxb = int(output[3])
-
-        nre = int(
+        # One snapshot of all guest counters and one of the host exits
+        guest_state = netperf_base.parse_state_samples(
             netperf_base.ssh_cmd(
-                server_ctl, "grep Tcp /proc/net/snmp|tail -1"
-            ).split()[12]
-        )
-        state_list = [
-            "rx_pkts",
-            nrx,
-            "tx_pkts",
-            ntx,
-            "rx_byts",
-            nrxb,
-            "tx_byts",
-            ntxb,
-            "re_pkts",
-            nre,
-        ]
-        try:
-            nrx_intr = count_interrupt("virtio.-input")
-            ntx_intr = count_interrupt("virtio.-output")
-            sum = 0
-            for i in range(len(nrx_intr)):
-                state_list.append("rx_intr_%s" % i)
-                state_list.append(nrx_intr[i])
-                sum += nrx_intr[i]
-            state_list.append("rx_intr_sum")
-            state_list.append(sum)
-
-            sum = 0
-            for i in range(len(ntx_intr)):
-                state_list.append("tx_intr_%s" % i)
-                state_list.append(ntx_intr[i])
-                sum += ntx_intr[i]
-            state_list.append("tx_intr_sum")
-            state_list.append(sum)
-
-        except IndexError:
-            ninit = count_interrupt("virtio.")
-            state_list.append("intr")
-            state_list.append(ninit)
-
-        exits = int(
-            netperf_base.ssh_cmd(host, "cat /sys/kernel/debug/kvm/exits"))
-        state_list.append("exits")
-        state_list.append(exits)
+                server_ctl, netperf_base.guest_state_cmd(get_ifname())))
+        host_state = netperf_base.parse_state_samples(
+            netperf_base.ssh_cmd(host, netperf_base.host_state_cmd()))
+        state_list = netperf_base.state_to_list(
+            guest_state[0], host_state[0]["exits"])
 
         test.log.debug(f"get_state returning: {state_list}")
         return state_list
@@ -782,7 +862,10 @@ def launch_client(
 
     def all_clients_up():
         try:
-            content = netperf_base.ssh_cmd(clients[-1], "cat %s" % fname)
+            if result_stream:
+                content = result_stream.read()
+            else:
+                content = netperf_base.ssh_cmd(clients[-1], "cat %s" % fname)
         except:
             content = ""
             return False
@@ -790,6 +873,13 @@ def launch_client(
             return True
         return False
 
+    def wait_clients_exit():
+        if use_agent:
+            if not result_stream.wait_done(l):
+                test.log.warning("Netperf clients didn't exit in %ss", l)
+        else:
+            client_thread.join()
+
     def stop_netperf_clients():
         if params.get("os_type_client") == "linux":
             netperf_base.ssh_cmd(
@@ -839,17 +929,25 @@ def launch_client(
         netperf_base.ssh_cmd(clients[-1], "rm -f %s" % fname)
         numa_enable = params.get("netperf_with_numa", "yes") == "yes"
         timeout_netperf_start = int(l) * 0.5
-        client_thread = threading.Thread(
-            target=thread_cmd,
-            kwargs={
-                "params": params,
-                "i": int(sessions),
-                "numa_enable": numa_enable,
-                "client_s": clients[0],
-                "timeout": timeout_netperf_start,
-            },
-        )
-        client_thread.start()
+        client_thread = None
+        if use_agent:
+            result_stream.run(fname, int(sessions), "%s%s -D 1 -H %s -l %s %s" % (
+                netperf_base.numa_prefix(params, numa_enable), client_path,
+                server, int(l) * 1.5, nf_args))
+        else:
+            if result_stream:
+                result_stream.follow(fname)
+            client_thread = threading.Thread(
+                target=thread_cmd,
+                kwargs={
+                    "params": params,
+                    "i": int(sessions),
+                    "numa_enable": numa_enable,
+                    "client_s": clients[0],
+                    "timeout": timeout_netperf_start,
+                },
+            )
+            client_thread.start()
 
         ret = {}
         ret["pid"] = pid
@@ -858,24 +956,53 @@ def launch_client(
             all_clients_up,
             timeout_netperf_start,
             0.0,
-            0.2,
+            float(params.get("netperf_poll_step", 0.2)),
             "Wait until all netperf clients start to work",
         ):
             test.log.debug("All netperf clients start to work.")
 
             # real & effective test starts
+            sampler = None
             if get_status_flag:
                 start_state = get_state()
+                if sample_interval:
+                    sampler = netperf_base.StateSampler(
+                        server_ctl, host, get_ifname(), sample_interval)
+                    sampler.start()
+            if kvm_profiler:
+                kvm_profiler.start()
+            if cpu_attribution:
+                cpu_attribution.start()
             ret["mpstat"] = netperf_base.ssh_cmd(
                 host, "mpstat 1 %d |tail -n 1" % (l - 1)
             )
+            if cpu_attribution:
+                ret["cpu_attr"] = cpu_attribution.stop()
+            if "LATENCY" in nf_args:
+                # The latency statistics are printed when netperf finishes
+                utils_misc.wait_for(
+                    lambda: len(netperf_base.parse_latency_result(
+                        netperf_base.ssh_cmd(clients[-1], "cat %s" % fname)
+                    )) >= int(sessions),
+                    l, 0.0, 1, "Wait until netperf prints latency")
             finished_result = netperf_base.ssh_cmd(
                 clients[-1], "cat %s" % fname)
 
             # stop netperf clients
             stop_netperf_clients()
+            if result_stream:
+                result_stream.stop()
 
             # real & effective test ends
+            if kvm_profiler:
+                ret["kvm_exits"] = kvm_profiler.stop()
+            if sampler:
+                series = sampler.stop()
+                series["guest_rates"] = netperf_base.sample_rates(
+                    series["guest"])
+                series["host_rates"] = netperf_base.sample_rates(
+                    series["host"])
+                ret["samples"] = series
             if get_status_flag:
                 end_state = get_state()
                 if len(start_state) != len(end_state):
@@ -889,9 +1016,15 @@ def launch_client(
                             end_state[i * 2 + 1] - start_state[i * 2 + 1]
                         )
 
-            client_thread.join()
+            wait_clients_exit()
 
             error_context.context("Testing Results Treatment and Report", test.log.info)
+            latency = netperf_base.parse_latency_result(finished_result)
+            if latency:
+                ret.update(netperf_base.summarize_latency(latency))
+                finished_result = "\n".join(
+                    line for line in finished_result.splitlines()
+                    if not re.match(r"\w+_LATENCY=", line))
             f = open(fname, "w")
             f.write(finished_result)
             f.close()
@@ -900,5 +1033,6 @@ def launch_client(
             break
         else:
             stop_netperf_clients()
+            wait_clients_exit()
             tries = tries - 1
             test.log.debug("left %s times", tries)
@@ -108,15 +108,18 @@ def run(test, params, env):
 
         firewalld.stop()
         vm_sess.cmd('systemctl stop firewalld')
+        throughput_args = network_base.get_throughput_check_args(params)
 
         network_base.check_throughput(
             vm_sess.cmd, lambda x: process.run(x).stdout_text,
-            vm_ip, throuput_bw if throuput_bw else inbound["average"], 'inbound'
+            vm_ip, throuput_bw if throuput_bw else inbound["average"], 'inbound',
+            **throughput_args
         )
 
         network_base.check_throughput(
             lambda x: process.run(x).stdout_text,
-            vm_sess.cmd,  host_ip, outbound["average"], 'outbound'
+            vm_sess.cmd,  host_ip, outbound["average"], 'outbound',
+            **throughput_args
         )
         vm_sess.close()
         vm.destroy()
@@ -106,15 +106,18 @@ def run(test, params, env):
         firewalld.stop()
         vm_sess.cmd('systemctl stop firewalld')
         vm_sess_2.cmd('systemctl stop firewalld')
+        throughput_args = network_base.get_throughput_check_args(params)
 
         network_base.check_throughput(
             vm_sess.cmd, vm_sess_2.cmd,
-            vm_ip, outbound["average"], 'outbound'
+            vm_ip, outbound["average"], 'outbound',
+            **throughput_args
         )
 
         network_base.check_throughput(
             vm_sess_2.cmd,
-            vm_sess.cmd,  vm_ip_2, inbound["average"], 'inbound'
+            vm_sess.cmd,  vm_ip_2, inbound["average"], 'inbound',
+            **throughput_args
         )
         vm_sess.close()
         vm_sess_2.close()
@@ -3,6 +3,7 @@ import logging
 from avocado.utils import process
 from virttest import utils_misc
 from virttest import utils_net
+from virttest import utils_package
 from virttest import virsh
 from virttest.libvirt_xml import vm_xml
 from virttest.libvirt_xml.network_xml import NetworkXML
@@ -33,6 +34,7 @@ def run(test, params, env):
     iface_attrs = eval(params.get('iface_attrs', '{}'))
     net_attrs = eval(params.get('net_attrs', '{}'))
     update_bw = eval(params.get('update_bw', '{}'))
+    check_actual_throughput = params.get_boolean('check_actual_throughput')
 
     vmxml = vm_xml.VMXML.new_from_inactive_dumpxml(vm_name)
     bkxml = vmxml.copy()
@@ -114,6 +116,25 @@ def run(test, params, env):
                 'Filter rule check after domiftune failed. Please check log.')
         LOG.debug('Filter rule check after domiftune: PASS')
 
+        if check_actual_throughput and iface_type != 'direct':
+            if not utils_package.package_install('netperf', session=session):
+                test.error('Failed to install netperf on VM.')
+            host_ip = utils_net.get_linux_iface_info(
+                iface=iface.source['bridge'])['addr_info'][0]['local']
+            vm_ip = network_base.get_vm_ip(session, mac)
+            session.cmd('systemctl stop firewalld', ignore_all_errors=True)
+            throughput_args = network_base.get_throughput_check_args(params)
+            network_base.check_throughput(
+                session.cmd, lambda x: process.run(x).stdout_text,
+                vm_ip, update_bw['inbound']['average'], 'inbound',
+                **throughput_args
+            )
+            network_base.check_throughput(
+                lambda x: process.run(x).stdout_text, session.cmd,
+                host_ip, update_bw['outbound']['average'], 'outbound',
+                **throughput_args
+            )
+
         virsh.domiftune(vm_name, tap_device, inbound='0',
                         outbound='0', **VIRSH_ARGS)
         iface_del_bw = network_base.get_iface_xml_inst(
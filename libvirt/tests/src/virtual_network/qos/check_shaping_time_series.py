@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from avocado.utils import process
+from virttest import utils_net
+from virttest import utils_package
+from virttest import virsh
+from virttest.libvirt_xml import vm_xml
+from virttest.utils_libvirt import libvirt_vmxml
+from virttest.utils_test import libvirt
+
+from provider.virtual_network import network_base
+
+VIRSH_ARGS = {'ignore_status': False, 'debug': True}
+
+LOG = logging.getLogger('avocado.' + __name__)
+
+
+def check_limits(phase, result, params):
+    """
+    Check the shaping metrics of a phase with the configured limits
+
+    :param phase: name of the phase
+    :param result: shaping metrics from analyze_shaping
+    :param params: test params
+    :return: list of failure messages
+    """
+    failures = []
+    checks = [('overshoot', params.get('max_overshoot')),
+              ('burst_ratio', params.get('max_burst_ratio')),
+              ('convergence_time', params.get('max_convergence_time'))]
+    for key, limit in checks:
+        if limit and result[key] is not None and result[key] > float(limit):
+            failures.append(f'{phase} {key} {result[key]:.3f} exceeds '
+                            f'{limit}')
+    if not result['converged']:
+        failures.append(f'{phase} rate {result["mean"]:.1f} KiB/s did not '
+                        f'converge to the average')
+    return failures
+
+
+def run(test, params, env):
+    """
+    Sample the throughput every 100 ms during a sustained stream to check
+    the overshoot, the burst size and the convergence time of the QoS
+    shaping, then change the limit with domiftune mid-stream and check how
+    long the new limit takes to apply.
+    """
+    vm_name = params.get('main_vm')
+    vm = env.get_vm(vm_name)
+    direction = params.get('direction', 'inbound')
+    iface_attrs = eval(params.get('iface_attrs'))
+    tune_bw = eval(params.get('tune_bw'))
+    stream_duration = int(params.get('stream_duration', 30))
+    tune_after = float(params.get('tune_after', 15))
+    interval = float(params.get('sample_interval', 0.1))
+    window = int(params.get('convergence_window', 10))
+    rel_tol = float(params.get('shaping_rel_tol', 0.1))
+    max_apply_time = params.get('max_apply_time')
+    bw = iface_attrs['bandwidth'][direction]
+
+    vmxml = vm_xml.VMXML.new_from_inactive_dumpxml(vm_name)
+    bkxml = vmxml.copy()
+
+    try:
+        vmxml.del_device('interface', by_tag=True)
+        libvirt_vmxml.modify_vm_device(vmxml, 'interface', iface_attrs)
+        vm.start()
+        session = vm.wait_for_serial_login()
+
+        iface = network_base.get_iface_xml_inst(vm_name, 'on vm')
+        mac = iface.mac_address
+        tap_device = libvirt.get_ifname_host(vm_name, mac)
+        source_br = iface.source['bridge']
+        LOG.debug(f'tap device on host with mac {mac} is: {tap_device}.')
+
+        if not utils_package.package_install('netperf', session=session):
+            test.error('Failed to install netperf on VM.')
+        if not utils_package.package_install('netperf'):
+            test.error('Failed to install netperf on host.')
+        session.cmd('systemctl stop firewalld', ignore_all_errors=True)
+        vm_ip = network_base.get_vm_ip(session, mac)
+        host_ip = utils_net.get_linux_iface_info(
+            iface=source_br)['addr_info'][0]['local']
+
+        # Inbound is shaped on the egress of the tap, outbound is policed
+        # on the ingress of the tap so count it after the policer
+        if direction == 'inbound':
+            session.cmd('netserver')
+            sampler = network_base.IfaceRateSampler(tap_device, 'tx_bytes',
+                                                    interval)
+            client_cmd = f'netperf -H {vm_ip} -l {stream_duration}'
+
+            def client_runner(cmd):
+                return process.run(cmd, shell=True).stdout_text
+        else:
+            process.run('netserver', shell=True)
+            sampler = network_base.IfaceRateSampler(source_br, 'rx_bytes',
+                                                    interval)
+            client_cmd = f'netperf -H {host_ip} -l {stream_duration}'
+
+            def client_runner(cmd):
+                return session.cmd_output(cmd, timeout=stream_duration + 60)
+
+        client_out = []
+        client = threading.Thread(
+            target=lambda: client_out.append(client_runner(client_cmd)))
+
+        test.log.info('TEST_STEP: Sample throughput of a sustained stream')
+        sampler.start()
+        time.sleep(1)
+        client.start()
+        time.sleep(tune_after)
+        tune_arg = f'{tune_bw["average"]},{tune_bw["peak"]},{tune_bw["burst"]}'
+        virsh.domiftune(vm_name, tap_device, **{direction: tune_arg},
+                        **VIRSH_ARGS)
+        tune_time = sampler.elapsed()
+        client.join()
+        time.sleep(1)
+        rates = sampler.stop()
+        if not client_out:
+            test.error('Netperf stream did not finish')
+        LOG.debug(client_out[0])
+
+        threshold = 0.05 * min(float(bw['average']),
+                               float(tune_bw['average']))
+        start, end = network_base.get_active_span(rates, threshold)
+        if tune_time >= end:
+            test.error(f'Stream ended at {end:.1f}s before the domiftune at '
+                       f'{tune_time:.1f}s')
+        initial = network_base.analyze_shaping(
+            network_base.slice_rates(rates, start, tune_time),
+            bw['average'], bw.get('peak'), bw.get('burst'), rel_tol, window)
+        tuned = network_base.analyze_shaping(
+            network_base.slice_rates(rates, tune_time, end),
+            tune_bw['average'], tune_bw.get('peak'), tune_bw.get('burst'),
+            rel_tol, window)
+        test.log.info(f'Initial shaping: {initial}')
+        test.log.info(f'Shaping after domiftune: {tuned}, new limit applied '
+                      f'in {tuned["convergence_time"]:.2f}s')
+
+        with open(os.path.join(test.resultsdir, 'shaping_time_series.json'),
+                  'w') as result_file:
+            json.dump({'direction': direction, 'interval': interval,
+                       'rates': rates, 'stream_start': start,
+                       'tune_time': tune_time, 'initial': initial,
+                       'tuned': tuned}, result_file, indent=2)
+
+        failures = check_limits('Initial', initial, params)
+        failures += check_limits('Tuned', tuned, params)
+        if max_apply_time and \
+                tuned['convergence_time'] > float(max_apply_time):
+            failures.append(f'New limit took {tuned["convergence_time"]:.2f}s'
+                            f' to apply, more than {max_apply_time}s')
+        if failures:
+            test.fail('\n'.join(failures))
+
+    finally:
+        process.run('pkill netserver', ignore_status=True)
+        if 'session' in locals():
+            session.close()
+        bkxml.sync()
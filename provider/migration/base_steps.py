@@ -1,3 +1,4 @@
+import json
 import os
 import platform
 import time
@@ -36,6 +37,10 @@ class MigrationBase(object):
     :param src_uri: source uri
     :param conn_list: connection object list
     :param remote_libvirtd_log: remote.RemoteFile object
+    :param job_sampler: MigrationJobSampler object if migration_job_sampler
+                        is enabled
+    :param heartbeat_receiver: HeartbeatReceiver object if
+                               check_guest_downtime is enabled
     """
 
     def __init__(self, test, vm, params):
@@ -53,6 +58,14 @@ class MigrationBase(object):
         self.check_cont_ping = "yes" == self.params.get("check_cont_ping", "no")
         self.check_cont_ping_log = self.params.get("check_cont_ping_log", "/tmp/log_file")
         self.remote_libvirtd_log = None
+        self.check_guest_downtime = "yes" == self.params.get("check_guest_downtime", "no")
+        self.heartbeat_receiver = None
+        self.dirty_workload_started = False
+        self.job_sampler = None
+        if self.params.get_boolean("migration_job_sampler"):
+            self.job_sampler = migration_base.MigrationJobSampler(
+                params.get("migrate_main_vm"),
+                float(self.params.get("migration_job_sample_interval", "1")))
 
         migration_test = migration.MigrationTest()
         migration_test.check_parameters(params)
@@ -104,6 +117,8 @@ class MigrationBase(object):
             vm_session = self.vm.wait_for_login()
             ping_cmd = "ping 8.8.8.8 > %s 2>&1 &" % self.check_cont_ping_log
             vm_session.sendline(ping_cmd)
+        if self.check_guest_downtime:
+            self.start_downtime_probe()
 
     def run_migration(self):
         """
@@ -181,15 +196,61 @@ class MigrationBase(object):
             self.migration_test.control_migrate_speed(vm_name, int(migrate_speed), mode)
         if stress_package:
             self.migration_test.run_stress_in_vm(self.vm, self.params)
+        if self.params.get("dirty_workload_rate") and not self.dirty_workload_started:
+            self.start_dirty_workload()
 
         # Execute migration process
         do_mig_param = {"vm": self.vm, "mig_test": self.migration_test, "src_uri": None,
                         "dest_uri": dest_uri, "options": options, "virsh_options": virsh_options,
                         "extra": extra, "action_during_mig": action_during_mig, "extra_args": extra_args}
-        migration_base.do_migration(**do_mig_param)
+        if self.job_sampler:
+            self.job_sampler.start()
+        try:
+            migration_base.do_migration(**do_mig_param)
+        finally:
+            if self.job_sampler:
+                self.job_sampler.stop()
+                self.job_sampler.save(os.path.join(self.test.outputdir,
+                                                   "migration_job_series.json"))
         if self.params.get_boolean("set_remote_libvirtd_log"):
             utils_sys.display_remote_log(self.params, self.test)
 
+    def start_dirty_workload(self):
+        """
+        Start the calibrated dirty workload in vm, and check the dirty rate
+        calculated by libvirt if required
+
+        """
+        rate = float(self.params.get("dirty_workload_rate"))
+        working_set = int(self.params.get("dirty_workload_size", "1024"))
+        pattern = self.params.get("dirty_workload_pattern", "sequential")
+        hot_size_ratio = float(self.params.get("dirty_workload_hot_size_ratio", "0.1"))
+        hot_write_ratio = float(self.params.get("dirty_workload_hot_write_ratio", "0.9"))
+        period = int(self.params.get("dirty_rate_calc_period", "1"))
+        tolerance = self.params.get("dirty_rate_tolerance")
+
+        self.test.log.debug("Start dirty workload in vm with %s MiB/s rate, "
+                            "%s MiB working set and %s pattern",
+                            rate, working_set, pattern)
+        vm_session = self.vm.wait_for_login()
+        migration_base.start_dirty_workload_in_vm(
+            vm_session, rate, working_set, pattern, hot_size_ratio,
+            hot_write_ratio)
+        vm_session.close()
+        self.dirty_workload_started = True
+        if not tolerance:
+            return
+        expected = migration_base.get_expected_dirty_rate(
+            rate, working_set, pattern, period, hot_size_ratio, hot_write_ratio)
+        actual = migration_base.get_dirty_rate(
+            self.vm.name, period, mode=self.params.get("dirty_rate_calc_mode"))
+        self.test.log.info("Dirty rate of vm: expected %.1f MiB/s, "
+                           "calculated %.1f MiB/s", expected, actual)
+        if abs(actual - expected) > expected * float(tolerance):
+            self.test.fail("Dirty rate %.1f MiB/s is out of %s tolerance of "
+                           "the expected %.1f MiB/s"
+                           % (actual, tolerance, expected))
+
     def run_migration_again(self):
         """
         Execute migration from source host to target host again
@@ -254,14 +315,11 @@ class MigrationBase(object):
         dest_uri = self.params.get("virsh_migrate_desturi")
         self.vm.connect_uri = dest_uri
         server_ip = self.params.get("server_ip")
-        server_user = self.params.get("server_user", "root")
         server_pwd = self.params.get("server_pwd")
 
         client_ip = self.params.get("client_ip")
         client_pwd = self.params.get("client_pwd")
-        runner_on_target = remote.RemoteRunner(host=server_ip,
-                                               username=server_user,
-                                               password=server_pwd)
+        runner_on_target = migration_base.CONNECTION_POOL.get_runner(self.params)
         ssh_connection = utils_conn.SSHConnection(server_ip=client_ip,
                                                   server_pwd=client_pwd,
                                                   client_ip=server_ip,
@@ -310,6 +368,57 @@ class MigrationBase(object):
             if check_on_dest:
                 self.vm.connect_uri = backup_uri
 
+    def start_downtime_probe(self):
+        """
+        Start the guest UDP heartbeat and the receiver on source host
+
+        """
+        port = self.params.get("heartbeat_port", "49999")
+        interval = self.params.get("heartbeat_interval", "0.001")
+        host_ip = self.params.get("heartbeat_host_ip",
+                                  self.params.get("migrate_source_host"))
+
+        self.test.log.debug("Starting heartbeat to %s:%s to measure guest downtime", host_ip, port)
+        utils_iptables.Firewall_cmd().add_port(port, 'udp')
+        # Record maxdowntime while the vm is still running on source
+        self.params["expected_max_downtime"] = self.params.get(
+            "expected_max_downtime",
+            virsh.migrate_getmaxdowntime(self.vm.name).stdout_text.strip())
+        self.heartbeat_receiver = migration_base.HeartbeatReceiver(port)
+        self.heartbeat_receiver.start()
+        vm_session = self.vm.wait_for_login()
+        migration_base.start_heartbeat_in_vm(vm_session, host_ip, port, interval)
+        vm_session.close()
+
+    def check_downtime_probe(self):
+        """
+        Check the guest visible downtime against maxdowntime
+
+        """
+        if not self.heartbeat_receiver:
+            return
+        # Wait for the heartbeats after the network recovers on target
+        time.sleep(int(self.params.get("heartbeat_settle_time", "3")))
+        self.heartbeat_receiver.stop()
+        result = self.heartbeat_receiver.analyze()
+        maxdowntime = self.params.get("expected_max_downtime")
+        downtime_tolerance = float(self.params.get("downtime_tolerance", "1.5"))
+        ret = virsh.domjobinfo(self.vm.name, extra="--completed", debug=True,
+                               ignore_status=True)
+        if not ret.exit_status:
+            result["libvirt_downtime"] = migration_base.parse_domjobinfo(
+                ret.stdout_text).get("Total downtime")
+        result["maxdowntime"] = maxdowntime
+        self.test.log.info("Guest pause: %s ms, network blackout: %s ms, "
+                           "libvirt downtime: %s ms, maxdowntime: %s ms",
+                           result["pause"], result["blackout"],
+                           result.get("libvirt_downtime"), maxdowntime)
+        with open(os.path.join(self.test.outputdir, "guest_downtime.json"), "w") as fd:
+            json.dump(result, fd, indent=2)
+        if maxdowntime and result["pause"] > float(maxdowntime) * downtime_tolerance:
+            self.test.fail("Guest pause %s ms exceeds maxdowntime %s ms (tolerance %s)"
+                           % (result["pause"], maxdowntime, downtime_tolerance))
+
     def verify_default(self):
         """
         Verify steps by default
@@ -325,6 +434,7 @@ class MigrationBase(object):
             self.migration_test.post_migration_check([self.vm], self.params,
                                                      dest_uri=dest_uri, src_uri=self.src_uri)
             self.check_vm_cont_ping(check_on_dest=True)
+            self.check_downtime_probe()
         self.check_local_and_remote_log()
 
     def cleanup_default(self):
@@ -338,6 +448,10 @@ class MigrationBase(object):
         set_remote_libvirtd_log = "yes" == self.params.get("set_remote_libvirtd_log", "no")
 
         self.test.log.debug("Recover test environment")
+        if self.heartbeat_receiver:
+            self.heartbeat_receiver.stop()
+            utils_iptables.Firewall_cmd().remove_port(
+                self.params.get("heartbeat_port", "49999"), 'udp')
         if set_remote_libvirtd_log and self.remote_libvirtd_log:
             del self.remote_libvirtd_log
         # Clean VM on destination and source
@@ -376,6 +490,7 @@ class MigrationBase(object):
 
         self.cleanup_default()
         migration_base.cleanup_conn_obj(self.conn_list, self.test)
+        migration_base.CONNECTION_POOL.close_all()
         if migrate_desturi_port:
             self.remote_add_or_remove_port(migrate_desturi_port, add=False)
             # Reload firewall on source host in case any changes were made
@@ -390,23 +505,18 @@ class MigrationBase(object):
         log_file = self.params.get("libvirtd_debug_file", "/var/log/libvirt/virtqemud.log")
         log_filters = self.params.get("libvirtd_debug_filters", "1:*")
         remote_file_type = self.params.get("remote_file_type", "virtqemud")
-        server_ip = self.params.get("server_ip", self.params.get("migrate_dest_host"))
-        server_user = self.params.get("server_user", "root")
-        server_pwd = self.params.get("server_pwd", self.params.get("migrate_dest_pwd"))
 
         self.test.log.debug(f"Start setting {remote_file_type} log on remote host")
         service_name = utils_libvirtd.Libvirtd(remote_file_type).service_name
         file_path = utils_config.get_conf_obj(service_name).conf_path
         self.test.log.debug("Config file path: %s" % file_path)
         cmd = "ls {0} || mkdir -p {0}".format(os.path.dirname(log_file))
-        remote.run_remote_cmd(cmd, self.params, ignore_status=False)
+        remote_runner = migration_base.CONNECTION_POOL.get_runner(self.params)
+        remote.run_remote_cmd(cmd, self.params, remote_runner, ignore_status=False)
         libvirtd_conf_dest = ('{".*log_level\s*=.*": "log_level = %s", '
                               '".*log_filters\s*=.*": \'log_filters="%s"\', '
                               '".*log_outputs\s*=.*": \'log_outputs="1:file:%s"\'}') % (log_level, log_filters, log_file)
         self.remote_libvirtd_log = libvirt_remote.update_remote_file(self.params, libvirtd_conf_dest, file_path)
-        remote_runner = remote.RemoteRunner(host=server_ip,
-                                            username=server_user,
-                                            password=server_pwd)
         utils_libvirtd.Libvirtd(remote_file_type, session=remote_runner.session).restart()
         self.params.update({
             "remote_session": remote_runner.session
@@ -439,12 +549,7 @@ class MigrationBase(object):
                 local_str_in_log = False
                 libvirt.check_logfile(check_log, log_file, str_in_log=local_str_in_log)
         if check_str_remote_log or check_no_str_remote_log:
-            server_ip = self.params.get("server_ip")
-            server_user = self.params.get("server_user", "root")
-            server_pwd = self.params.get("server_pwd")
-            runner_on_target = remote.RemoteRunner(host=server_ip,
-                                                   username=server_user,
-                                                   password=server_pwd)
+            runner_on_target = migration_base.CONNECTION_POOL.get_runner(self.params)
 
         if check_str_remote_log:
             for check_log in check_str_remote_log:
@@ -469,12 +574,7 @@ class MigrationBase(object):
         :param port: port
         :param add: True for add port, False for remove port
         """
-        server_ip = self.params.get("server_ip")
-        server_user = self.params.get("server_user")
-        server_pwd = self.params.get("server_pwd")
-        remote_session = remote.wait_for_login('ssh', server_ip, '22',
-                                               server_user, server_pwd,
-                                               r"[\#\$]\s*$")
+        remote_session = migration_base.CONNECTION_POOL.get_session(self.params)
         firewall_cmd = utils_iptables.Firewall_cmd(remote_session)
         if add:
             firewall_cmd.add_port(port, 'tcp', permanent=True)
@@ -482,7 +582,6 @@ class MigrationBase(object):
             firewall_cmd.remove_port(port, 'tcp', permanent=True)
         # Wait for 2 seconds to make the firewall take effect
         time.sleep(2)
-        remote_session.close()
 
 
 def setup_network_data_transport(params):
@@ -519,13 +618,7 @@ def prepare_disks_remote(params, vm):
     :param params: dict, get server ip, server user and server password
     :param vm: vm object
     """
-    server_ip = params.get("server_ip")
-    server_user = params.get("server_user")
-    server_pwd = params.get("server_pwd")
-
-    remote_session = remote.remote_login("ssh", server_ip, "22",
-                                         server_user, server_pwd,
-                                         r'[$#%]')
+    remote_session = migration_base.CONNECTION_POOL.get_session(params)
 
     all_vm_disks = vm.get_blk_devices()
     for disk in list(itervalues(all_vm_disks)):
@@ -538,7 +631,6 @@ def prepare_disks_remote(params, vm):
         libvirt_disk.create_disk(disk_type, path=disk_path,
                                  size=disk_size, disk_format=disk_format,
                                  session=remote_session)
-    remote_session.close()
 
 
 def cleanup_disks_remote(params, vm):
@@ -552,7 +644,9 @@ def cleanup_disks_remote(params, vm):
     for disk in list(itervalues(all_vm_disks)):
         disk_path = disk.get("source")
         cmd = "rm -f %s" % disk_path
-        remote.run_remote_cmd(cmd, params, ignore_status=False)
+        remote.run_remote_cmd(cmd, params,
+                              migration_base.CONNECTION_POOL.get_runner(params),
+                              ignore_status=False)
 
 
 def sync_cpu_for_mig(params):
@@ -600,11 +694,8 @@ def check_cpu_for_mig(params):
     with open(mig_src_xml, 'w+') as fd:
         fd.write(cpu_src_xml)
 
-    remote_session = remote.remote_login("ssh", remote_ip, "22",
-                                         remote_user, remote_pwd,
-                                         r'[$#%]')
+    remote_session = migration_base.CONNECTION_POOL.get_session(params)
     utils_misc.make_dirs(os.path.dirname(mig_src_xml), remote_session)
-    remote_session.close()
     remote.scp_to_remote(remote_ip, '22', remote_user, remote_pwd, mig_src_xml,
                          mig_src_xml, limit="", log_filename=None, timeout=60,
                          interface=None)
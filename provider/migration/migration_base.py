@@ -1,7 +1,13 @@
+import itertools
+import json
 import logging as log
+import math
 import types
 import re
 import signal                                        # pylint: disable=W0611
+import socket
+import struct
+import threading
 import time
 
 from avocado.core import exceptions
@@ -136,6 +142,1092 @@ def do_migration(**kwargs):
                               **extra_args)
 
 
+# Unit multipliers to MiB of the sizes in domjobinfo output
+SIZE_UNITS = {'B': 1.0 / 1024 / 1024, 'KiB': 1.0 / 1024, 'MiB': 1.0,
+              'GiB': 1024.0, 'TiB': 1024.0 * 1024}
+
+# Job info items of the telemetry series, name in series: domjobinfo key
+JOB_SERIES_ITEMS = {'time_elapsed': 'Time elapsed',
+                    'data_remaining': 'Data remaining',
+                    'memory_remaining': 'Memory remaining',
+                    'data_processed': 'Data processed',
+                    'throughput': 'Memory bandwidth',
+                    'dirty_rate': 'Dirty rate',
+                    'iteration': 'Iteration',
+                    'expected_downtime': 'Expected downtime',
+                    'downtime': 'Total downtime',
+                    'throttle': 'Auto converge throttle',
+                    'postcopy_requests': 'Postcopy requests'}
+
+
+def parse_domjobinfo(output):
+    """
+    Parse domjobinfo output to numeric values
+
+    Sizes are converted to MiB and bandwidths to MiB/s, time values are
+    in ms, other values keep their own units.
+
+    :param output: output of virsh domjobinfo
+    :return: dict, job info item and its value, 'Job type' and 'Operation'
+             are kept as str
+    """
+    jobinfo = {}
+    for line in output.splitlines():
+        if ':' not in line:
+            continue
+        key, value = [item.strip() for item in line.split(':', 1)]
+        fields = value.split()
+        if not fields:
+            continue
+        try:
+            number = float(fields[0])
+        except ValueError:
+            jobinfo[key] = value
+            continue
+        unit = fields[1].split('/')[0] if len(fields) > 1 else ''
+        jobinfo[key] = number * SIZE_UNITS.get(unit, 1.0)
+    return jobinfo
+
+
+class MigrationJobSampler(object):
+    """
+    Sample domjobinfo of a migration job at a fixed interval in the
+    background, to get the time series of the data remaining, dirty rate,
+    iteration, throughput and expected downtime of the migration.
+    """
+
+    def __init__(self, vm_name, interval=1.0, uri=None):
+        """
+        :param vm_name: vm name
+        :param interval: sampling interval in seconds
+        :param uri: uri of the host running the job, None for local
+        """
+        self.vm_name = vm_name
+        self.interval = interval
+        self.uri = uri
+        self.series = []
+        self.completed = {}
+        self.start_time = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop_event.is_set():
+            ret = virsh.domjobinfo(self.vm_name, uri=self.uri,
+                                   ignore_status=True)
+            if not ret.exit_status:
+                jobinfo = parse_domjobinfo(ret.stdout_text)
+                if jobinfo.get('Job type', 'None') not in ('None',
+                                                           'Completed'):
+                    sample = {'t': round(time.time() - self.start_time, 3)}
+                    for name, key in JOB_SERIES_ITEMS.items():
+                        if key in jobinfo:
+                            sample[name] = jobinfo[key]
+                    self.series.append(sample)
+            self._stop_event.wait(self.interval)
+
+    def start(self):
+        self.series = []
+        self.completed = {}
+        self._stop_event.clear()
+        self.start_time = time.time()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and get the info of the completed job
+
+        :return: list of the samples
+        """
+        self._stop_event.set()
+        self._thread.join()
+        ret = virsh.domjobinfo(self.vm_name, extra='--completed',
+                               uri=self.uri, ignore_status=True)
+        if not ret.exit_status:
+            self.completed = parse_domjobinfo(ret.stdout_text)
+        logging.debug("Sampled %d domjobinfo of %s", len(self.series),
+                      self.vm_name)
+        return self.series
+
+    def save(self, path):
+        """
+        Save the series and the completed job info as json
+
+        :param path: path of the json file
+        """
+        with open(path, 'w') as fd:
+            json.dump({'vm_name': self.vm_name, 'interval': self.interval,
+                       'series': self.series, 'completed': self.completed},
+                      fd, indent=2)
+        logging.info("Migration job series saved to %s", path)
+
+
+def get_host_cpu_ticks(params=None):
+    """
+    Get the busy and total cpu ticks of the local or remote host
+
+    :param params: dict with the remote host parameters, None for local
+    :return: tuple of busy ticks and total ticks
+    """
+    cmd = "head -n 1 /proc/stat"
+    if params:
+        output = remote.run_remote_cmd(cmd, params,
+                                       CONNECTION_POOL.get_runner(params),
+                                       ignore_status=False).stdout_text
+    else:
+        output = process.run(cmd, shell=True).stdout_text
+    fields = [int(field) for field in output.split()[1:]]
+    total = sum(fields[:8])
+    # idle and iowait are not busy
+    return total - fields[3] - fields[4], total
+
+
+def get_cpu_usage(start_ticks, end_ticks):
+    """
+    Get the cpu usage between two samples of get_host_cpu_ticks
+
+    :param start_ticks: ticks at the start
+    :param end_ticks: ticks at the end
+    :return: busy percentage of all cpus
+    """
+    total = end_ticks[1] - start_ticks[1]
+    busy = end_ticks[0] - start_ticks[0]
+    return round(busy * 100.0 / total, 2) if total else 0.0
+
+
+def build_mig_perf_matrix(params):
+    """
+    Build the migration performance configurations to sweep
+
+    The unsupported combinations are skipped: zerocopy needs parallel
+    connections without compression, multifd compression methods (zlib,
+    zstd) need parallel connections and the others can not be used with
+    parallel connections.
+
+    :param params: dict, get the lists of parallel connections, compression
+                   methods, zerocopy and bandwidth
+    :return: list of dict, the configurations
+    """
+    parallel_list = [int(n) for n in
+                     params.get("matrix_parallel_connections", "0").split()]
+    comp_list = params.get("matrix_comp_methods", "none").split()
+    zerocopy_list = params.get("matrix_zerocopy", "no").split()
+    bandwidth_list = [int(n) for n in
+                      params.get("matrix_bandwidth", "0").split()]
+    multifd_comp = ("zlib", "zstd")
+
+    matrix = []
+    for parallel, comp, zerocopy, bandwidth in itertools.product(
+            parallel_list, comp_list, zerocopy_list, bandwidth_list):
+        zerocopy = zerocopy == "yes"
+        if zerocopy and (not parallel or comp != "none"):
+            continue
+        if comp in multifd_comp and not parallel:
+            continue
+        if comp not in multifd_comp + ("none",) and parallel:
+            continue
+        matrix.append({"parallel_connections": parallel,
+                       "comp_method": comp,
+                       "zerocopy": zerocopy,
+                       "bandwidth": bandwidth})
+    return matrix
+
+
+def get_mig_perf_options(config):
+    """
+    Get virsh migrate options of a migration performance configuration
+
+    :param config: dict, one configuration from build_mig_perf_matrix
+    :return: str, virsh migrate options
+    """
+    options = []
+    if config["parallel_connections"]:
+        options.append("--parallel --parallel-connections %d"
+                       % config["parallel_connections"])
+    if config["comp_method"] != "none":
+        options.append("--compressed --comp-methods %s" % config["comp_method"])
+    if config["zerocopy"]:
+        options.append("--zerocopy")
+    if config["bandwidth"]:
+        options.append("--bandwidth %d" % config["bandwidth"])
+    return " ".join(options)
+
+
+def rank_mig_perf_results(results, rank_by):
+    """
+    Rank the migration performance results
+
+    :param results: list of dict, the results of the configurations
+    :param rank_by: list of result keys to sort by in ascending order, the
+                    failed migrations are ranked last
+    :return: list of dict, the ranked results
+    """
+    def _key(result):
+        return [not result["passed"]] + [
+            result.get(key) if result.get(key) is not None else float("inf")
+            for key in rank_by]
+
+    ranked = sorted(results, key=_key)
+    for index, result in enumerate(ranked):
+        result["rank"] = index + 1
+    return ranked
+
+
+# UDP heartbeat emitter run in the guest, each packet carries the sequence
+# number and the guest monotonic time
+HEARTBEAT_SCRIPT = """
+import socket, struct, sys, time
+dst = (sys.argv[1], int(sys.argv[2]))
+interval = float(sys.argv[3])
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+seq = 0
+next_time = time.monotonic()
+while True:
+    try:
+        sock.sendto(struct.pack('!Qd', seq, time.monotonic()), dst)
+    except OSError:
+        pass
+    seq += 1
+    next_time += interval
+    time.sleep(max(next_time - time.monotonic(), 0))
+"""
+
+HEARTBEAT_FORMAT = '!Qd'
+
+
+class HeartbeatReceiver(object):
+    """
+    Receive the UDP heartbeats from the guest on the host and measure the
+    guest visible downtime of a migration.
+
+    The largest gap between the arrivals of 2 consecutive heartbeats is the
+    network blackout. The guest monotonic clock does not advance while the
+    vm is paused, so the part of the gap not covered by the guest time
+    between the 2 heartbeats is the guest pause, the rest is spent with the
+    guest running but its packets lost.
+    """
+
+    def __init__(self, port, bind_ip='0.0.0.0'):
+        """
+        :param port: UDP port to listen on
+        :param bind_ip: address to listen on
+        """
+        self.port = int(port)
+        self.bind_ip = bind_ip
+        self.records = []
+        self._stop_event = threading.Event()
+        self._sock = None
+        self._thread = None
+
+    def _receive(self):
+        size = struct.calcsize(HEARTBEAT_FORMAT)
+        while not self._stop_event.is_set():
+            try:
+                data = self._sock.recv(size)
+            except socket.timeout:
+                continue
+            if len(data) == size:
+                seq, guest_time = struct.unpack(HEARTBEAT_FORMAT, data)
+                self.records.append((time.time(), seq, guest_time))
+
+    def start(self):
+        self.records = []
+        self._stop_event.clear()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((self.bind_ip, self.port))
+        self._sock.settimeout(0.5)
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._sock.close()
+            self._thread = None
+
+    def analyze(self):
+        """
+        Get the guest visible downtime from the received heartbeats
+
+        :return: dict, blackout and pause in ms, packets received and lost
+        """
+        if len(self.records) < 2:
+            raise exceptions.TestError("Received %d heartbeat from the guest"
+                                       % len(self.records))
+        gap, before, after = max(
+            (rec2[0] - rec1[0], rec1, rec2)
+            for rec1, rec2 in zip(self.records, self.records[1:]))
+        guest_gap = after[2] - before[2]
+        result = {"blackout": round(gap * 1000, 3),
+                  "pause": round(max(gap - guest_gap, 0) * 1000, 3),
+                  "lost_in_blackout": after[1] - before[1] - 1,
+                  "received": len(self.records),
+                  "lost": self.records[-1][1] + 1 - len(self.records)}
+        logging.debug("Guest visible downtime: %s", result)
+        return result
+
+
+def start_heartbeat_in_vm(session, host_ip, port, interval=0.001):
+    """
+    Start the UDP heartbeat emitter in the guest
+
+    :param session: vm session
+    :param host_ip: ip of the host running HeartbeatReceiver
+    :param port: UDP port of the receiver
+    :param interval: seconds between heartbeats
+    """
+    script = "/tmp/heartbeat.py"
+    session.cmd("cat > %s << 'EOF'%sEOF" % (script, HEARTBEAT_SCRIPT))
+    session.cmd("nohup python3 %s %s %s %s > /dev/null 2>&1 &"
+                % (script, host_ip, port, interval))
+
+
+DIRTY_WORKLOAD_SCRIPT = """
+import random, sys, time
+rate, working_set = float(sys.argv[1]), int(sys.argv[2])
+pattern = sys.argv[3]
+hot_size_ratio, hot_write_ratio = float(sys.argv[4]), float(sys.argv[5])
+page = 4096
+pages = working_set * 1024 * 1024 // page
+hot_pages = max(int(pages * hot_size_ratio), 1)
+buf = bytearray(pages * page)
+buf[::page] = bytes(pages)
+open(sys.argv[6], "w").close()
+tick = 0.01
+per_tick = rate * 1024 * 1024 / page * tick
+value = pos = 0
+budget = 0.0
+next_time = time.monotonic()
+while True:
+    budget += per_tick
+    count = int(budget)
+    budget -= count
+    value = (value + 1) % 256
+    if pattern == "sequential":
+        while count:
+            chunk = min(count, pages - pos)
+            buf[pos * page:(pos + chunk) * page:page] = bytes([value]) * chunk
+            pos = (pos + chunk) % pages
+            count -= chunk
+    else:
+        hot = 0
+        if pattern == "hot-set":
+            hot = sum(random.random() < hot_write_ratio for _ in range(count))
+        for _ in range(hot):
+            buf[random.randrange(hot_pages) * page] = value
+        low = hot_pages if pattern == "hot-set" and hot_pages < pages else 0
+        for _ in range(count - hot):
+            buf[random.randrange(low, pages) * page] = value
+    next_time += tick
+    delay = next_time - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    elif delay < -1:
+        next_time = time.monotonic()
+"""
+
+DIRTY_WORKLOAD_PATTERNS = ("sequential", "random", "hot-set")
+
+
+def start_dirty_workload_in_vm(session, rate, working_set, pattern="sequential",
+                               hot_size_ratio=0.1, hot_write_ratio=0.9):
+    """
+    Start a workload dirtying the guest memory at a given rate
+
+    :param session: vm session
+    :param rate: dirty rate in MiB/s
+    :param working_set: size of the memory to dirty in MiB
+    :param pattern: page access pattern, sequential, random or hot-set
+    :param hot_size_ratio: part of the working set being the hot set
+    :param hot_write_ratio: part of the writes going to the hot set
+    """
+    if pattern not in DIRTY_WORKLOAD_PATTERNS:
+        raise exceptions.TestError("Unknown dirty workload pattern %s, "
+                                   "supported: %s" % (pattern, DIRTY_WORKLOAD_PATTERNS))
+    script = "/tmp/dirty_workload.py"
+    ready_file = "/tmp/dirty_workload.ready"
+    session.cmd("cat > %s << 'EOF'%sEOF" % (script, DIRTY_WORKLOAD_SCRIPT))
+    session.cmd("rm -f %s" % ready_file)
+    session.cmd("nohup python3 %s %s %s %s %s %s %s > /dev/null 2>&1 &"
+                % (script, rate, working_set, pattern, hot_size_ratio,
+                   hot_write_ratio, ready_file))
+    # The script creates the ready file once the working set is allocated,
+    # so the dirty rate measured afterwards doesn't include the allocation
+    if not utils_misc.wait_for(
+            lambda: not session.cmd_status("test -f %s" % ready_file),
+            timeout=max(10, working_set // 100)):
+        raise exceptions.TestError("Failed to start the dirty workload in vm")
+
+
+def stop_dirty_workload_in_vm(session):
+    """
+    Stop the dirty workload in vm
+
+    :param session: vm session
+    """
+    session.cmd_status("pkill -f /tmp/dirty_workload.py; "
+                       "rm -f /tmp/dirty_workload.ready")
+
+
+def get_expected_dirty_rate(rate, working_set, pattern, period,
+                            hot_size_ratio=0.1, hot_write_ratio=0.9):
+    """
+    Get the dirty rate expected to be measured in a period for the workload
+
+    Pages written more than once in the period are counted once, so the
+    measured rate is lower than the written rate when the pages are
+    revisited, by the wrap around of a sequential pattern or by the
+    collisions of a random one.
+
+    :param rate: written rate in MiB/s
+    :param working_set: size of the memory to dirty in MiB
+    :param pattern: page access pattern, sequential, random or hot-set
+    :param period: seconds of the measurement
+    :param hot_size_ratio: part of the working set being the hot set
+    :param hot_write_ratio: part of the writes going to the hot set
+    :return: float, expected dirty rate in MiB/s
+    """
+    written = float(rate) * period
+
+    def _unique(size, writes):
+        return size * (1 - math.exp(-writes / size)) if size else 0
+
+    if pattern == "sequential":
+        dirtied = min(written, working_set)
+    elif pattern == "random":
+        dirtied = _unique(working_set, written)
+    else:
+        hot_size = working_set * hot_size_ratio
+        dirtied = (_unique(hot_size, written * hot_write_ratio) +
+                   _unique(working_set - hot_size, written * (1 - hot_write_ratio)))
+    return dirtied / period
+
+
+def get_dirty_rate(vm_name, period=1, uri=None, mode=None):
+    """
+    Calculate the dirty rate of a vm by domdirtyrate-calc
+
+    :param vm_name: vm name
+    :param period: seconds of the calculation
+    :param uri: uri of the host running the vm, None for local
+    :param mode: calculation mode, page-sampling, dirty-bitmap or dirty-ring,
+                 None for the default one
+    :return: float, dirty rate in MiB/s
+    """
+    options = "--seconds %s" % period
+    if mode:
+        options += " --mode %s" % mode
+    virsh.domdirtyrate_calc(vm_name, options=options, uri=uri,
+                            ignore_status=False, debug=True)
+
+    def _get_stats():
+        ret = virsh.domstats(vm_name, "--dirtyrate", uri=uri, debug=True)
+        stats = dict(item.strip().split("=", 1) for item in
+                     ret.stdout_text.strip().splitlines()[1:] if "=" in item)
+        # calc_status 2 means the calculation is completed
+        if stats.get("dirtyrate.calc_status") == "2":
+            return stats
+
+    time.sleep(int(period))
+    stats = utils_misc.wait_for(_get_stats, timeout=int(period) + 30, step=0.5)
+    if not stats:
+        raise exceptions.TestError("Failed to calculate dirty rate of %s" % vm_name)
+    return float(stats["dirtyrate.megabytes_per_second"])
+
+
+def measure_link_bandwidth(params, port=5201, duration=5):
+    """
+    Measure the bandwidth from the source host to the target host by iperf3
+
+    :param params: dict with the remote host parameters
+    :param port: iperf3 server port on the target host
+    :param duration: seconds of the measurement
+    :return: float, bandwidth in MiB/s
+    """
+    remote.run_remote_cmd("iperf3 -s -1 -D -p %s" % port, params,
+                          CONNECTION_POOL.get_runner(params),
+                          ignore_status=False)
+    server_ip = params.get("server_ip", params.get("migrate_dest_host"))
+    output = process.run("iperf3 -c %s -p %s -t %s -J" % (server_ip, port, duration),
+                         shell=True).stdout_text
+    bits = json.loads(output)["end"]["sum_received"]["bits_per_second"]
+    bandwidth = bits / 8.0 / 1024 / 1024
+    logging.debug("Link bandwidth to %s: %.1f MiB/s", server_ip, bandwidth)
+    return bandwidth
+
+
+def predict_migration(memory, dirty_rate, bandwidth, max_downtime,
+                      working_set=None, max_iterations=30):
+    """
+    Predict a precopy migration with a constant dirty rate and bandwidth
+
+    The first iteration sends the whole memory, each later one sends the
+    memory dirtied during the previous iteration, which is limited by the
+    working set, until the remaining memory can be sent within the max
+    downtime.
+
+    :param memory: memory to send in the first iteration, in MiB
+    :param dirty_rate: guest dirty rate in MiB/s
+    :param bandwidth: migration bandwidth in MiB/s
+    :param max_downtime: max downtime in ms
+    :param working_set: memory being dirtied in MiB, None for all the memory
+    :param max_iterations: iterations to give up the convergence after
+    :return: dict, convergence, iterations, total time and downtime in ms,
+             and transferred data in MiB
+    """
+    working_set = memory if working_set is None else working_set
+    remaining = float(memory)
+    transferred = elapsed = 0.0
+    iteration = 0
+    converged = False
+    while iteration < max_iterations:
+        iteration += 1
+        duration = remaining / bandwidth
+        transferred += remaining
+        elapsed += duration
+        remaining = min(dirty_rate * duration, working_set)
+        if remaining / bandwidth * 1000 <= max_downtime:
+            converged = True
+            break
+    downtime = remaining / bandwidth * 1000
+    return {"converged": converged, "iterations": iteration,
+            "total_time": round(elapsed * 1000 + downtime, 1),
+            "downtime": round(downtime, 1),
+            "transferred": round(transferred + remaining, 1)}
+
+
+def tune_migration(memory, dirty_rate, link_bandwidth, target_downtime,
+                   max_downtime_limit, working_set=None, max_total_time=None,
+                   bandwidth_ratios=(0.25, 0.5, 0.75, 1.0), max_iterations=30):
+    """
+    Choose the migration settings from the predicted migration
+
+    The lowest bandwidth converging within the target downtime and the max
+    total time is chosen to leave the link to other traffic. If no bandwidth converges, the
+    maxdowntime is raised up to the limit, and at last postcopy is used,
+    switching after the first iteration since the later ones do not
+    shrink the remaining memory.
+
+    :param memory: memory to send in the first iteration, in MiB
+    :param dirty_rate: guest dirty rate in MiB/s
+    :param link_bandwidth: link bandwidth in MiB/s
+    :param target_downtime: desired downtime in ms
+    :param max_downtime_limit: highest downtime in ms to accept
+    :param working_set: memory being dirtied in MiB, None for all the memory
+    :param max_total_time: highest total time in ms to accept, None for no limit
+    :param bandwidth_ratios: parts of the link bandwidth to try
+    :param max_iterations: iterations to give up the convergence after
+    :return: dict, the chosen 'bandwidth' in MiB/s, 'maxdowntime' in ms,
+             'postcopy_after_iteration' (0 for no postcopy) and the
+             'prediction' of the migration
+    """
+    for ratio in sorted(bandwidth_ratios):
+        bandwidth = max(int(link_bandwidth * ratio), 1)
+        prediction = predict_migration(memory, dirty_rate, bandwidth,
+                                       target_downtime, working_set,
+                                       max_iterations)
+        if prediction["converged"] and (
+                not max_total_time or prediction["total_time"] <= max_total_time):
+            return {"bandwidth": bandwidth, "maxdowntime": int(target_downtime),
+                    "postcopy_after_iteration": 0, "prediction": prediction}
+
+    bandwidth = max(int(link_bandwidth), 1)
+    working_set = memory if working_set is None else working_set
+    # The remaining memory stops shrinking at the dirtied working set
+    steady = min(working_set, dirty_rate * memory / bandwidth)
+    needed = int(math.ceil(steady / bandwidth * 1000))
+    if needed <= max_downtime_limit:
+        prediction = predict_migration(memory, dirty_rate, bandwidth, needed,
+                                       working_set, max_iterations)
+        if prediction["converged"]:
+            return {"bandwidth": bandwidth, "maxdowntime": needed,
+                    "postcopy_after_iteration": 0, "prediction": prediction}
+
+    first_pass = memory / float(bandwidth)
+    remaining = min(dirty_rate * first_pass, working_set)
+    prediction = {"converged": True, "iterations": 1,
+                  "total_time": round((first_pass + remaining / bandwidth) * 1000, 1),
+                  "downtime": None, "transferred": round(memory + remaining, 1)}
+    return {"bandwidth": bandwidth, "maxdowntime": int(target_downtime),
+            "postcopy_after_iteration": 1, "prediction": prediction}
+
+
+def switch_to_postcopy_after_iteration(vm_name, iteration, timeout=600):
+    """
+    Wait for the migration to reach the iteration and switch it to postcopy
+
+    :param vm_name: vm name
+    :param iteration: memory iteration to switch after, 0 to switch during
+                      the first pass over the memory
+    :param timeout: seconds to wait for the iteration
+    :return: True if switched to postcopy
+    """
+    def _reached():
+        ret = virsh.domjobinfo(vm_name, ignore_status=True)
+        if ret.exit_status:
+            return False
+        return parse_domjobinfo(ret.stdout_text).get("Iteration", 0) > iteration
+
+    if not utils_misc.wait_for(_reached, timeout=timeout, step=0.2):
+        logging.warning("Migration did not reach iteration %s", iteration)
+        return False
+    ret = virsh.migrate_postcopy(vm_name, debug=True, ignore_status=True)
+    return ret.exit_status == 0
+
+
+def get_prediction_error(prediction, completed):
+    """
+    Compare the predicted migration with the completed one
+
+    :param prediction: dict from predict_migration
+    :param completed: parsed domjobinfo --completed
+    :return: dict, predicted and actual values with the relative error
+    """
+    items = {"total_time": "Time elapsed", "downtime": "Total downtime",
+             "transferred": "Memory processed"}
+    error = {}
+    for name, key in items.items():
+        predicted = prediction.get(name)
+        actual = completed.get(key)
+        relative = None
+        if predicted is not None and actual:
+            relative = round(abs(predicted - actual) / actual, 3)
+        error[name] = {"predicted": predicted, "actual": actual,
+                       "error": relative}
+    return error
+
+
+TOUCH_WORKLOAD_SCRIPT = """
+import json, os, random, signal, sys, time
+working_set, duration = int(sys.argv[1]), float(sys.argv[2])
+threshold, output = int(sys.argv[3]) * 1000, sys.argv[4]
+write_ratio = float(sys.argv[5])
+page = 4096
+pages = working_set * 1024 * 1024 // page
+buf = bytearray(pages * page)
+buf[::page] = bytes([1]) * pages
+signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+touches = writes = 0
+slow = []
+clock = time.perf_counter_ns
+end = time.monotonic() + duration
+try:
+    while time.monotonic() < end:
+        index = random.randrange(pages) * page
+        if random.random() < write_ratio:
+            start = clock()
+            buf[index] = touches & 0xff
+            latency = clock() - start
+            writes += 1
+        else:
+            start = clock()
+            buf[index]
+            latency = clock() - start
+        touches += 1
+        if latency > threshold:
+            slow.append((round(time.time(), 3), latency // 1000))
+finally:
+    with open(output + '.tmp', 'w') as fd:
+        json.dump({'touches': touches, 'writes': writes,
+                   'threshold_us': threshold // 1000, 'slow': slow}, fd)
+    os.rename(output + '.tmp', output)
+"""
+
+TOUCH_WORKLOAD_OUTPUT = "/tmp/touch_latency.json"
+
+
+def start_touch_workload_in_vm(session, working_set, duration=600,
+                               threshold=50, write_ratio=0.2):
+    """
+    Start a workload touching random pages of the guest memory and timing
+    each touch, the touches slower than the threshold are recorded as faults
+
+    Part of the touches write the page, so the working set keeps being
+    dirtied during precopy and is left on the source for postcopy.
+
+    :param session: vm session
+    :param working_set: size of the memory to touch in MiB
+    :param duration: seconds to run the workload
+    :param threshold: latency in us to count a touch as a fault
+    :param write_ratio: part of the touches writing the page
+    """
+    script = "/tmp/touch_workload.py"
+    session.cmd("rm -f %s" % TOUCH_WORKLOAD_OUTPUT)
+    session.cmd("cat > %s << 'EOF'%sEOF" % (script, TOUCH_WORKLOAD_SCRIPT))
+    session.cmd("nohup python3 %s %s %s %s %s %s > /dev/null 2>&1 &"
+                % (script, working_set, duration, threshold,
+                   TOUCH_WORKLOAD_OUTPUT, write_ratio))
+
+
+def stop_touch_workload_in_vm(session, timeout=30):
+    """
+    Stop the touch workload in vm and get its records
+
+    :param session: vm session
+    :param timeout: seconds to wait for the records
+    :return: dict, the number of touches and the (guest wall clock time,
+             latency in us) of the slow touches
+    """
+    session.cmd_status("pkill -TERM -f /tmp/touch_workload.py")
+    if not utils_misc.wait_for(
+            lambda: not session.cmd_status("test -f %s" % TOUCH_WORKLOAD_OUTPUT),
+            timeout=timeout):
+        raise exceptions.TestError("Failed to get the touch workload records")
+    return json.loads(session.cmd_output("cat %s" % TOUCH_WORKLOAD_OUTPUT))
+
+
+def get_guest_clock_offset(session):
+    """
+    Get the offset of the guest wall clock to the host one
+
+    :param session: vm session
+    :return: guest time minus host time in seconds
+    """
+    before = time.time()
+    guest_time = float(session.cmd_output("date +%s.%N").strip())
+    after = time.time()
+    return guest_time - (before + after) / 2
+
+
+def analyze_fault_latency(records, percentiles=(50, 90, 99, 99.9),
+                          window=None, postcopy_requests=None):
+    """
+    Get the count and latency percentiles of the faults in the touch
+    workload records
+
+    :param records: dict from stop_touch_workload_in_vm
+    :param percentiles: percentiles to get
+    :param window: (start, end) guest time of the postcopy phase, only the
+                   slow touches inside it are counted as faults, None to
+                   count all of them
+    :param postcopy_requests: postcopy page requests of the migration job,
+                              to cross-check the number of faults
+    :return: dict, the number of touches and faults, the fault latency
+             percentiles and max in us
+    """
+    slow = records["slow"]
+    if window:
+        slow = [(stamp, latency) for stamp, latency in slow
+                if window[0] <= stamp <= window[1]]
+    latencies = sorted(latency for _, latency in slow)
+    result = {"touches": records["touches"],
+              "writes": records.get("writes", 0), "faults": len(latencies),
+              "outside_window": len(records["slow"]) - len(latencies),
+              "postcopy_requests": postcopy_requests,
+              "threshold_us": records["threshold_us"]}
+    # Every remote fault of the workload is a page request, so more faults
+    # than requests means slow touches of another cause
+    if postcopy_requests is not None and len(latencies) > postcopy_requests:
+        logging.warning("%s faults in the postcopy window are more than the "
+                        "%s postcopy requests", len(latencies),
+                        postcopy_requests)
+    for percentile in percentiles:
+        key = "p%s" % ("%g" % percentile).replace(".", "_")
+        if not latencies:
+            result[key] = None
+            continue
+        index = int(math.ceil(percentile / 100.0 * len(latencies))) - 1
+        result[key] = latencies[max(index, 0)]
+    result["max"] = latencies[-1] if latencies else None
+    return result
+
+
+class PostcopyPhaseTimer(object):
+    """
+    Switch a migration to postcopy after an iteration in the background,
+    and time the postcopy phase until the job leaves the source host.
+    """
+
+    def __init__(self, vm_name, iteration=1, timeout=600):
+        """
+        :param vm_name: vm name
+        :param iteration: memory iteration to switch after
+        :param timeout: seconds to wait for the switch and for the end
+        """
+        self.vm_name = vm_name
+        self.iteration = iteration
+        self.timeout = timeout
+        self.switched = False
+        self.switch_time = None
+        self.end_time = None
+        self._thread = None
+
+    def _job_ended(self):
+        ret = virsh.domjobinfo(self.vm_name, ignore_status=True)
+        if ret.exit_status:
+            return True
+        return parse_domjobinfo(ret.stdout_text).get(
+            "Job type", "None") in ("None", "Completed")
+
+    def _run(self):
+        self.switched = switch_to_postcopy_after_iteration(
+            self.vm_name, self.iteration, self.timeout)
+        if not self.switched:
+            return
+        self.switch_time = time.time()
+        utils_misc.wait_for(self._job_ended, timeout=self.timeout, step=0.1)
+        self.end_time = time.time()
+
+    def start(self):
+        self.switched = False
+        self.switch_time = self.end_time = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Wait for the timer to finish
+
+        :return: postcopy phase length in ms, None if not switched
+        """
+        self._thread.join()
+        if not (self.switch_time and self.end_time):
+            return None
+        return round((self.end_time - self.switch_time) * 1000, 1)
+
+
+class MigrationScheduler(object):
+    """
+    Migrate a list of vms to the target host with a limited number of
+    concurrent jobs, in the order of the given policy, sharing a total
+    bandwidth budget among the running jobs.
+    """
+
+    POLICIES = ("fifo", "largest_first", "dirtiest_first")
+
+    def __init__(self, vms, dest_uri, options="--live --verbose", extra="",
+                 concurrency=2, policy="fifo", bandwidth_budget=0,
+                 virsh_options=""):
+        """
+        :param vms: list of vm objects
+        :param dest_uri: target uri
+        :param options: virsh migrate options
+        :param extra: extra virsh migrate options
+        :param concurrency: max number of concurrent migrations
+        :param policy: order of the migrations, fifo, largest_first
+                       (by memory) or dirtiest_first (by dirty rate)
+        :param bandwidth_budget: total bandwidth in MiB/s shared by the
+                                 running migrations, 0 for unlimited
+        :param virsh_options: virsh options
+        """
+        if policy not in self.POLICIES:
+            raise exceptions.TestError("Unknown migration policy %s, "
+                                       "supported: %s" % (policy, self.POLICIES))
+        self.vms = vms
+        self.dest_uri = dest_uri
+        self.options = options
+        self.extra = extra
+        self.concurrency = max(int(concurrency), 1)
+        self.policy = policy
+        self.bandwidth_budget = int(bandwidth_budget)
+        self.virsh_options = virsh_options
+        self.results = {}
+
+    def order(self):
+        """
+        Sort the vms by the scheduling policy
+
+        :return: list of vm objects in migration order
+        """
+        if self.policy == "largest_first":
+            key = {vm.name: vm_xml.VMXML.new_from_dumpxml(vm.name).current_mem
+                   for vm in self.vms}
+        elif self.policy == "dirtiest_first":
+            key = {vm.name: get_dirty_rate(vm.name) for vm in self.vms}
+        else:
+            return list(self.vms)
+        logging.debug("Migration order key by %s: %s", self.policy, key)
+        return sorted(self.vms, key=lambda vm: key[vm.name], reverse=True)
+
+    def _share_bandwidth(self, active):
+        if not self.bandwidth_budget or not active:
+            return 0
+        share = max(self.bandwidth_budget // len(active), 1)
+        for vm_name in active:
+            virsh.migrate_setspeed(vm_name, share, debug=True)
+        return share
+
+    def _migrate(self, vm, bandwidth):
+        result = self.results[vm.name]
+        extra = self.extra
+        if bandwidth:
+            extra = "%s --bandwidth %d" % (extra, bandwidth)
+        result["start"] = time.time()
+        ret = virsh.migrate(vm.name, self.dest_uri, self.options, extra,
+                            virsh_opt=self.virsh_options, ignore_status=True,
+                            debug=True)
+        result["end"] = time.time()
+        result["status"] = ret.exit_status
+        if ret.exit_status:
+            result["error"] = ret.stderr_text.strip()
+
+    def run(self):
+        """
+        Run the migrations
+
+        :return: dict, the total evacuation time in seconds and the timing
+                 of each vm
+        """
+        pending = self.order()
+        self.results = {vm.name: {"order": index}
+                        for index, vm in enumerate(pending)}
+        threads = {}
+        start = time.time()
+        while pending or threads:
+            for vm_name in [name for name, thread in threads.items()
+                            if not thread.is_alive()]:
+                threads.pop(vm_name).join()
+                logging.info("Migration of %s finished with status %s",
+                             vm_name, self.results[vm_name]["status"])
+                # Give the freed bandwidth to the running migrations
+                if threads and not pending:
+                    self._share_bandwidth(list(threads))
+            while pending and len(threads) < self.concurrency:
+                vm = pending.pop(0)
+                running = min(self.concurrency, len(threads) + 1 + len(pending))
+                bandwidth = (max(self.bandwidth_budget // running, 1)
+                             if self.bandwidth_budget else 0)
+                logging.info("Start migration of %s with bandwidth %s",
+                             vm.name, bandwidth or "unlimited")
+                thread = threading.Thread(target=self._migrate,
+                                          args=(vm, bandwidth))
+                threads[vm.name] = thread
+                thread.start()
+            time.sleep(0.5)
+        end = time.time()
+
+        for result in self.results.values():
+            result["wait"] = round(result["start"] - start, 3)
+            result["duration"] = round(result["end"] - result["start"], 3)
+            result["start"] = round(result["start"] - start, 3)
+            result["end"] = round(result["end"] - start, 3)
+        summary = {"policy": self.policy, "concurrency": self.concurrency,
+                   "bandwidth_budget": self.bandwidth_budget,
+                   "total_time": round(end - start, 3), "vms": self.results}
+        logging.debug("Migration schedule result: %s", summary)
+        return summary
+
+
+class RemoteConnectionPool(object):
+    """
+    Keep the remote shell sessions and remote runners keyed by (host, user,
+    transport), so the test steps reuse them instead of logging in again.
+
+    A pooled entry is checked before being handed out and is replaced when
+    the check fails. The pooled sessions and runners are shared, the users
+    should not close them but call discard() if they break them on purpose.
+    The migration connection objects are not pooled, they are set up and
+    recovered by their owner.
+    """
+
+    SESSION_PROMPT = r'[$#%]'
+
+    def __init__(self):
+        self._sessions = {}
+        self._runners = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _get_key(params, transport):
+        host = params.get("server_ip", params.get("migrate_dest_host"))
+        user = params.get("server_user", "root")
+        return host, user, transport.lower()
+
+    @staticmethod
+    def _is_healthy(kind, obj):
+        try:
+            if kind == "session":
+                return obj.is_alive() and obj.cmd_status("true", timeout=10) == 0
+            return obj.run("true", ignore_status=True).exit_status == 0
+        except Exception as detail:
+            logging.debug("Pooled %s %s is not healthy: %s", kind, obj, detail)
+            return False
+
+    def _get(self, pool, kind, key, create):
+        with self._lock:
+            obj = pool.get(key)
+            if obj is not None and self._is_healthy(kind, obj):
+                logging.debug("Reuse pooled %s for %s", kind, key)
+                return obj
+            if obj is not None:
+                self._close(kind, obj)
+            logging.debug("Create pooled %s for %s", kind, key)
+            pool[key] = create()
+            return pool[key]
+
+    @staticmethod
+    def _close(kind, obj):
+        try:
+            if kind == "session":
+                obj.close()
+            elif kind == "runner":
+                obj.session.close()
+        except Exception as detail:
+            logging.debug("Failed to close pooled %s: %s", kind, detail)
+
+    def get_session(self, params):
+        """
+        Get a shell session on the remote host
+
+        :param params: dict, get server ip, server user and server password
+        :return: the shared remote session
+        """
+        def _create():
+            return remote.remote_login("ssh", key[0], "22", key[1],
+                                       params.get("server_pwd",
+                                                  params.get("migrate_dest_pwd")),
+                                       self.SESSION_PROMPT)
+
+        key = self._get_key(params, "ssh")
+        return self._get(self._sessions, "session", key, _create)
+
+    def get_runner(self, params):
+        """
+        Get a runner on the remote host
+
+        :param params: dict, get server ip, server user and server password
+        :return: the shared remote runner
+        """
+        def _create():
+            return remote.RemoteRunner(host=key[0], username=key[1],
+                                       password=params.get("server_pwd",
+                                                           params.get("migrate_dest_pwd")))
+
+        key = self._get_key(params, "ssh")
+        return self._get(self._runners, "runner", key, _create)
+
+    def discard(self, obj):
+        """
+        Remove an object from the pool without closing it
+
+        :param obj: pooled session or runner
+        :return: True if the object was pooled
+        """
+        with self._lock:
+            for pool in (self._sessions, self._runners):
+                for key, pooled in list(pool.items()):
+                    if pooled is obj:
+                        del pool[key]
+                        return True
+        return False
+
+    def close_all(self):
+        """
+        Close the pooled sessions and runners
+        """
+        with self._lock:
+            for kind, pool in (("session", self._sessions),
+                               ("runner", self._runners)):
+                for obj in pool.values():
+                    self._close(kind, obj)
+                pool.clear()
+
+
+CONNECTION_POOL = RemoteConnectionPool()
+
+
 def setup_conn_obj(conn_type, params, test):
     """
     Setup connection object, like TLS
@@ -721,7 +1813,8 @@ def check_NM(params, remote_host=False):
     """
     cmd = "rpm -q NetworkManager"
     if remote_host:
-        ret = remote.run_remote_cmd(cmd, params, ignore_status=False)
+        ret = remote.run_remote_cmd(cmd, params, CONNECTION_POOL.get_runner(params),
+                                    ignore_status=False)
     else:
         ret = process.run(cmd, ignore_status=False, shell=True)
     if ret.exit_status:
@@ -738,13 +1831,7 @@ def get_NM_service(params=None, remote_host=False):
     :return: NetworkManager service object
     """
     if remote_host:
-        server_ip = params.get("server_ip")
-        server_user = params.get("server_user", "root")
-        server_pwd = params.get("server_pwd")
-        remote_runner = remote.RemoteRunner(host=server_ip,
-                                            username=server_user,
-                                            password=server_pwd)
-        runner = remote_runner.run
+        runner = CONNECTION_POOL.get_runner(params).run
     else:
         runner = process.run
     return service.Factory.create_service("NetworkManager", run=runner)
@@ -1,5 +1,12 @@
+import hashlib
+import json
 import logging
 import os
+import re
+import statistics
+
+import aexpect
+from avocado.utils import crypto
 
 from virttest import data_dir, error_context, remote, utils_misc, utils_net, utils_netperf
 
@@ -11,22 +18,101 @@ def record_env_version(test, params, host, server_ctl, fd, test_duration):
     """
     Get host kernel/qemu/guest kernel version
 
+    :return: dict of the recorded versions, to be attached to json records
     """
     ver_cmd = params.get("ver_cmd", "rpm -q qemu-kvm")
     guest_ver_cmd = params.get("guest_ver_cmd", "uname -r")
     libvirt_ver_cmd = params.get("libvirt_ver_cmd", "rpm -q libvirt")
 
-    test.write_test_keyval({"kvm-userspace-ver": ssh_cmd(host, ver_cmd).strip()})
-    test.write_test_keyval(
-        {"guest-kernel-ver": ssh_cmd(server_ctl, guest_ver_cmd).strip()}
-    )
-    test.write_test_keyval({"libvirt-ver": ssh_cmd(host, libvirt_ver_cmd).strip()})
+    env_version = {
+        "kvm-userspace-ver": ssh_cmd(host, ver_cmd).strip(),
+        "guest-kernel-ver": ssh_cmd(server_ctl, guest_ver_cmd).strip(),
+        "libvirt-ver": ssh_cmd(host, libvirt_ver_cmd).strip(),
+    }
+    for key, value in env_version.items():
+        test.write_test_keyval({key: value})
     test.write_test_keyval({"session-length": test_duration})
-    fd.write("### kvm-userspace-ver : %s\n" % ssh_cmd(host, ver_cmd).strip())
-    fd.write("### guest-kernel-ver : %s\n" % ssh_cmd(server_ctl, guest_ver_cmd).strip())
-    fd.write("### libvirt-ver : %s\n" % ssh_cmd(host, libvirt_ver_cmd).strip())
-    fd.write("### kvm_version : %s\n" % os.uname()[2])
-    fd.write("### session-length : %s\n" % test_duration)
+    env_version["kvm_version"] = os.uname()[2]
+    env_version["session-length"] = test_duration
+    for key, value in env_version.items():
+        fd.write("### %s : %s\n" % (key, value))
+    return env_version
+
+
+def get_build_key(params, session, pkg):
+    """
+    Get the content address of netperf binaries built on the target, from
+    its arch, distro and compiler, the package and the build command
+
+    :param params: Dictionary with the test parameters.
+    :param session: a remote shell session or tag for localhost
+    :param pkg: path of netperf package
+    :return: hex digest string
+    """
+    target = ssh_cmd(
+        session, "uname -m; . /etc/os-release && echo $ID-$VERSION_ID; "
+        "cc --version | head -1", ignore_status=True)
+    digest = hashlib.sha256()
+    digest.update(target.strip().encode())
+    digest.update(params.get("setup_cmd", "").encode())
+    with open(pkg, "rb") as pkg_file:
+        digest.update(pkg_file.read())
+    return digest.hexdigest()[:16]
+
+
+def install_cached_netperf(params, session, ip, username, shell_port,
+                           password, pkg):
+    """
+    Install netperf binaries from the cache under the data dir, build and
+    add them to the cache when they are missing. The binaries are pushed
+    only when their md5 on the target differs from the cache.
+
+    :param params: Dictionary with the test parameters.
+    :param session: a remote shell session or tag for localhost
+    :param ip: ip of the target
+    :param username: username of the target
+    :param shell_port: shell port of the target
+    :param password: password of the target
+    :param pkg: path of netperf package
+    """
+    netperf_version = params.get("netperf_version", "2.6.0")
+    src_dir = "/tmp/netperf-%s/src" % netperf_version
+    binaries = ("netperf", "netserver")
+    cache_dir = os.path.join(data_dir.get_data_dir(), "netperf_cache",
+                             get_build_key(params, session, pkg))
+    md5_file = os.path.join(cache_dir, "md5sum")
+
+    if not os.path.exists(md5_file):
+        LOG_JOB.info("Build netperf on %s for cache %s", ip, cache_dir)
+        remote.scp_to_remote(ip, shell_port, username, password, pkg, "/tmp")
+        ssh_cmd(session, params.get("setup_cmd"))
+        tmp_dir = cache_dir + ".tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for binary in binaries:
+            remote.scp_from_remote(ip, shell_port, username, password,
+                                   "%s/%s" % (src_dir, binary), tmp_dir)
+        with open(os.path.join(tmp_dir, "md5sum"), "w") as md5_fd:
+            for binary in binaries:
+                md5_fd.write("%s  %s\n" % (crypto.hash_file(
+                    os.path.join(tmp_dir, binary), algorithm="md5"), binary))
+        os.rename(tmp_dir, cache_dir)
+        return
+
+    with open(md5_file) as md5_fd:
+        cached = {name: md5 for md5, name in
+                  (line.split() for line in md5_fd if line.strip())}
+    output = ssh_cmd(session, "cd %s && md5sum %s" % (src_dir,
+                     " ".join(binaries)), ignore_status=True)
+    target = {name: md5 for md5, name in
+              re.findall(r"^([0-9a-f]{32})\s+(\S+)$", output, re.M)}
+    ssh_cmd(session, "mkdir -p %s" % src_dir)
+    for binary in binaries:
+        if target.get(binary) == cached[binary]:
+            continue
+        LOG_JOB.info("Push cached %s to %s", binary, ip)
+        remote.scp_to_remote(ip, shell_port, username, password,
+                             os.path.join(cache_dir, binary), src_dir)
+    ssh_cmd(session, "chmod +x %s/netperf %s/netserver" % (src_dir, src_dir))
 
 
 def env_setup(test, params, session, ip, username, shell_port, password):
@@ -40,8 +126,12 @@ def env_setup(test, params, session, ip, username, shell_port, password):
 
     pkg = params["netperf_pkg"]
     pkg = os.path.join(data_dir.get_deps_dir(), pkg)
-    remote.scp_to_remote(ip, shell_port, username, password, pkg, "/tmp")
-    ssh_cmd(session, params.get("setup_cmd"))
+    if params.get("netperf_cache", "no") == "yes":
+        install_cached_netperf(params, session, ip, username, shell_port,
+                               password, pkg)
+    else:
+        remote.scp_to_remote(ip, shell_port, username, password, pkg, "/tmp")
+        ssh_cmd(session, params.get("setup_cmd"))
 
     agent_path = os.path.join(test.virtdir, "scripts/netperf_agent.py")
     remote.scp_to_remote(ip, shell_port, username, password, agent_path, "/tmp")
@@ -87,21 +177,486 @@ def ssh_cmd(session, cmd, timeout=120, ignore_status=False):
     return output
 
 
-def netperf_thread(params, numa_enable, client_s, option, fname):
+def numa_prefix(params, numa_enable):
     """
-    Start netperf thread on client
+    Get the numactl prefix to bind the netperf client to the numa node
 
+    :param params: Dictionary with the test parameters.
+    :param numa_enable: whether to bind the client
+    :return: command prefix string, empty if not bound
     """
-    cmd = ""
     if numa_enable and params.get("numa_node") is not None:
         n = abs(int(params.get("numa_node"))) - 1
-        cmd += "numactl --cpunodebind=%s --membind=%s " % (n, n)
+        return "numactl --cpunodebind=%s --membind=%s " % (n, n)
+    return ""
+
+
+def netperf_thread(params, numa_enable, client_s, option, fname):
+    """
+    Start netperf thread on client
+
+    """
+    cmd = numa_prefix(params, numa_enable)
     cmd += option
     cmd += " >> %s" % fname
     LOG_JOB.info("Start netperf thread by cmd '%s'", cmd)
     ssh_cmd(client_s, cmd)
 
 
+NETPERF_CLIENT_AGENT = """
+import subprocess, sys, threading
+lock = threading.Lock()
+
+
+def pump(proc, out):
+    for line in proc.stdout:
+        with lock:
+            out.write(line)
+            out.flush()
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+
+def run_job(sessions, fname, cmd):
+    with open(fname, "a") as out:
+        procs = [subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT,
+                                  universal_newlines=True)
+                 for _ in range(sessions)]
+        pumps = [threading.Thread(target=pump, args=(proc, out))
+                 for proc in procs]
+        for thread in pumps:
+            thread.start()
+        for thread in pumps:
+            thread.join()
+        for proc in procs:
+            proc.wait()
+    with lock:
+        sys.stdout.write("#AGENT_DONE\\n")
+        sys.stdout.flush()
+
+
+for line in iter(sys.stdin.readline, ""):
+    fields = line.split(None, 3)
+    if fields and fields[0] == "EXIT":
+        break
+    if len(fields) == 4 and fields[0] == "RUN":
+        threading.Thread(target=run_job, args=(int(fields[1]), fields[2],
+                                               fields[3].strip())).start()
+"""
+
+AGENT_DONE = "#AGENT_DONE"
+
+
+class NetperfResultStream(object):
+    """
+    Follow the netperf agent result file over one resident shell, so the
+    interim results are streamed back instead of re-reading the whole file
+    with a new command for every poll.
+
+    With start_agent(), the shell runs a long-lived client agent instead:
+    the netperf sessions of every cell are launched by a command line sent
+    to the agent, and their output comes back on the same channel, so no
+    new shell command or python process is needed per cell.
+    """
+
+    def __init__(self, session):
+        """
+        :param session: a dedicated shell session on the netperf client
+        """
+        self.session = session
+        self.content = ""
+        self.agent = False
+        self._following = False
+
+    def start_agent(self, path="/tmp/netperf_client_agent.py"):
+        """
+        Start the long-lived client agent in the resident shell
+
+        :param path: path of the agent script on the client
+        """
+        self.stop()
+        self.session.cmd("cat > %s << 'EOF'%sEOF" % (path, NETPERF_CLIENT_AGENT))
+        self.session.sendline("`command -v python3 python | head -1` %s" % path)
+        self.agent = True
+
+    def run(self, fname, sessions, cmd):
+        """
+        Launch the netperf sessions of one cell by the agent
+
+        :param fname: result file name on the client, the output of the
+                      sessions is appended to it as well
+        :param sessions: number of concurrent netperf sessions
+        :param cmd: netperf command line of one session
+        """
+        self.content = ""
+        self.session.sendline("RUN %d %s %s" % (sessions, fname, cmd))
+
+    def wait_done(self, timeout):
+        """
+        Wait for all the sessions of the cell launched by run() to exit
+
+        :param timeout: timeout in seconds
+        :return: True if they exited in time
+        """
+        return bool(utils_misc.wait_for(
+            lambda: AGENT_DONE in self.read(), timeout, 0.0, 0.5))
+
+    def follow(self, fname):
+        """
+        Start following a new result file, drop the content of the last one
+
+        :param fname: result file name on the client
+        """
+        self.stop()
+        self.content = ""
+        self.session.sendline("tail -n +1 -F %s 2>/dev/null" % fname)
+        self._following = True
+
+    def read(self, timeout=0.2):
+        """
+        Read the streamed content which is available now
+
+        :param timeout: how long to wait for new data
+        :return: all the content streamed since follow()
+        """
+        self.content += self.session.read_nonblocking(0.05, timeout)
+        return self.content
+
+    def stop(self):
+        """Stop following the current result file"""
+        if self._following:
+            self.session.sendcontrol("c")
+            self.session.read_nonblocking(0.05, 1)
+            self._following = False
+
+    def close(self):
+        self.stop()
+        if self.agent:
+            self.session.sendline("EXIT")
+            self.agent = False
+        self.session.close()
+
+
+def open_result_stream(params, client):
+    """
+    Open a resident result stream on the netperf client
+
+    :param params: Dictionary with the test parameters.
+    :param client: "localhost" or the client ip for data connection
+    :return: NetperfResultStream object
+    """
+    if client == "localhost":
+        session = aexpect.ShellSession("bash")
+    else:
+        session = remote.wait_for_login(
+            params.get("shell_client_client"),
+            params.get("client_public_ip", client),
+            params.get("shell_port_client"),
+            params.get("username_client"),
+            params.get("password_client"),
+            params.get("shell_prompt_client"),
+        )
+    return NetperfResultStream(session)
+
+
+def guest_state_cmd(ifname):
+    """
+    Get the command to take one snapshot of the guest network counters:
+    the iface statistics, Tcp line of /proc/net/snmp and virtio interrupts
+
+    :param ifname: guest interface name of the data connection
+    :return: command string, it doesn't include single quotes
+    """
+    stat = "/sys/class/net/%s/statistics" % ifname
+    return (
+        'echo "#stamp" $(date +%%s.%%N); '
+        'echo "#stat" $(cat %s/rx_packets %s/tx_packets '
+        '%s/rx_bytes %s/tx_bytes); '
+        'echo "#snmp" $(grep Tcp: /proc/net/snmp | tail -1); '
+        'grep virtio /proc/interrupts | sed "s/^/#intr /"; '
+        'echo "#end"' % (stat, stat, stat, stat)
+    )
+
+
+def host_state_cmd():
+    """
+    Get the command to take one snapshot of the host kvm exits counter
+
+    :return: command string, it doesn't include single quotes
+    """
+    return ('echo "#stamp" $(date +%s.%N); '
+            'echo "#exits" $(cat /sys/kernel/debug/kvm/exits); '
+            'echo "#end"')
+
+
+def parse_state_samples(output):
+    """
+    Parse the snapshots taken by guest_state_cmd/host_state_cmd
+
+    :param output: output of one or several snapshots
+    :return: list of sample dicts
+    """
+    samples = []
+    sample = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if not fields or not fields[0].startswith("#"):
+            continue
+        tag = fields[0]
+        if tag == "#stamp":
+            sample = {"stamp": float(fields[1]),
+                      "rx_intr": [], "tx_intr": [], "intr": 0}
+        elif tag == "#stat":
+            for key, value in zip(("rx_pkts", "tx_pkts", "rx_byts",
+                                   "tx_byts"), fields[1:5]):
+                sample[key] = int(value)
+        elif tag == "#snmp":
+            # RetransSegs of the Tcp line
+            sample["re_pkts"] = int(fields[13])
+        elif tag == "#intr":
+            count = 0
+            for value in fields[2:]:
+                if not value.isdigit():
+                    break
+                count += int(value)
+            if re.search(r"virtio\d+-input", line):
+                sample["rx_intr"].append(count)
+            elif re.search(r"virtio\d+-output", line):
+                sample["tx_intr"].append(count)
+            else:
+                sample["intr"] += count
+        elif tag == "#exits":
+            sample["exits"] = int(fields[1])
+        elif tag == "#end" and sample:
+            samples.append(sample)
+            sample = {}
+    return samples
+
+
+def state_to_list(sample, exits):
+    """
+    Convert a guest sample to the state list used by netperf test
+
+    :param sample: guest sample dict from parse_state_samples
+    :param exits: host kvm exits counter
+    :return: list of alternating names and values
+    """
+    state_list = []
+    for key in ("rx_pkts", "tx_pkts", "rx_byts", "tx_byts", "re_pkts"):
+        state_list.extend([key, sample[key]])
+    if sample["rx_intr"]:
+        for direction in ("rx", "tx"):
+            intr = sample["%s_intr" % direction]
+            for i, count in enumerate(intr):
+                state_list.extend(["%s_intr_%s" % (direction, i), count])
+            state_list.extend(["%s_intr_sum" % direction, sum(intr)])
+    else:
+        state_list.extend(["intr", sample["intr"]])
+    state_list.extend(["exits", exits])
+    return state_list
+
+
+def sample_rates(samples):
+    """
+    Compute the per second rates between consecutive samples
+
+    :param samples: list of sample dicts from parse_state_samples
+    :return: list of rate dicts, the stamp is the end of each interval
+    """
+    rates = []
+    for prev, cur in zip(samples, samples[1:]):
+        interval = cur["stamp"] - prev["stamp"]
+        if interval <= 0:
+            continue
+        rate = {"stamp": cur["stamp"]}
+        for key, value in cur.items():
+            if key == "stamp" or key not in prev:
+                continue
+            if isinstance(value, list):
+                if len(value) == len(prev[key]):
+                    rate[key] = [(c - p) / interval
+                                 for c, p in zip(value, prev[key])]
+            else:
+                rate[key] = (value - prev[key]) / interval
+        rates.append(rate)
+    return rates
+
+
+class StateSampler(object):
+    """
+    Sample the guest network counters and the host kvm exits periodically.
+
+    The sampling loops run as background agents on guest and host, so every
+    sample is one consistent snapshot and no round trip is needed until the
+    series are collected.
+    """
+
+    def __init__(self, server_ctl, host, ifname, interval=1,
+                 path="/tmp/netperf_state"):
+        """
+        :param server_ctl: session to control netperf server
+        :param host: host session or "localhost"
+        :param ifname: guest interface name of the data connection
+        :param interval: sample interval in seconds
+        :param path: prefix of the sample files on guest and host
+        """
+        self.agents = [(server_ctl, guest_state_cmd(ifname),
+                        "%s.guest" % path),
+                       (host, host_state_cmd(), "%s.host" % path)]
+        self.interval = interval
+        self.pids = []
+
+    def start(self):
+        self.pids = []
+        for session, cmd, fname in self.agents:
+            loop = "while true; do %s; sleep %s; done" % (cmd, self.interval)
+            output = ssh_cmd(session, "nohup sh -c '%s' > %s 2>&1 & echo $!"
+                             % (loop, fname))
+            self.pids.append(output.strip().split()[-1])
+
+    def stop(self):
+        """
+        Stop the agents and collect the samples
+
+        :return: dict of guest and host sample lists
+        """
+        series = {}
+        for (session, _, fname), pid, name in zip(self.agents, self.pids,
+                                                  ("guest", "host")):
+            ssh_cmd(session, "kill %s" % pid, ignore_status=True)
+            series[name] = parse_state_samples(
+                ssh_cmd(session, "cat %s; rm -f %s" % (fname, fname),
+                        ignore_status=True))
+        self.pids = []
+        return series
+
+
+def parse_kvm_stat_report(output):
+    """
+    Parse the output of 'perf kvm stat report'
+
+    :param output: output of perf kvm stat report
+    :return: dict of exit reason and its samples/time percentage
+    """
+    exits = {}
+    pattern = re.compile(r"^\s*(\S+)\s+(\d+)\s+([\d.]+)%\s+([\d.]+)%")
+    for line in output.splitlines():
+        match = pattern.match(line)
+        if match:
+            reason, samples, samples_pct, time_pct = match.groups()
+            exits[reason] = {"samples": int(samples),
+                             "samples_pct": float(samples_pct),
+                             "time_pct": float(time_pct)}
+    return exits
+
+
+class KvmExitProfiler(object):
+    """
+    Record the kvm exits of a guest with 'perf kvm stat' on the host, and
+    break them down by exit reason and by vcpu.
+    """
+
+    def __init__(self, host, qemu_pid, vcpus=0,
+                 path="/tmp/netperf_kvm_stat.data"):
+        """
+        :param host: host session or "localhost"
+        :param qemu_pid: pid of the qemu process of the guest
+        :param vcpus: number of vcpus to report one by one
+        :param path: perf data file on the host
+        """
+        self.host = host
+        self.qemu_pid = qemu_pid
+        self.vcpus = vcpus
+        self.path = path
+        self.pid = None
+
+    def start(self):
+        cmd = ("nohup perf kvm stat record -p %s -o %s > /dev/null 2>&1 & "
+               "echo $!" % (self.qemu_pid, self.path))
+        self.pid = ssh_cmd(self.host, cmd).strip().split()[-1]
+
+    def stop(self):
+        """
+        Stop recording and report the exits
+
+        :return: dict with the breakdown of all vcpus and of each vcpu
+        """
+        ssh_cmd(self.host, "kill -INT %s; while kill -0 %s 2>/dev/null; "
+                "do sleep 0.1; done" % (self.pid, self.pid),
+                ignore_status=True)
+        self.pid = None
+        report_cmd = ("perf kvm stat report -i %s --event=vmexit "
+                      "--key=sample 2>/dev/null" % self.path)
+        breakdown = {"all": parse_kvm_stat_report(
+            ssh_cmd(self.host, report_cmd, ignore_status=True))}
+        for vcpu in range(self.vcpus):
+            breakdown["vcpu%s" % vcpu] = parse_kvm_stat_report(
+                ssh_cmd(self.host, "%s --vcpu=%s" % (report_cmd, vcpu),
+                        ignore_status=True))
+        ssh_cmd(self.host, "rm -f %s" % self.path, ignore_status=True)
+        return breakdown
+
+
+LATENCY_SELECTORS = ("P50_LATENCY", "P90_LATENCY", "P99_LATENCY",
+                     "MAX_LATENCY", "MEAN_LATENCY", "STDDEV_LATENCY")
+
+
+def latency_args():
+    """
+    Get the netperf arguments to output latency statistics, the global
+    option -j is needed to keep the latency histogram
+
+    :return: tuple of global and test-specific arguments
+    """
+    return "-j", "-k %s" % ",".join(LATENCY_SELECTORS)
+
+
+def parse_latency_result(content):
+    """
+    Parse the latency keyvals of every netperf session
+
+    :param content: content of the result file
+    :return: list of dicts, one per session
+    """
+    results = []
+    current = {}
+    for key, value in re.findall(r"^(\w+_LATENCY)=([\d.]+)\s*$",
+                                 content, re.M):
+        if key in current:
+            results.append(current)
+            current = {}
+        current[key] = float(value)
+    if current:
+        results.append(current)
+    return results
+
+
+def summarize_latency(results):
+    """
+    Summarize the latency of all sessions, the percentiles and mean are
+    averaged over the sessions and the worst p99/max is kept as well
+
+    :param results: list of dicts from parse_latency_result
+    :return: dict of latency keys recorded in the netperf results (us)
+    """
+    summary = {}
+    keys = {"P50_LATENCY": "p50_lat", "P90_LATENCY": "p90_lat",
+            "P99_LATENCY": "p99_lat", "MEAN_LATENCY": "mean_lat",
+            "STDDEV_LATENCY": "stddev_lat"}
+    for selector, key in keys.items():
+        values = [r[selector] for r in results if selector in r]
+        if values:
+            summary[key] = statistics.mean(values)
+    worst_p99 = [r["P99_LATENCY"] for r in results if "P99_LATENCY" in r]
+    if worst_p99:
+        summary["worst_p99_lat"] = max(worst_p99)
+    max_lat = [r["MAX_LATENCY"] for r in results if "MAX_LATENCY" in r]
+    if max_lat:
+        summary["max_lat"] = max(max_lat)
+    return summary
+
+
 def format_result(result, base="17", fbase="2"):
     """
     Format the result to a fixed length string.
@@ -149,6 +704,113 @@ def netperf_record(results, filter_list, header=False, base="17", fbase="2"):
     return record, key_list
 
 
+def netperf_record_json(fd, results, filter_list, **extra):
+    """
+    Record the results as one typed json line.
+
+    :param fd: opened file object of the json lines result file
+    :param results: a dict include the results for the variables
+    :param filter_list: variable list which is wanted to be recorded
+    :param extra: extra fields for the record, e.g. protocol or env versions
+    :return: the recorded dict
+    """
+    record = dict(extra)
+    for key in filter_list:
+        if key in results:
+            record[key] = results[key]
+    fd.write(json.dumps(record, sort_keys=True) + "\n")
+    fd.flush()
+    return record
+
+
+def load_json_records(path):
+    """
+    Load the records from json lines result file(s).
+
+    :param path: result file, or a directory which includes
+                 netperf-result.*.jsonl files of several runs
+    :return: list of record dicts
+    """
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(path, f) for f in os.listdir(path)
+            if f.startswith("netperf-result.") and f.endswith(".jsonl")
+        )
+    else:
+        files = [path]
+    records = []
+    for fname in files:
+        with open(fname) as fd:
+            records.extend(json.loads(line) for line in fd if line.strip())
+    return records
+
+
+def compare_with_baseline(records, baseline, metrics=None, tolerance=0.05,
+                          z_threshold=2.0):
+    """
+    Compare the records with baseline records and find the regressions.
+
+    Records are matched by (protocol, size, sessions). When the baseline
+    includes several runs of a cell, the regression needs to be beyond
+    z_threshold standard deviations of the baseline samples as well as
+    beyond the relative tolerance, otherwise only the tolerance is used.
+
+    :param records: list of record dicts of the current run
+    :param baseline: list of record dicts of the baseline run(s)
+    :param metrics: dict of metric name and its better direction,
+                    "higher" or "lower"
+    :param tolerance: allowed relative change against baseline mean
+    :param z_threshold: the z score of a significant change
+    :return: list of regression dicts
+    """
+    if metrics is None:
+        metrics = {"throughput": "higher", "trans.rate": "higher",
+                   "thr_per_CPU": "higher", "CPU": "lower",
+                   "p99_lat": "lower"}
+
+    def _key(record):
+        return (record.get("protocol"), record.get("size"),
+                record.get("sessions"))
+
+    samples = {}
+    for record in baseline:
+        for metric in metrics:
+            if record.get(metric) is not None:
+                samples.setdefault((_key(record), metric), []).append(
+                    float(record[metric]))
+
+    regressions = []
+    for record in records:
+        for metric, better in metrics.items():
+            base_values = samples.get((_key(record), metric))
+            if record.get(metric) is None or not base_values:
+                continue
+            value = float(record[metric])
+            mean = statistics.mean(base_values)
+            if not mean:
+                continue
+            change = (value - mean) / mean
+            if better == "lower":
+                change = -change
+            if change >= -tolerance:
+                continue
+            z_score = None
+            if len(base_values) > 1:
+                stdev = statistics.stdev(base_values)
+                if stdev:
+                    z_score = abs(value - mean) / stdev
+                    if z_score < z_threshold:
+                        continue
+            protocol, size, sessions = _key(record)
+            regressions.append({
+                "protocol": protocol, "size": size, "sessions": sessions,
+                "metric": metric, "value": value, "baseline_mean": mean,
+                "baseline_samples": len(base_values),
+                "change": change, "z_score": z_score,
+            })
+    return regressions
+
+
 def compile_netperf_pkg(params, env, address):
     """
     Prepare and compile netperf binaries on the target system
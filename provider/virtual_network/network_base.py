@@ -1,8 +1,12 @@
+import glob
+import json
 import logging
 import math
 import os
 import re
 import shutil
+import statistics
+import threading
 import time
 
 import aexpect
@@ -15,6 +19,7 @@ from virttest import utils_misc
 from virttest import utils_net
 from virttest import utils_package
 from virttest import virsh
+from virttest.cpu import cpus_parser
 from virttest.utils_libvirt import libvirt_vmxml
 from virttest.libvirt_xml import network_xml
 from virttest.libvirt_xml import vm_xml
@@ -26,17 +31,187 @@ VIRSH_ARGS = {'ignore_status': False, 'debug': True}
 LOG = logging.getLogger('avocado.' + __name__)
 
 
-def get_vm_ip(session, mac, ip_ver="ipv4", timeout=5, ignore_error=False):
+class VMIPResolver(object):
+    """
+    Resolve vm ip addresses on the host with a mac to ip cache.
+
+    The dnsmasq lease status files of libvirt networks are watched by their
+    mtime, so the leases are only parsed again when dnsmasq changes them,
+    other sources of "virsh domifaddr" (arp, agent) are queried only when
+    the mac is not found in the leases. Only the leases of the network the
+    interface is attached to are used when the vm is known, and expired
+    leases are dropped.
+    """
+
+    LEASE_DIR = '/var/lib/libvirt/dnsmasq'
+
+    def __init__(self, ttl=300):
+        """
+        :param ttl: seconds to keep the entries not from the leases
+        """
+        self.ttl = ttl
+        self.cache = {}
+        self.leases = {}
+        self._lease_mtimes = {}
+
+    def _leases_changed(self):
+        mtimes = {path: os.stat(path).st_mtime for path in
+                  glob.glob(os.path.join(self.LEASE_DIR, '*.status'))}
+        changed = mtimes != self._lease_mtimes
+        self._lease_mtimes = mtimes
+        return changed
+
+    def _load_leases(self):
+        self.leases = {}
+        for path in self._lease_mtimes:
+            try:
+                with open(path) as status_file:
+                    content = status_file.read()
+                entries = json.loads(content) if content.strip() else []
+            except (OSError, ValueError) as e:
+                LOG.debug(f'Skip lease file {path}: {e}')
+                continue
+            leases = self.leases.setdefault(path, {})
+            for entry in entries:
+                mac = entry.get('mac-address')
+                if not mac or entry.get('expiry-time', 0) <= time.time():
+                    continue
+                ip_ver = 'ipv6' if ':' in entry['ip-address'] else 'ipv4'
+                leases[(mac.lower(), ip_ver)] = (entry['ip-address'],
+                                                 entry['expiry-time'])
+
+    def _get_lease_file(self, vm_name, mac):
+        """
+        Get the lease status file of the network the interface is on
+
+        :return: path of the file, '' if the interface is not on a libvirt
+                 network, None if the vm is unknown
+        """
+        if not vm_name:
+            return None
+        vmxml = vm_xml.VMXML.new_from_dumpxml(vm_name)
+        for iface in vmxml.get_devices('interface'):
+            if iface.mac_address.lower() != mac.lower():
+                continue
+            if iface.type_name != 'network':
+                return ''
+            net_inst = network_xml.NetworkXML.new_from_net_dumpxml(
+                iface.source['network'])
+            return os.path.join(self.LEASE_DIR,
+                                net_inst.bridge['name'] + '.status')
+        return ''
+
+    def _query_domifaddr(self, vm_name, source):
+        output = virsh.domifaddr(vm_name, options=f'--source {source}',
+                                 ignore_status=True).stdout_text
+        mac = None
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) != 4 or fields[2] not in ('ipv4', 'ipv6'):
+                continue
+            # Following addresses of the same interface are marked with "-"
+            mac = fields[1].lower() if fields[1] != '-' else mac
+            if mac and not fields[3].startswith('fe80'):
+                self.cache[(mac, fields[2])] = (fields[3].split('/')[0],
+                                                source, time.time() + self.ttl)
+
+    def lookup(self, mac, ip_ver='ipv4', lease_file=None):
+        """
+        Get the cached ip of the mac
+
+        :param mac: mac address
+        :param ip_ver: ip version, ipv4 or ipv6
+        :param lease_file: lease status file to search, None for all of
+                           them, '' for none of them
+        :return: ip address, None if not cached or expired
+        """
+        key = (mac.lower(), ip_ver)
+        paths = list(self.leases) if lease_file is None else [lease_file]
+        for path in paths:
+            entry = self.leases.get(path, {}).get(key)
+            if entry and entry[1] > time.time():
+                return entry[0]
+        entry = self.cache.get(key)
+        if entry and entry[2] > time.time():
+            return entry[0]
+        return None
+
+    def invalidate(self, mac=None):
+        """
+        Drop the cached ips of the mac, or all of them if mac is None
+
+        :param mac: mac address
+        """
+        if mac is None:
+            self.cache.clear()
+            self.leases.clear()
+            self._lease_mtimes = {}
+            return
+        for key in [k for k in self.cache if k[0] == mac.lower()]:
+            self.cache.pop(key)
+        for leases in self.leases.values():
+            for key in [k for k in leases if k[0] == mac.lower()]:
+                leases.pop(key)
+
+    def resolve(self, mac, vm_name=None, ip_ver='ipv4', timeout=60,
+                sources=('lease', 'arp', 'agent'), step=0.2):
+        """
+        Wait for the ip of the mac to show up in any source
+
+        :param mac: mac address
+        :param vm_name: vm name, needed by the arp and agent sources and
+                        to only use the leases of the interface's network
+        :param ip_ver: ip version, ipv4 or ipv6
+        :param timeout: seconds to wait for
+        :param sources: sources to resolve the ip from
+        :param step: seconds between checks
+        :return: ip address, None on timeout
+        """
+        lease_file = self._get_lease_file(vm_name, mac)
+
+        def _resolve():
+            if 'lease' in sources and self._leases_changed():
+                self._load_leases()
+            ip = self.lookup(mac, ip_ver, lease_file)
+            if ip or not vm_name:
+                return ip
+            for source in sources:
+                if source != 'lease':
+                    self._query_domifaddr(vm_name, source)
+                    ip = self.lookup(mac, ip_ver, lease_file)
+                    if ip:
+                        return ip
+
+        ip = utils_misc.wait_for(_resolve, timeout, step=step)
+        LOG.debug(f'Resolved {ip_ver} addr of {mac}: {ip}')
+        return ip
+
+
+VM_IP_RESOLVER = VMIPResolver()
+
+
+def get_vm_ip(session, mac, ip_ver="ipv4", timeout=5, ignore_error=False,
+              vm_name=None):
     """
     Get vm ip address
 
-    :param session: vm session
+    :param session: vm session, None to resolve the ip on the host from the
+                    leases, arp table or guest agent without logging in
     :param mac: mac address of vm
     :param ip_ver: ip version, defaults to "ipv4"
     :param ignore_error: True to return None, False to raise exception,
            defaults to False
+    :param vm_name: vm name to resolve the ip by domifaddr and the leases
+                    of its network when session is None
     :return: ip address of given mac
     """
+    if session is None:
+        vm_ip = VM_IP_RESOLVER.resolve(mac, vm_name, ip_ver, timeout)
+        if not vm_ip and not ignore_error:
+            raise exceptions.TestError(
+                f'Cannot resolve {ip_ver} addr with given mac: {mac}')
+        return vm_ip
+
     def _get_vm_ip():
         iface_info = utils_net.get_linux_iface_info(mac=mac, session=session)
         addr_list = iface_info['addr_info']
@@ -369,6 +544,45 @@ def get_ethtool_coalesce(iface):
     return coalesce
 
 
+def get_guest_irq_count(session, pattern='virtio'):
+    """
+    Get the total interrupt count of the guest irqs matching pattern
+
+    :param session: vm session
+    :param pattern: pattern in the irq name, e.g. 'virtio0-input'
+    :return: sum of the interrupts on all guest cpus
+    """
+    lines = session.cmd_output('cat /proc/interrupts').splitlines()
+    cpus = len(lines[0].split())
+    count = 0
+    for line in lines[1:]:
+        if pattern in line:
+            count += sum(int(x) for x in line.split()[1:cpus + 1]
+                         if x.isdigit())
+    return count
+
+
+def pareto_front(points, objectives):
+    """
+    Get the points not dominated by any other point
+
+    :param points: list of dict-type measurements
+    :param objectives: dict of key and 'max' or 'min' as its direction
+    :return: list of the pareto optimal points
+    """
+    def _better_or_equal(a, b, key):
+        if objectives[key] == 'max':
+            return a[key] >= b[key]
+        return a[key] <= b[key]
+
+    def _dominates(a, b):
+        return (all(_better_or_equal(a, b, key) for key in objectives) and
+                any(a[key] != b[key] for key in objectives))
+
+    return [p for p in points
+            if not any(_dominates(q, p) for q in points if q is not p)]
+
+
 def check_iface_attrs(iface, key, expect_val):
     """
     Check whether interface attribute value meets expectation
@@ -433,11 +647,184 @@ def cleanup_for_iface(iface_type, params):
             libvirt_network.create_or_del_network(network_dict, is_del=True)
 
 
+# Two-sided critical values of t distribution with 95% confidence
+T_CRITICAL_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306,
+                 2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120,
+                 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064,
+                 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+def parse_netperf_interim(netperf_out):
+    """
+    Get the interim results of netperf demo mode (-D)
+
+    :param netperf_out: output of netperf command
+    :return: list of interim throughput values
+    """
+    return [float(val) for val in
+            re.findall(r'Interim result:\s*([\d.]+)', netperf_out)]
+
+
+def reject_outliers(samples, threshold=3.5):
+    """
+    Reject the outliers by the modified z-score based on median absolute
+    deviation
+
+    :param samples: list of values
+    :param threshold: the modified z-score beyond which is outlier
+    :return: tuple of kept values and rejected values
+    """
+    if len(samples) < 3:
+        return list(samples), []
+    median = statistics.median(samples)
+    mad = statistics.median([abs(x - median) for x in samples])
+    if not mad:
+        return list(samples), []
+    kept, rejected = [], []
+    for x in samples:
+        if 0.6745 * abs(x - median) / mad > threshold:
+            rejected.append(x)
+        else:
+            kept.append(x)
+    return kept, rejected
+
+
+def throughput_stats(samples, confidence=0.95, outlier_threshold=3.5):
+    """
+    Get the distribution of throughput samples
+
+    :param samples: list of throughput values
+    :param confidence: confidence level of the interval of the mean
+    :param outlier_threshold: modified z-score to reject outliers, 0 to
+                              keep all the samples
+    :return: dict of the distribution
+    """
+    if outlier_threshold:
+        kept, rejected = reject_outliers(samples, outlier_threshold)
+    else:
+        kept, rejected = list(samples), []
+    mean = statistics.mean(kept)
+    stdev = statistics.stdev(kept) if len(kept) > 1 else 0.0
+    if len(kept) > 1:
+        df = len(kept) - 1
+        if confidence == 0.95 and df <= len(T_CRITICAL_95):
+            critical = T_CRITICAL_95[df - 1]
+        else:
+            critical = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        margin = critical * stdev / math.sqrt(len(kept))
+    else:
+        margin = 0.0
+    return {'samples': list(samples), 'rejected': rejected, 'n': len(kept),
+            'mean': mean, 'stdev': stdev, 'median': statistics.median(kept),
+            'min': min(kept), 'max': max(kept),
+            'ci_low': mean - margin, 'ci_high': mean + margin}
+
+
+def sample_throughput(serv_runner, cli_runner, ip_addr, samples=1,
+                      duration=10, warmup=0, interval=None,
+                      netserver_cmd='netserver', netperf_cmd='netperf'):
+    """
+    Sample the throughput with repeated netperf runs
+
+    :param serv_runner: runner of netserver
+    :param cli_runner: runner of netperf client
+    :param ip_addr: ip address
+    :param samples: number of netperf runs
+    :param duration: length of each netperf run in seconds
+    :param warmup: seconds of interim results to discard in each run
+    :param interval: interim result interval (-D) in seconds, None to take
+                     the final result of each run only
+    :param netserver_cmd: netserver command with path
+    :param netperf_cmd: netperf command with path
+    :return: list of throughput values
+    """
+    if interval and warmup >= duration:
+        raise exceptions.TestError(f'Warmup {warmup}s discards all the '
+                                   f'interim results of a {duration}s run')
+    serv_runner(netserver_cmd)
+    netperf_args = f'-H {ip_addr} -l {duration}'
+    if interval:
+        netperf_args += f' -D {interval}'
+    values = []
+    try:
+        for _ in range(int(samples)):
+            netperf_out = cli_runner(f'{netperf_cmd} {netperf_args}')
+            LOG.debug(netperf_out)
+            interim = parse_netperf_interim(netperf_out) if interval else []
+            interim = interim[int(warmup / interval):] if interim else []
+            if interim:
+                values.extend(interim)
+            else:
+                values.append(
+                    float(netperf_out.strip().splitlines()[-1].split()[-1]))
+    finally:
+        netserver_bin = os.path.basename(netserver_cmd.split()[0])
+        serv_runner(f'pkill {netserver_bin}')
+    return values
+
+
+def run_guest_netperf(session, server_ip, test_type, duration,
+                      test_opts='', netperf_cmd='netperf'):
+    """
+    Run a netperf omni test in vm and collect throughput and latency
+
+    :param session: vm session
+    :param server_ip: ip address of netserver
+    :param test_type: netperf test type, e.g. TCP_STREAM, TCP_RR, TCP_CRR
+    :param duration: length of the run in seconds
+    :param test_opts: extra test specific options, e.g. '-m 64'
+    :param netperf_cmd: netperf command with path
+    :return: dict of throughput, its unit, mean and p99 latency
+    """
+    # -j is needed to keep the latency histogram for P99_LATENCY
+    cmd = f'{netperf_cmd} -H {server_ip} -l {duration} -t {test_type} -j ' \
+          f'-P 0 -- -o THROUGHPUT,THROUGHPUT_UNITS,MEAN_LATENCY,P99_LATENCY ' \
+          f'{test_opts}'
+    status, output = session.cmd_status_output(cmd,
+                                               timeout=int(duration) + 60)
+    LOG.debug(output)
+    if status:
+        raise exceptions.TestFail(f'{test_type} to {server_ip} failed: '
+                                  f'{output}')
+    values = output.strip().splitlines()[-1].split(',')
+    return {'throughput': float(values[0]),
+            'units': values[1],
+            'mean_latency': float(values[2]),
+            'p99_latency': float(values[3])}
+
+
+def get_throughput_check_args(params):
+    """
+    Get the sampling arguments of check_throughput from params
+
+    :param params: test params
+    :return: dict of the arguments
+    """
+    interval = params.get('throughput_interval')
+    max_ci_width = params.get('throughput_max_ci_width')
+    return {'samples': params.get_numeric('throughput_samples', 1),
+            'duration': params.get_numeric('throughput_duration', 10),
+            'warmup': float(params.get('throughput_warmup', 0)),
+            'interval': float(interval) if interval else None,
+            'rel_tol': float(params.get('throughput_rel_tol', 0.1)),
+            'confidence': float(params.get('throughput_confidence', 0.95)),
+            'max_ci_width': float(max_ci_width) if max_ci_width else None}
+
+
 def check_throughput(serv_runner, cli_runner, ip_addr, bw, th_type,
-                     netserver_cmd='netserver', netperf_cmd='netperf'):
+                     netserver_cmd='netserver', netperf_cmd='netperf',
+                     samples=1, duration=None, warmup=0, interval=None,
+                     rel_tol=0.1, confidence=0.95, outlier_threshold=3.5,
+                     max_ci_width=None):
     """
     Check actual thoughput of network using netperf
 
+    With a single sample the result is compared with the expected value
+    directly. With repeated sampling, outliers are rejected and the mean is
+    compared with the expected value. A confidence interval of the mean
+    wider than max_ci_width fails the check when max_ci_width is set, and
+    is only reported otherwise.
+
     :param serv_runner: runner of netserver
     :param cli_runner: runner of netperf client
     :param ip_addr: ip address
@@ -445,22 +832,195 @@ def check_throughput(serv_runner, cli_runner, ip_addr, bw, th_type,
     :param th_type: inbound or outbound
     :param netserver_cmd: netserver command with path (default: 'netserver')
     :param netperf_cmd: netperf command with path (default: 'netperf')
+    :param samples: number of netperf runs
+    :param duration: length of each netperf run, None for netperf default
+    :param warmup: seconds of interim results to discard in each run
+    :param interval: interim result interval (-D) in seconds
+    :param rel_tol: relative tolerance to the expected throughput
+    :param confidence: confidence level of the interval of the mean
+    :param outlier_threshold: modified z-score to reject outliers
+    :param max_ci_width: the largest half width of the confidence interval
+                         relative to the expected throughput, None to not
+                         check it
+    :return: dict of the throughput distribution
     """
-
-    serv_runner(netserver_cmd)
-    netperf_out = cli_runner(f'{netperf_cmd} -H {ip_addr}')
-    LOG.debug(netperf_out)
-    netserver_bin = os.path.basename(netserver_cmd.split()[0])
-    serv_runner(f'pkill {netserver_bin}')
-
-    actual_throu = float(netperf_out.strip().splitlines()[-1].split()[-1])
     expect_throu = int(bw) * 8 / 1024
 
-    msg = f'Expected {th_type}: {expect_throu}, actual {th_type}: {actual_throu}'
-    if not math.isclose(expect_throu, actual_throu, rel_tol=0.1):
+    if samples == 1 and not interval:
+        serv_runner(netserver_cmd)
+        netperf_args = f'-H {ip_addr}'
+        if duration:
+            netperf_args += f' -l {duration}'
+        netperf_out = cli_runner(f'{netperf_cmd} {netperf_args}')
+        LOG.debug(netperf_out)
+        netserver_bin = os.path.basename(netserver_cmd.split()[0])
+        serv_runner(f'pkill {netserver_bin}')
+
+        actual_throu = float(netperf_out.strip().splitlines()[-1].split()[-1])
+        stats = throughput_stats([actual_throu], outlier_threshold=0)
+        passed = math.isclose(expect_throu, actual_throu, rel_tol=rel_tol)
+    else:
+        values = sample_throughput(serv_runner, cli_runner, ip_addr, samples,
+                                   duration or 10, warmup, interval,
+                                   netserver_cmd, netperf_cmd)
+        stats = throughput_stats(values, confidence, outlier_threshold)
+        actual_throu = stats['mean']
+        passed = math.isclose(expect_throu, actual_throu, rel_tol=rel_tol)
+        ci_width = (stats['ci_high'] - stats['ci_low']) / 2
+        if max_ci_width is not None and ci_width > expect_throu * max_ci_width:
+            raise exceptions.TestFail(
+                f'{th_type} is too noisy to check: {confidence:.0%} CI '
+                f'[{stats["ci_low"]:.2f}, {stats["ci_high"]:.2f}] is wider '
+                f'than {max_ci_width:.0%} of expected {expect_throu}')
+        if ci_width > expect_throu * rel_tol:
+            LOG.warning(f'{th_type} is noisy: {confidence:.0%} CI '
+                        f'[{stats["ci_low"]:.2f}, {stats["ci_high"]:.2f}] is '
+                        f'wider than {rel_tol:.0%} of expected {expect_throu}')
+
+    msg = (f'Expected {th_type}: {expect_throu}, actual {th_type}: '
+           f'{actual_throu} (median {stats["median"]}, stdev '
+           f'{stats["stdev"]:.2f}, {confidence:.0%} CI [{stats["ci_low"]:.2f}'
+           f', {stats["ci_high"]:.2f}], {stats["n"]} samples, '
+           f'{len(stats["rejected"])} outliers rejected)')
+    if not passed:
         raise exceptions.TestFail(f'Actual {th_type} is not close to expected '
                                   f'{th_type}:\n{msg}')
     LOG.debug(msg)
+    return stats
+
+
+class IfaceRateSampler(object):
+    """
+    Sample a byte counter of a host interface at a fixed interval in the
+    background to get the time series of the throughput.
+    """
+
+    def __init__(self, ifname, counter='tx_bytes', interval=0.1):
+        """
+        :param ifname: host interface name
+        :param counter: statistics counter, tx_bytes or rx_bytes
+        :param interval: sampling interval in seconds
+        """
+        self.path = f'/sys/class/net/{ifname}/statistics/{counter}'
+        self.interval = interval
+        self.samples = []
+        self.start_time = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _read(self):
+        with open(self.path) as counter_file:
+            return int(counter_file.read())
+
+    def _sample(self):
+        next_time = time.time()
+        while not self._stop_event.is_set():
+            self.samples.append((time.time(), self._read()))
+            next_time += self.interval
+            self._stop_event.wait(max(next_time - time.time(), 0))
+
+    def start(self):
+        self.samples = []
+        self._stop_event.clear()
+        self.start_time = time.time()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def elapsed(self):
+        """
+        :return: seconds since the sampling started
+        """
+        return time.time() - self.start_time
+
+    def stop(self):
+        """
+        :return: list of (time, rate in KiB/s) of each interval, the time
+                 is the end of the interval relative to the start
+        """
+        self._stop_event.set()
+        self._thread.join()
+        rates = []
+        for (t1, b1), (t2, b2) in zip(self.samples, self.samples[1:]):
+            rates.append((t2 - self.start_time, (b2 - b1) / (t2 - t1) / 1024))
+        return rates
+
+
+def slice_rates(rates, start, end=None):
+    """
+    Get the rates in the time range with the time relative to its start
+
+    :param rates: list of (time, rate)
+    :param start: start time, exclusive
+    :param end: end time, inclusive, None for no limit
+    :return: list of (time, rate)
+    """
+    return [(t - start, rate) for t, rate in rates
+            if t > start and (end is None or t <= end)]
+
+
+def get_active_span(rates, threshold):
+    """
+    Get the time range in which the rate is above threshold
+
+    :param rates: list of (time, rate)
+    :param threshold: rate under which the interface is regarded as idle
+    :return: tuple of start and end time, start is the end of the last
+             idle interval before the traffic
+    """
+    active = [i for i, (_, rate) in enumerate(rates) if rate > threshold]
+    if not active:
+        raise exceptions.TestError('No traffic was sampled')
+    start = rates[active[0] - 1][0] if active[0] else 0.0
+    return start, rates[active[-1]][0]
+
+
+def analyze_shaping(rates, average, peak=None, burst=None, rel_tol=0.1,
+                    window=10):
+    """
+    Analyze the shaping accuracy of a throughput time series
+
+    The units follow the libvirt bandwidth settings, KiB/s for the rates
+    and KiB for the burst.
+
+    :param rates: list of (time, rate) relative to the start of traffic
+    :param average: configured average rate
+    :param peak: configured peak rate if any
+    :param burst: configured burst size if any
+    :param rel_tol: relative tolerance of a converged rate
+    :param window: number of samples of the moving average
+    :return: dict of the shaping metrics
+    """
+    average = float(average)
+    limit = float(peak) if peak else average
+    values = [rate for _, rate in rates]
+    # The burst is the largest excess of bytes over the average rate
+    excess = max_excess = 0.0
+    prev_t = 0.0
+    for t, rate in rates:
+        excess += (rate - average) * (t - prev_t)
+        max_excess = max(max_excess, excess)
+        prev_t = t
+    # Converged after the end of the last moving window out of tolerance
+    window = min(window, len(values))
+    convergence = 0.0
+    for i in range(len(values) - window + 1):
+        mean = statistics.mean(values[i:i + window])
+        if not math.isclose(mean, average, rel_tol=rel_tol):
+            convergence = rates[i + window - 1][0]
+    steady = values[-window:]
+    result = {
+        'samples': len(values),
+        'mean': statistics.mean(values),
+        'max_rate': max(values),
+        'overshoot': max(max(values) / limit - 1, 0.0),
+        'burst': max_excess,
+        'burst_ratio': max_excess / float(burst) if burst else None,
+        'convergence_time': convergence,
+        'converged': math.isclose(statistics.mean(steady), average,
+                                  rel_tol=rel_tol),
+    }
+    LOG.debug(f'Shaping analysis against average {average}: {result}')
+    return result
 
 
 def exec_netperf_test(params, env):
@@ -593,6 +1153,138 @@ def exec_netperf_test(params, env):
         process.run("systemctl start firewalld", ignore_status=True)
 
 
+def build_netperf_pairs(vms, topology='pairwise'):
+    """
+    Build the client/server pairs of the netperf mesh
+
+    :param vms: list of vm names
+    :param topology: pairwise, ring or all_to_all
+    :return: list of (client, server) tuples
+    """
+    if topology == 'pairwise':
+        return [(vms[i], vms[i + 1]) for i in range(0, len(vms) - 1, 2)]
+    if topology == 'ring':
+        if len(vms) == 2:
+            return [(vms[0], vms[1])]
+        return [(vms[i], vms[(i + 1) % len(vms)]) for i in range(len(vms))]
+    if topology == 'all_to_all':
+        return [(cli, serv) for cli in vms for serv in vms if cli != serv]
+    raise exceptions.TestError(f'Unsupported mesh topology: {topology}')
+
+
+def jain_fairness(values):
+    """
+    Get Jain's fairness index of the values
+
+    :param values: list of throughput values
+    :return: fairness index from 1/n to 1
+    """
+    if not values or not any(values):
+        return 0.0
+    return sum(values) ** 2 / (len(values) * sum(v ** 2 for v in values))
+
+
+def exec_netperf_mesh(params, env, serial=False):
+    """
+    Run concurrent netperf streams between the vms and measure the
+    aggregate and per pair throughput, the fairness and the host cpu.
+
+    The streams of a client vm are started in background in one session,
+    so vms with direct interfaces, which can't be reached from the host,
+    run them over the serial console.
+
+    :param params: Dictionary with the test parameters.
+    :param env: Dictionary with test environment.
+    :param serial: True to log into the vms by the serial console, for the
+                   interfaces can't be reached from the host, e.g. direct
+    :return: dict of the results
+    """
+    vms = params.get('vms').split()
+    topology = params.get('netperf_mesh_topology', 'pairwise')
+    duration = params.get_numeric('netperf_timeout', 60)
+    test_protocol = params.get('test_protocol', 'TCP_STREAM')
+    netperf_opts = params.get('netperf_opts', '')
+    firewall_cmd = params.get('firewall_cmd', 'systemctl stop firewalld')
+    netserver_cmd = params.get('netserver_cmd', 'netserver')
+    netperf_bin = params.get('netperf_bin', 'netperf')
+    login_timeout = params.get_numeric('login_timeout', 360)
+
+    pairs = build_netperf_pairs(vms, topology)
+    if not pairs:
+        raise exceptions.TestError(f'No netperf pair of {vms} with '
+                                   f'topology {topology}')
+    vm_objs = {vm_i: env.get_vm(vm_i) for vm_i in vms}
+    servers = set(serv for _, serv in pairs)
+    sessions = {}
+    vm_ips = {}
+    try:
+        for vm_name, vm in vm_objs.items():
+            if not vm.is_alive():
+                vm.start()
+            if serial:
+                session = vm.wait_for_serial_login(timeout=login_timeout)
+                vm_ips[vm_name] = get_vm_ip(
+                    session, vm_xml.VMXML.get_first_mac_by_name(vm_name),
+                    timeout=login_timeout)
+            else:
+                session = vm.wait_for_login(timeout=login_timeout)
+                vm_ips[vm_name] = vm.get_address()
+            sessions[vm_name] = session
+            if not utils_package.package_install('netperf', session):
+                raise exceptions.TestError(
+                    f'Unable to install netperf on {vm_name}!')
+            session.cmd(firewall_cmd, ignore_all_errors=True)
+            if vm_name in servers:
+                session.cmd_output('killall netserver')
+                session.cmd(netserver_cmd)
+
+        results = {'topology': topology, 'protocol': test_protocol,
+                   'pairs': []}
+        for index, (client, server) in enumerate(pairs):
+            result = {'client': client, 'server': server,
+                      'output': f'/tmp/netperf_mesh_{index}.out'}
+            results['pairs'].append(result)
+            sessions[client].cmd(
+                f'nohup {netperf_bin} -H {vm_ips[server]} -l {duration} '
+                f'-t {test_protocol} -P 0 -- -o THROUGHPUT {netperf_opts} '
+                f'> {result["output"]} 2>&1 &')
+        LOG.info(f'Started {len(pairs)} concurrent netperf streams '
+                 f'with {topology} topology')
+        mpstat = process.run(f'mpstat 1 {max(duration - 2, 1)} | tail -n 1',
+                             shell=True, ignore_status=True).stdout_text
+        idle = float(mpstat.split()[-1]) if mpstat.strip() else 100.0
+
+        clients = set(cli for cli, _ in pairs)
+        if not utils_misc.wait_for(
+                lambda: all(sessions[cli].cmd_status('pidof netperf')
+                            for cli in clients), 60, step=2):
+            LOG.error('Netperf streams are still running')
+        for result in results['pairs']:
+            output = sessions[result['client']].cmd_output(
+                f'cat {result.pop("output")}')
+            try:
+                result['throughput'] = float(output.strip().splitlines()[-1])
+            except (IndexError, ValueError) as e:
+                LOG.error(f'Netperf of {result["client"]} -> '
+                          f'{result["server"]} failed: {output} {e}')
+                result['throughput'] = 0.0
+    finally:
+        for vm_name, session in sessions.items():
+            session.cmd_output('pkill netperf; rm -f /tmp/netperf_mesh_*.out')
+            if vm_name in servers:
+                session.cmd_output('killall netserver')
+            session.close()
+
+    throughputs = [pair['throughput'] for pair in results['pairs']]
+    results['aggregate'] = sum(throughputs)
+    results['fairness'] = jain_fairness(throughputs)
+    results['host_cpu'] = 100 - idle
+    results['aggregate_per_cpu'] = (results['aggregate'] / results['host_cpu']
+                                    if results['host_cpu'] else 0.0)
+    LOG.debug(f'Netperf mesh results: {results}')
+    return results
+
+
 def prepare_single_vm(params, vm_name, disk_path='', iface_list=[]):
     """
     Prepare single vm with specified disk image and interface.
@@ -705,6 +1397,136 @@ def get_vhost_tids(vm):
     return tids
 
 
+def get_threads_cpu_time(tids, pid=None):
+    """
+    Get the consumed cpu time of host threads
+
+    :param tids: list of thread ids
+    :param pid: process id the threads belong to, None for kernel threads
+                or threads looked up directly under /proc
+    :return: dict of thread id and its user+system cpu time in seconds
+    """
+    clk_tck = os.sysconf('SC_CLK_TCK')
+    cpu_time = {}
+    for tid in tids:
+        stat_path = (f'/proc/{pid}/task/{tid}/stat' if pid
+                     else f'/proc/{tid}/stat')
+        try:
+            with open(stat_path) as stat_file:
+                stat = stat_file.read()
+        except IOError:
+            continue
+        # Skip the comm field as it may include spaces
+        fields = stat[stat.rindex(')') + 2:].split()
+        cpu_time[tid] = (int(fields[11]) + int(fields[12])) / clk_tck
+    return cpu_time
+
+
+def classify_qemu_threads(pid, vhost_tids=None):
+    """
+    Classify the threads of a qemu process as vcpu, vhost, iothread or
+    emulator by their names
+
+    :param pid: qemu process id
+    :param vhost_tids: vhost thread ids, including vhost kernel threads
+                       which don't belong to the qemu process
+    :return: dict of thread id and its category
+    """
+    vhost_tids = set(vhost_tids or [])
+    threads = {tid: 'vhost' for tid in vhost_tids}
+    task_dir = f'/proc/{pid}/task'
+    for tid in os.listdir(task_dir):
+        tid = int(tid)
+        if tid in vhost_tids:
+            continue
+        try:
+            with open(os.path.join(task_dir, str(tid), 'comm')) as comm_file:
+                comm = comm_file.read().strip()
+        except IOError:
+            continue
+        if re.match(r'CPU \d+/KVM', comm):
+            threads[tid] = 'vcpu'
+        elif comm.startswith('vhost'):
+            threads[tid] = 'vhost'
+        elif comm.startswith('IO '):
+            threads[tid] = 'iothread'
+        else:
+            threads[tid] = 'emulator'
+    return threads
+
+
+def get_host_cpu_ticks():
+    """
+    Get the busy and total ticks of all host cpus from /proc/stat
+
+    :return: tuple of busy ticks and total ticks
+    """
+    with open('/proc/stat') as stat_file:
+        fields = [int(f) for f in stat_file.readline().split()[1:]]
+    # idle and iowait are not busy
+    total = sum(fields[:8])
+    return total - fields[3] - fields[4], total
+
+
+class HostCpuAttribution(object):
+    """
+    Attribute the host cpu of a measurement window to the vcpu, vhost,
+    iothread and emulator threads of a vm, the rest of the busy host cpu is
+    counted as other.
+
+    All the values are in percentage of all host cpus, the same unit as
+    the cpu usage from mpstat.
+    """
+
+    CATEGORIES = ('vcpu', 'vhost', 'iothread', 'emulator', 'other')
+
+    def __init__(self, vm):
+        """
+        :param vm: libvirt vm object
+        """
+        self.pid = vm.get_pid()
+        self.threads = classify_qemu_threads(self.pid, get_vhost_tids(vm))
+        self.start_time = None
+        self.start_ticks = None
+        self.start_cpu = None
+
+    def _thread_times(self):
+        cpu_time = {}
+        for tid in self.threads:
+            task_time = get_threads_cpu_time([tid], self.pid)
+            if not task_time:
+                # vhost kernel threads are not in the qemu task list
+                task_time = get_threads_cpu_time([tid])
+            cpu_time.update(task_time)
+        return cpu_time
+
+    def start(self):
+        self.start_cpu = self._thread_times()
+        self.start_ticks = get_host_cpu_ticks()
+        self.start_time = time.time()
+
+    def stop(self):
+        """
+        :return: dict of category and its cpu percentage of the window
+        """
+        end_cpu = self._thread_times()
+        end_ticks = get_host_cpu_ticks()
+        elapsed = time.time() - self.start_time
+        capacity = elapsed * os.cpu_count()
+        usage = {category: 0.0 for category in self.CATEGORIES}
+        for tid, category in self.threads.items():
+            if tid in end_cpu and tid in self.start_cpu:
+                usage[category] += (end_cpu[tid] - self.start_cpu[tid]) \
+                    / capacity * 100
+        busy = end_ticks[0] - self.start_ticks[0]
+        total = end_ticks[1] - self.start_ticks[1]
+        host_busy = busy / total * 100 if total else 0.0
+        usage['other'] = max(host_busy - sum(usage.values()), 0.0)
+        LOG.debug("Host cpu attribution of vm process %s: %s",
+                  self.pid, usage)
+        return usage
+
+
 def pin_vhost_threads(vm, vhost_tids, cpus):
     """
     Pin vhost threads to specified host cpus.
@@ -754,6 +1576,179 @@ def pin_vcpu_vhost_threads(vm, node=None):
         raise exceptions.TestError("Failed to pin VM threads: %s" % e)
 
 
+def get_host_cpu_topology():
+    """
+    Get host cpu topology from sysfs
+
+    :return: dict of 'nodes' (node id: sorted online cpus), 'siblings'
+             (cpu: sorted smt sibling cpus) and 'distance'
+             (node id: distance list)
+    """
+    topology = {'nodes': {}, 'siblings': {}, 'distance': {}}
+    node_root = '/sys/devices/system/node'
+    cpu_root = '/sys/devices/system/cpu'
+    with open(os.path.join(cpu_root, 'online')) as online_file:
+        online = set(cpus_parser(online_file.read().strip()))
+    node_dirs = [d for d in os.listdir(node_root)
+                 if re.match(r'node\d+$', d)] if os.path.isdir(node_root) \
+        else []
+    for node_dir in node_dirs:
+        node = int(node_dir[4:])
+        with open(os.path.join(node_root, node_dir, 'cpulist')) as cpu_file:
+            cpus = cpus_parser(cpu_file.read().strip())
+        cpus = sorted(cpu for cpu in cpus if cpu in online)
+        if not cpus:
+            continue
+        topology['nodes'][node] = cpus
+        with open(os.path.join(node_root, node_dir, 'distance')) as dis_file:
+            topology['distance'][node] = [
+                int(d) for d in dis_file.read().split()]
+    if not topology['nodes']:
+        topology['nodes'][0] = sorted(online)
+        topology['distance'][0] = [10]
+    for cpu in online:
+        sibling_path = os.path.join(cpu_root, f'cpu{cpu}',
+                                    'topology/thread_siblings_list')
+        try:
+            with open(sibling_path) as sibling_file:
+                siblings = cpus_parser(
+                    sibling_file.read().strip())
+        except IOError:
+            siblings = [cpu]
+        topology['siblings'][cpu] = sorted(s for s in siblings if s in online)
+    return topology
+
+
+def get_nic_numa_node(iface):
+    """
+    Get the numa node of a host nic
+
+    :param iface: host interface name
+    :return: numa node id, or None if the nic has no locality
+    """
+    path = f'/sys/class/net/{iface}/device/numa_node'
+    if not os.path.exists(path):
+        return None
+    with open(path) as node_file:
+        node = int(node_file.read().strip())
+    return node if node >= 0 else None
+
+
+def get_vm_pin_threads(vm):
+    """
+    Get the threads of a vm which need to be pinned
+
+    :param vm: libvirt vm object
+    :return: dict of vcpu count, iothread ids and vhost thread ids
+    """
+    iothread_out = virsh.iothreadinfo(vm.name, ignore_status=True).stdout_text
+    return {
+        'vcpus': int(vm.dominfo().get('CPU(s)', 0)),
+        'iothreads': re.findall(r'^\s*(\d+)\s+\S+', iothread_out, re.M),
+        'vhost': get_vhost_tids(vm),
+    }
+
+
+def plan_vm_pinning(vm_threads, topology, node=None, reserved_cpus=None):
+    """
+    Compute a non-conflicting placement of the vm threads.
+
+    The cpus of the preferred node (the nic node) are used first, and then
+    the other nodes in order of distance. Physical cores are handed out
+    before their smt siblings, vcpus get cpus first, then vhost threads and
+    iothreads, and the emulator of each vm shares one cpu with its
+    iothreads, or with its last vhost/vcpu thread if there are no more cpus.
+
+    :param vm_threads: dict of vm name and its threads from
+                       get_vm_pin_threads
+    :param topology: host cpu topology from get_host_cpu_topology
+    :param node: preferred numa node id in sysfs, None to use the first node
+    :param reserved_cpus: list of cpus kept for host housekeeping
+    :return: dict of vm name and its placement
+    """
+    nodes = sorted(topology['nodes'])
+    node = nodes[0] if node is None else int(node)
+    if node not in topology['nodes']:
+        raise exceptions.TestError(f'Unknown numa node {node}, host nodes '
+                                   f'are {nodes}')
+    distance = topology['distance'].get(node, [])
+    node_order = sorted(
+        nodes, key=lambda n: (distance[n] if n < len(distance) else 255, n))
+    reserved = set(reserved_cpus or [])
+
+    free_cpus = []
+    for node_id in node_order:
+        cpus = [c for c in topology['nodes'][node_id] if c not in reserved]
+        primary = [c for c in cpus
+                   if topology['siblings'].get(c, [c])[0] == c]
+        free_cpus.extend(primary + [c for c in cpus if c not in primary])
+
+    def _take(count):
+        if count > len(free_cpus):
+            raise exceptions.TestError(
+                f'Not enough host cpus for the pinning plan, need {count} '
+                f'more, only {len(free_cpus)} free')
+        taken = free_cpus[:count]
+        del free_cpus[:count]
+        return taken
+
+    plan = {}
+    for vm_name, threads in vm_threads.items():
+        vm_plan = {'node': node, 'vcpus': _take(threads['vcpus'])}
+        vm_plan['vhost'] = dict(zip(threads['vhost'],
+                                    _take(len(threads['vhost']))))
+        io_cpus = _take(1) if threads['iothreads'] else []
+        vm_plan['iothreads'] = {iothread: io_cpus[0]
+                                for iothread in threads['iothreads']}
+        if io_cpus:
+            vm_plan['emulator'] = io_cpus[0]
+        elif free_cpus:
+            vm_plan['emulator'] = _take(1)[0]
+        else:
+            vm_plan['emulator'] = (list(vm_plan['vhost'].values()) +
+                                   vm_plan['vcpus'])[-1]
+        plan[vm_name] = vm_plan
+    return plan
+
+
+def apply_vm_pinning(vm, vm_plan):
+    """
+    Apply the placement of a vm from plan_vm_pinning
+
+    :param vm: libvirt vm object
+    :param vm_plan: placement of the vm
+    """
+    for vcpu, cpu in enumerate(vm_plan['vcpus']):
+        vm.vcpupin(vcpu, str(cpu))
+    pin_vhost_threads(vm, list(vm_plan['vhost'].keys()),
+                      list(vm_plan['vhost'].values()))
+    for iothread, cpu in vm_plan['iothreads'].items():
+        virsh.iothreadpin(vm.name, iothread, str(cpu), **VIRSH_ARGS)
+    virsh.emulatorpin(vm.name, str(vm_plan['emulator']), **VIRSH_ARGS)
+    LOG.info("Applied pinning plan of vm %s: %s", vm.name, vm_plan)
+
+
+def plan_and_pin_vms(vms, node=None, nic=None, reserved_cpus=None):
+    """
+    Plan and apply a numa aware pinning of the vcpu/vhost/iothread/emulator
+    threads of the vms
+
+    :param vms: list of libvirt vm objects
+    :param node: preferred numa node id in sysfs, the node of nic if None
+    :param nic: host nic of the data path, to get the numa locality
+    :param reserved_cpus: list of cpus kept for host housekeeping
+    :return: the plan
+    """
+    topology = get_host_cpu_topology()
+    if node is None and nic:
+        node = get_nic_numa_node(nic)
+    vm_threads = {vm.name: get_vm_pin_threads(vm) for vm in vms}
+    plan = plan_vm_pinning(vm_threads, topology, node, reserved_cpus)
+    for vm in vms:
+        apply_vm_pinning(vm, plan[vm.name])
+    return plan
+
+
 def cancel_if_ovs_bridge(params, test):
     """
     Cancel test if host using OVS bridge (for only Linux Bridge tests).
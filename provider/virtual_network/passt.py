@@ -13,6 +13,8 @@ from virttest import utils_net
 from virttest import utils_selinux
 from virttest.utils_libvirt import libvirt_vmxml
 
+from provider.virtual_network import network_base
+
 VIRSH_ARGS = {'ignore_status': False, 'debug': True}
 IPV6_LENGTH = 128
 
@@ -493,3 +495,62 @@ def generate_random_ip_addr(exclude_multicast_addr=False):
 
     digits = [str(first_octet)] + [str(random.randint(0, 255)) for i in range(3)]
     return '.'.join(digits)
+
+
+def get_proc_usage(pid):
+    """
+    Get cpu time and resident memory of process with given pid
+
+    :param pid: pid of the process
+    :return: dict of cpu time in seconds and rss in kB
+    """
+    with open(f'/proc/{pid}/stat') as stat_file:
+        # Skip "pid (comm)" since comm may contain spaces
+        fields = stat_file.read().rsplit(')', 1)[1].split()
+    ticks = int(fields[11]) + int(fields[12])
+    rss = 0
+    with open(f'/proc/{pid}/status') as status_file:
+        for line in status_file:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+    return {'cpu_time': ticks / os.sysconf('SC_CLK_TCK'), 'rss_kb': rss}
+
+
+def get_passt_pid():
+    """
+    Get pid of the running passt process
+
+    :return: pid of passt, str type
+    """
+    return get_proc_info('passt')['PID']
+
+
+def benchmark_data_path(session, server_ip, workloads, duration, pids):
+    """
+    Run workloads over the current data path and record process cost
+
+    :param session: vm session
+    :param server_ip: address of host as seen from vm
+    :param workloads: list of netperf test types
+    :param duration: length of each run in seconds
+    :param pids: dict of name and pid of host processes to account
+    :return: dict of workload and its guest and process metrics
+    """
+    results = {}
+    for test_type in workloads:
+        before = {name: get_proc_usage(pid) for name, pid in pids.items()}
+        start = time.time()
+        result = network_base.run_guest_netperf(session, server_ip,
+                                                test_type, duration)
+        elapsed = time.time() - start
+        result['proc'] = {}
+        for name, pid in pids.items():
+            after = get_proc_usage(pid)
+            cpu = after['cpu_time'] - before[name]['cpu_time']
+            result['proc'][name] = {
+                'cpu_percent': round(cpu / elapsed * 100, 2),
+                'rss_kb': after['rss_kb'],
+            }
+        LOG.info(f'{test_type}: {result}')
+        results[test_type] = result
+    return results
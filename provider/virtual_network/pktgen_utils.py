@@ -1,6 +1,7 @@
 import aexpect
 import logging
 import os
+import time
 
 from avocado.utils import process
 
@@ -87,6 +88,7 @@ class PktgenConfig:
         size,
         burst,
         session_serial=None,
+        delay=None,
     ):
         """
         Generate pktgen command based on test parameters.
@@ -99,6 +101,8 @@ class PktgenConfig:
         :param size: Packet size
         :param burst: Burst size
         :param session_serial: Serial session for guest command execution
+        :param delay: Tx delay (ns) of each thread to limit the rate,
+                      None means no limit
         :return: Generated command string
         """
         cmd = "%s -i %s -m %s -n 0 -t %s -s %s -b %s -c 0" % (
@@ -109,6 +113,8 @@ class PktgenConfig:
             size,
             burst,
         )
+        if delay is not None:
+            cmd = "%s -w %d" % (cmd, delay)
 
         if (
             session_serial
@@ -230,6 +236,10 @@ def run_tests_for_category(
     guest_mac = vm.get_mac_address(0)
     guest_eth = utils_net.get_linux_ifname(session_serial, guest_mac)
 
+    if params.get("pktgen_search_mode") == "zero_loss":
+        run_rate_search_for_category(params, result_file, vm, session_serial)
+        return
+
     record_line = ""
     for record in record_list:
         record_line += "%s|" % format_result(record)
@@ -276,3 +286,186 @@ def run_tests_for_category(
             line += "%s|" % format_result(burst)
             line += "%s" % format_result(pkt_cate_r)
             result_file.write(("%s\n" % line))
+
+
+def _run_output(runner, cmd):
+    """Run cmd by runner and return its output as string"""
+    output = runner(cmd)
+    if isinstance(output, process.CmdResult):
+        output = output.stdout_text
+    return output
+
+
+def stop_pktgen(script, runner):
+    """
+    Stop the pktgen script and the pktgen threads where the runner runs.
+
+    :param script: pktgen script name
+    :param runner: the command runner function, a shell session cmd or
+                   process.run
+    """
+    stop_cmd = ("pkill -9 -f %s; echo stop > /proc/net/pktgen/pgctrl"
+                % script)
+    session = getattr(runner, "__self__", None)
+    if isinstance(session, aexpect.ShellSession):
+        # The session is still busy with the script if it ran in foreground
+        session.sendcontrol("c")
+        session.cmd_status(stop_cmd, timeout=60)
+    else:
+        process.run(stop_cmd, shell=True, ignore_status=True)
+
+
+def run_loss_trial(script, cmd, runner, sent_reader, recv_reader, duration,
+                   session_serial=None):
+    """
+    Run pktgen for a while and count the sent and received packets.
+
+    :param script: pktgen script name
+    :param cmd: the command to execute the pktgen script
+    :param runner: the command runner function
+    :param sent_reader: function to get the sent packets counter
+    :param recv_reader: function to get the received packets counter
+    :param duration: how long to send the packets
+    :param session_serial: session serial for VM
+    :return: tuple of sent pps, received pps and loss ratio
+    """
+    sent_b, recv_b = sent_reader(), recv_reader()
+    LOG_JOB.info("Start pktgen trial by cmd '%s'", cmd)
+    try:
+        runner(cmd, duration)
+        if session_serial and runner == session_serial.cmd:
+            # the script is sent to background in guest
+            time.sleep(duration)
+    except (aexpect.ShellTimeoutError, process.CmdError):
+        pass
+    # The script sends until it's stopped, so stop it for every runner,
+    # otherwise the next trial and the counters share a busy sender
+    stop_pktgen(script, runner)
+    sent = sent_reader() - sent_b
+    recv = recv_reader() - recv_b
+    loss = (sent - recv) / sent if sent else 1.0
+    return sent / duration, recv / duration, max(loss, 0.0)
+
+
+def search_zero_loss_rate(trial, max_pps, loss_threshold=0.0,
+                          resolution=0.01, max_iterations=12):
+    """
+    Binary search the highest rate whose loss is not beyond the threshold,
+    as the throughput test of RFC2544.
+
+    :param trial: function with the target pps (None for unlimited),
+                  returns tuple of sent pps, received pps and loss ratio
+    :param max_pps: the upper bound of the search
+    :param loss_threshold: the acceptable loss ratio
+    :param resolution: stop when the range is narrower than this ratio
+                       of max_pps
+    :param max_iterations: the maximum number of trials
+    :return: tuple of the highest zero loss pps and the curve, a list of
+             (target pps, sent pps, received pps, loss) tuples
+    """
+    low, high = 0.0, float(max_pps)
+    best = 0.0
+    curve = []
+    for _ in range(max_iterations):
+        if high - low <= max_pps * resolution:
+            break
+        rate = (low + high) / 2
+        sent_pps, recv_pps, loss = trial(rate)
+        curve.append((rate, sent_pps, recv_pps, loss))
+        LOG_JOB.debug("Trial rate %.0f pps: sent %.0f received %.0f "
+                      "loss %.6f", rate, sent_pps, recv_pps, loss)
+        if loss <= loss_threshold:
+            best = max(best, sent_pps)
+            low = rate
+        else:
+            high = rate
+    return best, sorted(curve)
+
+
+def run_rate_search_for_category(params, result_file, vm=None,
+                                 session_serial=None):
+    """
+    Search the zero loss maximum packet rate for each packet size and
+    thread count of the tx/rx categories.
+
+    :param params: Dictionary with the test parameters
+    :param result_file: File to write the test results
+    :param vm: VM instance
+    :param session_serial: Session serial for VM
+    """
+    duration = params.get_numeric("pktgen_trial_time", "10")
+    loss_threshold = float(params.get("pktgen_loss_threshold", "0"))
+    resolution = float(params.get("pktgen_search_resolution", "0.01"))
+    max_iterations = params.get_numeric("pktgen_search_iterations", "12")
+    sizes = params.get_list("pktgen_search_sizes", params.get("pkt_size"))
+    threads_list = params.get_list("pktgen_search_threads",
+                                   params.get("pktgen_threads"))
+    burst = params.get("burst", "1")
+    guest_mac = vm.get_mac_address(0)
+    guest_eth = utils_net.get_linux_ifname(session_serial, guest_mac)
+    host_iface = libvirt.get_ifname_host(vm.name, guest_mac)
+
+    def _counter(runner, iface, counter):
+        path = "/sys/class/net/%s/statistics/%s" % (iface, counter)
+        return lambda: int(_run_output(runner, "cat %s" % path))
+
+    record_line = "|".join(format_result(record) for record in (
+        "pkt_size", "run_threads", "burst", "max_mpps", "line_mpps"))
+    pktgen_config = PktgenConfig()
+    for script in params.get("pktgen_script").split():
+        for pkt_cate in params.get("pkg_dir").split():
+            if pkt_cate == "loopback":
+                # configure_pktgen sets up no sender/receiver pair for
+                # loopback, so there is no path whose loss can be counted
+                LOG_JOB.warning("Rate search skips the loopback category: "
+                                "it isn't configured by PktgenConfig")
+                result_file.write("Script:%s Category:%s Search:skipped, "
+                                  "loopback isn't configured by PktgenConfig\n"
+                                  % (script, pkt_cate))
+                continue
+            pktgen_config = pktgen_config.configure_pktgen(
+                pkt_cate, vm, session_serial, script=script, params=params
+            )
+            guest_counter = _counter(
+                session_serial.cmd, guest_eth,
+                "tx_packets" if pkt_cate == "tx" else "rx_packets")
+            if pkt_cate == "tx":
+                sent_reader = guest_counter
+                recv_reader = _counter(process.run, host_iface, "rx_packets")
+            else:
+                sent_reader = _counter(pktgen_config.runner,
+                                       pktgen_config.interface, "tx_packets")
+                recv_reader = guest_counter
+            result_file.write("Script:%s Category:%s Search:zero_loss\n"
+                              % (script, pkt_cate))
+            result_file.write("%s\n" % record_line)
+            for size in sizes:
+                for threads in threads_list:
+                    def _trial(rate):
+                        delay = None
+                        if rate:
+                            delay = int(int(threads) * int(burst) * 10 ** 9
+                                        / rate)
+                        cmd = pktgen_config.generate_pktgen_cmd(
+                            script, pkt_cate, pktgen_config.interface,
+                            pktgen_config.dsc, threads, size, burst,
+                            session_serial, delay=delay,
+                        )
+                        return run_loss_trial(
+                            script, cmd, pktgen_config.runner, sent_reader,
+                            recv_reader, duration, session_serial)
+
+                    line_pps, _, _ = _trial(None)
+                    best, curve = search_zero_loss_rate(
+                        _trial, line_pps, loss_threshold, resolution,
+                        max_iterations)
+                    line = "|".join(format_result(value) for value in (
+                        size, threads, burst, best / 10 ** 6,
+                        line_pps / 10 ** 6))
+                    result_file.write("%s\n" % line)
+                    for rate, sent_pps, recv_pps, loss in curve:
+                        result_file.write(
+                            "# curve size=%s threads=%s target_pps=%.0f "
+                            "sent_pps=%.0f recv_pps=%.0f loss=%.6f\n"
+                            % (size, threads, rate, sent_pps, recv_pps, loss))
+                    result_file.flush()